@@ -0,0 +1,389 @@
+"""
+JSON query API over the co2 data set, registered on app.server under /api/v1.
+
+Every endpoint returns a columnar JSON document:
+    {"dataset_version": "...", "index": [...], "columns": [...], "data": {"column": [values, ...], ...}}
+with NaN as null, or an Arrow IPC stream when called with ?format=arrow (requires pyarrow).
+
+Results come from the same functions the pages use, and the summary, growth, multiplier, and elasticity tables are
+also persisted to disk when CO2_CACHE_DIR is set. Every query can hold any combination of countries, columns, and years,
+so only the MAX_CACHED_QUERIES most recently used results and bodies of each endpoint are kept in memory. Responses
+carry an ETag made of the dataset version and the normalized query, so a client repeating a request with If-None-Match
+gets a 304 without anything being computed. Bodies are gzip-compressed by compression.py for clients that accept it.
+
+Endpoints:
+    /api/v1/version                                             dataset version, columns, countries, years, and the
+                                                                validation report of the data set (see validation.py)
+    /api/v1/country-range?column=co2&countries=A,B&start=1990&end=2020     bitmap_index.select_countries
+    /api/v1/year?year=2020[&countries=A,B][&columns=co2,gdp]               utils.find_all_data_for_year
+    /api/v1/summary?columns=co2,gdp                             summary_growth.create_combined_summary
+    /api/v1/growth?columns=co2,gdp                              summary_growth.extract_growth_rates_from_summary_df
+    /api/v1/multiplier?columns=gdp,co2&groups=4                 growth_analysis.grouped_growth_rate_multipliers
+    /api/v1/elasticity?columns=gdp,co2[&window=20]              growth_analysis.find_elasticities
+    /api/v1/rolling-elasticity?columns=gdp,co2[&window=20]      growth_analysis.find_rolling_elasticities
+    /api/v1/group-shares?group_by=gdp&column=co2&groups=10[&weight=population]      contribution.group_shares_by_year
+    /api/v1/group-statistics?group_by=gdp&column=co2&groups=10[&weight=population]  contribution.group_statistics_by_year
+"""
+import hashlib
+import io
+import json
+
+import flask
+import pandas as pd
+
+from download_data import co2_data_countries, dataset_version, validation_report
+from cache import memoize
+import bitmap_index as bi
+import compression as cp
+import page_data as pg
+
+api = flask.Blueprint('api', __name__, url_prefix='/api/v1')
+
+# number of results, and of encoded bodies, kept in memory per endpoint
+MAX_CACHED_QUERIES = 128
+
+
+class QueryError(ValueError):
+    """Raised for a query with missing or invalid parameters, returned to the client as a 400 response"""
+
+
+def frame_to_columnar(df):
+    """
+    Takes a dataframe and returns it as a columnar dict that can be serialized to json, with NaN as None
+
+    :param df: dataframe to convert
+    :return: dict with the index, the column names, and a list of values for each column
+    """
+    def to_list(values):
+        # a multi-level index, e.g. (year, group), becomes a list of [year, group] per row
+        if isinstance(values, pd.MultiIndex):
+            return [list(row) for row in zip(*(to_list(values.get_level_values(level))
+                                               for level in range(values.nlevels)))]
+        values = pd.Series(values)
+        return values.astype(object).where(values.notnull(), None).tolist()
+
+    return {
+        'index': to_list(df.index),
+        'columns': [str(col) for col in df.columns],
+        'data': {str(col): to_list(df[col]) for col in df.columns},
+    }
+
+
+def frame_to_arrow(df):
+    """
+    Takes a dataframe and returns it as an Arrow IPC stream, with the dataset version in the schema metadata
+
+    :param df: dataframe to convert
+    :return: bytes of the Arrow IPC stream
+    """
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df.rename(columns=str))
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'dataset_version': dataset_version})
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue()
+
+
+def list_argument(name, required=True):
+    """
+    Takes the name of a query parameter holding a comma separated list, returns the list
+
+    :param name: name of the query parameter
+    :param required: whether a missing parameter is an error
+    :return: tuple of the values, or None if the parameter is missing and not required
+    """
+    value = flask.request.args.get(name)
+    if not value:
+        if required:
+            raise QueryError(f"missing parameter '{name}'")
+        return None
+
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+def int_argument(name):
+    """
+    Takes the name of a required query parameter holding an integer, returns the integer
+    :param name: name of the query parameter
+    :return: value of the parameter as int
+    """
+    try:
+        return int(flask.request.args[name])
+    except KeyError:
+        raise QueryError(f"missing parameter '{name}'")
+    except ValueError:
+        raise QueryError(f"parameter '{name}' must be an integer")
+
+
+def check_columns(columns):
+    """
+    Takes a list of columns and raises a QueryError if any of them isn't a data column of the data set
+    :param columns: list of column names
+    :return: None
+    """
+    unknown_columns = [col for col in columns if col not in pg.dataset_options()]
+    if unknown_columns:
+        raise QueryError(f"unknown columns: {', '.join(unknown_columns)}")
+
+
+def check_countries(countries):
+    """
+    Takes a list of countries and raises a QueryError if any of them isn't a country in the data set
+    :param countries: list of country names
+    :return: None
+    """
+    unknown_countries = [country for country in countries if country not in pg.country_options()]
+    if unknown_countries:
+        raise QueryError(f"unknown countries: {', '.join(unknown_countries)}")
+
+
+@memoize(max_entries=MAX_CACHED_QUERIES)
+def query_country_range(column, countries, year_1, year_2):
+    # every country's values on every year of the range, null in the years a country has no data for
+    if year_1 > year_2:
+        year_1, year_2 = year_2, year_1
+    years = pd.RangeIndex(year_1, year_2 + 1, name='year')
+    selected_country_df = bi.select_countries(countries)
+    return selected_country_df.pivot(index='year', columns='country', values=column) \
+        .reindex(index=years, columns=list(countries)).rename_axis(columns=None)
+
+
+@memoize(max_entries=MAX_CACHED_QUERIES)
+def query_year(year, countries, columns):
+    rows = bi.years_bitmap(year)
+    if countries:
+        rows = rows & bi.countries_bitmap(countries)
+    df = bi.select(rows)
+    return df.set_index('country')[list(columns) if columns else pg.dataset_options()]
+
+
+@memoize(persist_results=True, inputs=lambda columns: (columns, None), max_entries=MAX_CACHED_QUERIES)
+def query_summary(columns):
+    import summary_growth as sg
+
+    return sg.create_combined_summary(co2_data_countries, list(columns))
+
+
+@memoize(persist_results=True, inputs=lambda columns: (columns, None), max_entries=MAX_CACHED_QUERIES)
+def query_growth(columns):
+    import summary_growth as sg
+
+    return sg.extract_growth_rates_from_summary_df(co2_data_countries, list(columns))
+
+
+@memoize(persist_results=True, inputs=lambda columns, number_of_groups: (columns, None),
+         max_entries=MAX_CACHED_QUERIES)
+def query_multiplier(columns, number_of_groups):
+    import growth_analysis as ga
+
+    return ga.grouped_growth_rate_multipliers(co2_data_countries, list(columns), number_of_groups)
+
+
+@memoize(persist_results=True, inputs=lambda columns, window: (columns, None), max_entries=MAX_CACHED_QUERIES)
+def query_elasticity(columns, window):
+    import growth_analysis as ga
+
+    return ga.find_elasticities(co2_data_countries, list(columns), window)
+
+
+@memoize(max_entries=MAX_CACHED_QUERIES)
+def query_rolling_elasticity(columns, window):
+    import growth_analysis as ga
+
+    return ga.find_rolling_elasticities(co2_data_countries, list(columns), window)
+
+
+def query_group_shares(column_to_group, value_column, number_of_groups, weight_column):
+    import contribution as ct
+
+    return ct.group_shares_by_year(column_to_group, value_column, number_of_groups, weight_column)
+
+
+def query_group_statistics(column_to_group, value_column, number_of_groups, weight_column):
+    import contribution as ct
+
+    return ct.group_statistics_by_year(column_to_group, value_column, number_of_groups, weight_column)
+
+
+@memoize(max_entries=MAX_CACHED_QUERIES)
+def encode_response(endpoint, arguments, response_format):
+    """
+    Takes an endpoint, its parsed arguments, and a format, returns the encoded response body
+
+    The most recently used bodies are memoized per dataset version, endpoint and arguments, so a repeated query is
+    served without computing or encoding anything.
+    :param endpoint: name of the query function in QUERIES
+    :param arguments: tuple of the query function's arguments
+    :param response_format: 'json' or 'arrow'
+    :return: bytes of the body
+    """
+    df = QUERIES[endpoint](*arguments)
+    if response_format == 'arrow':
+        return frame_to_arrow(df)
+
+    return json.dumps({'dataset_version': dataset_version, **frame_to_columnar(df)}).encode('utf-8')
+
+
+def parse_country_range():
+    column = flask.request.args.get('column')
+    if not column:
+        raise QueryError("missing parameter 'column'")
+    countries = list_argument('countries')
+    check_columns([column])
+    check_countries(countries)
+    return column, countries, int_argument('start'), int_argument('end')
+
+
+def parse_year():
+    countries = list_argument('countries', required=False)
+    columns = list_argument('columns', required=False)
+    if countries:
+        check_countries(countries)
+    if columns:
+        check_columns(columns)
+    return int_argument('year'), countries, columns
+
+
+def parse_columns():
+    columns = list_argument('columns')
+    check_columns(columns)
+    return (columns,)
+
+
+def parse_multiplier():
+    columns = list_argument('columns')
+    if len(columns) != 2:
+        raise QueryError("parameter 'columns' must contain two columns")
+    check_columns(columns)
+    number_of_groups = int_argument('groups')
+    if number_of_groups <= 0:
+        raise QueryError("parameter 'groups' must be greater than 0")
+    return columns, number_of_groups
+
+
+def parse_elasticity():
+    import growth_analysis as ga
+
+    columns = list_argument('columns')
+    if len(columns) != 2:
+        raise QueryError("parameter 'columns' must contain two columns")
+    check_columns(columns)
+    window = int_argument('window') if 'window' in flask.request.args else 20
+    if window < ga.MIN_REGRESSION_YEARS:
+        raise QueryError(f"parameter 'window' must be at least {ga.MIN_REGRESSION_YEARS}")
+    return columns, window
+
+
+def parse_group_contribution():
+    column_to_group = flask.request.args.get('group_by')
+    value_column = flask.request.args.get('column')
+    if not column_to_group or not value_column:
+        raise QueryError("parameters 'group_by' and 'column' are required")
+    weight_column = flask.request.args.get('weight') or None
+    check_columns([column_to_group, value_column] + ([weight_column] if weight_column else []))
+    number_of_groups = int_argument('groups')
+    if number_of_groups <= 0:
+        raise QueryError("parameter 'groups' must be greater than 0")
+    return column_to_group, value_column, number_of_groups, weight_column
+
+
+# {endpoint : query function}, and {endpoint : function parsing the request into the query function's arguments}
+QUERIES = {
+    'country-range': query_country_range,
+    'year': query_year,
+    'summary': query_summary,
+    'growth': query_growth,
+    'multiplier': query_multiplier,
+    'elasticity': query_elasticity,
+    'rolling-elasticity': query_rolling_elasticity,
+    'group-shares': query_group_shares,
+    'group-statistics': query_group_statistics,
+}
+PARSERS = {
+    'country-range': parse_country_range,
+    'year': parse_year,
+    'summary': parse_columns,
+    'growth': parse_columns,
+    'multiplier': parse_multiplier,
+    'elasticity': parse_elasticity,
+    'rolling-elasticity': parse_elasticity,
+    'group-shares': parse_group_contribution,
+    'group-statistics': parse_group_contribution,
+}
+
+MIMETYPES = {'json': 'application/json', 'arrow': 'application/vnd.apache.arrow.stream'}
+
+
+def error_response(message, status):
+    return flask.Response(json.dumps({'error': message}), status=status, mimetype='application/json')
+
+
+def make_response(body, response_format, etag):
+    """
+    Takes an encoded body, returns the response with caching headers
+    :param body: bytes of the body
+    :param response_format: 'json' or 'arrow'
+    :param etag: entity tag of the body
+    :return: flask.Response
+    """
+    response = flask.Response(body, mimetype=MIMETYPES[response_format])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=300'
+
+    return response
+
+
+@api.route('/version')
+def version():
+    body = json.dumps({'dataset_version': dataset_version, 'columns': pg.dataset_options(),
+                       'countries': pg.country_options(), 'years': list(pg.year_range()),
+                       'validation': validation_report}).encode('utf-8')
+    etag = f"{dataset_version}-version"
+    response = cp.not_modified(etag)
+    if response is not None:
+        return response
+
+    return make_response(body, 'json', etag)
+
+
+@api.route('/<endpoint>')
+def query(endpoint):
+    if endpoint not in QUERIES:
+        return error_response(f"unknown endpoint '{endpoint}'", 404)
+
+    response_format = flask.request.args.get('format', 'json')
+    if response_format not in MIMETYPES:
+        return error_response("parameter 'format' must be 'json' or 'arrow'", 400)
+
+    try:
+        arguments = PARSERS[endpoint]()
+    except QueryError as error:
+        return error_response(str(error), 400)
+
+    # the same dataset version and normalized arguments always produce the same body, so the etag is known up front
+    etag = hashlib.sha1(repr((dataset_version, endpoint, arguments, response_format)).encode('utf-8')).hexdigest()
+    response = cp.not_modified(etag)
+    if response is not None:
+        return response
+
+    try:
+        body = encode_response(endpoint, arguments, response_format)
+    except ImportError:
+        return error_response("format 'arrow' requires pyarrow to be installed", 406)
+    except (KeyError, ValueError) as error:
+        # e.g. a column with too little data for the requested number of groups
+        return error_response(f"query failed: {error}", 422)
+
+    return make_response(body, response_format, etag)
+
+
+def register(server):
+    """
+    Takes the Flask server of the Dash app and registers the API on it
+    :param server: app.server
+    :return: None
+    """
+    server.register_blueprint(api)
@@ -5,6 +5,13 @@ import dash_bootstrap_templates as dbt
 import plotly.express as px
 from download_data import co2_data_countries, codebook
 import utils as u
+import page_data as pg
+import api
+import compression
+import memory_debug
+import profiling
+import tracing
+import load_test
 
 
 # Palette:
@@ -17,6 +24,21 @@ app = Dash(__name__, use_pages=True, external_stylesheets=[dbc.themes.SOLAR])
 server = app.server
 dbt.load_figure_template('SOLAR')
 
+# JSON query API for programmatic access, served from the same caches as the pages
+api.register(server)
+# profile the next callback requests of a worker when armed with CO2_PROFILE_TOKEN, registered before compression so
+# its after_request hook runs last and the profiles include compressing the response
+profiling.register(server)
+# compress callback, layout, and API responses, and answer repeated GET requests with 304
+compression.register(server)
+# trace every request as a root span of the stage spans inside it, only when enabled with CO2_TRACE_FILE. Registered
+# after compression, so the request span ends before the response is compressed, like the serialize span
+tracing.register(server)
+# /debug/memory and per-callback allocation tracing, only when enabled with CO2_MEMORY_DEBUG and CO2_MEMORY_TRACE
+memory_debug.register(server)
+# append every callback request to the CO2_CAPTURE_CALLBACKS file, for replaying in load tests
+load_test.register(server)
+
 navbar_image = "https://images.plot.ly/logo/new-branding/plotly-logomark.png"
 
 navbar = dbc.Navbar(
@@ -63,5 +85,9 @@ app.layout = html.Div([
     ])
     ])
 
+# build every page's initial layout, figures and tables once, so that with gunicorn --preload the master does the work
+# before forking and neither worker boot nor the first page load needs to scan the data set
+pg.warm_page_cache(dash.page_registry)
+
 if __name__ == '__main__':
     app.run_server()
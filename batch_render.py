@@ -0,0 +1,182 @@
+"""
+Headless batch renderer for the charts in plots.py.
+
+Renders one chart for every combination in a grid of columns x years x group counts, in parallel across processes,
+with the non-interactive Agg backend and an explicit figure per chart. Every chart is saved as PNG and/or SVG, and a
+manifest.json in the output directory lists the parameters, files, and render time of each chart (or the error, if a
+chart couldn't be drawn), so report images can be pre-generated for every year and column. The dataset version is
+recorded in the manifest and in the metadata of every file.
+
+Usage:
+    python batch_render.py group_boxplot --columns gdp population --values co2 --years 1990:2020:10 --groups 4 5
+    python batch_render.py grouped_multiplier_boxplot --columns gdp --values co2 --groups 3 4 5 --formats svg
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+
+# the backend must be chosen before pyplot is imported by plots
+matplotlib.use('Agg')
+
+from matplotlib.figure import Figure
+
+import plots
+from download_data import co2_data_countries, dataset_version
+
+# {chart name : (whether the chart is drawn for a single year, function building the chart's arguments)}
+# each argument builder takes the grid values (column, value column, year, number of groups, statistic)
+CHARTS = {
+    'group_boxplot': (True, lambda column, value, year, n, stat: {
+        'year': year, 'column_to_group': column, 'number_of_groups': n, 'column_to_plot': value}),
+    'plot_pct_of_total': (True, lambda column, value, year, n, stat: {
+        'year': year, 'column_to_group': column, 'number_of_groups': n, 'pct_of_total_column': value}),
+    'plot_grouped_descriptive_stats': (True, lambda column, value, year, n, stat: {
+        'year': year, 'column_to_group': column, 'number_of_groups': n, 'column_to_summarize': value,
+        'stat_to_plot': stat}),
+    'grouped_mean_multiplier_bar_chart': (False, lambda column, value, year, n, stat: {
+        'mult_columns': [column, value], 'number_of_groups': n}),
+    'grouped_multiplier_boxplot': (False, lambda column, value, year, n, stat: {
+        'mult_columns': [column, value], 'number_of_groups': n}),
+}
+
+
+def parse_years(year_tokens):
+    """
+    Takes a list of year tokens, either single years ('2000') or ranges ('1990:2020' or '1990:2020:10'), returns years
+
+    Ranges include their end year.
+    :param year_tokens: list of strings
+    :return: sorted list of unique years as ints
+    """
+    years = set()
+    for token in year_tokens:
+        parts = [int(part) for part in token.split(':')]
+        if len(parts) == 1:
+            years.add(parts[0])
+        else:
+            step = parts[2] if len(parts) == 3 else 1
+            years.update(range(parts[0], parts[1] + 1, step))
+
+    return sorted(years)
+
+
+def build_jobs(chart, columns, value_columns, years, group_counts, stat='mean'):
+    """
+    Takes a chart name and the values of the grid, returns one job for each combination of the grid
+
+    Charts that aren't drawn for a single year (the multiplier charts) ignore the years.
+    :param chart: name of a function in plots.py listed in CHARTS
+    :param columns: columns to group by (or the first multiplier column)
+    :param value_columns: columns to plot (or the second multiplier column)
+    :param years: years to draw the chart for
+    :param group_counts: numbers of groups to draw the chart for
+    :param stat: statistic drawn by plot_grouped_descriptive_stats
+    :return: list of dicts with the chart name, the file stem and the chart's arguments
+    """
+    uses_year, build_arguments = CHARTS[chart]
+    jobs = []
+    for column, value, year, n in itertools.product(columns, value_columns, years if uses_year else [None],
+                                                    group_counts):
+        name_parts = [chart, column, value] + ([str(year)] if uses_year else []) + [f"{n}groups"]
+        jobs.append({
+            'chart': chart,
+            'file_stem': re.sub(r'[^\w.-]+', '_', '__'.join(name_parts)),
+            'arguments': build_arguments(column, value, year, n, stat),
+        })
+
+    return jobs
+
+
+def render_job(job, output_dir, formats):
+    """
+    Takes a job, draws its chart on a new figure, and saves it in each format
+
+    Runs in the worker processes. Errors are returned in the manifest entry rather than raised, so a chart that can't
+    be drawn (e.g. a column without data in a year) doesn't stop the rest of the batch.
+    :param job: dict created by build_jobs
+    :param output_dir: directory to save the files in
+    :param formats: list of file formats, e.g. ['png', 'svg']
+    :return: manifest entry for the job
+    """
+    start = time.perf_counter()
+    entry = {'chart': job['chart'], 'arguments': job['arguments'], 'files': []}
+    try:
+        fig = Figure(figsize=(10, 6))
+        getattr(plots, job['chart'])(co2_data_countries, fig=fig, **job['arguments'])
+        for file_format in formats:
+            file_name = f"{job['file_stem']}.{file_format}"
+            fig.savefig(os.path.join(output_dir, file_name), format=file_format,
+                        metadata={'Description': f"dataset_version {dataset_version}"})
+            entry['files'].append(file_name)
+    except Exception as error:
+        entry['error'] = f"{type(error).__name__}: {error}"
+    entry['seconds'] = round(time.perf_counter() - start, 3)
+
+    return entry
+
+
+def render_batch(jobs, output_dir, formats=('png',), workers=None):
+    """
+    Takes a list of jobs and renders them in parallel across processes, then writes the manifest
+
+    Workers are forked where the platform allows it, so they share the data set already loaded by this process
+    instead of downloading it again.
+    :param jobs: list of jobs created by build_jobs
+    :param output_dir: directory to save the files and manifest in, created if it doesn't exist
+    :param formats: file formats to save each chart in
+    :param workers: number of processes, defaults to the number of CPUs
+    :return: the manifest as a dict
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        entries = list(executor.map(render_job, jobs, itertools.repeat(output_dir), itertools.repeat(list(formats))))
+
+    manifest = {
+        'dataset_version': dataset_version,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'seconds': round(time.perf_counter() - start, 3),
+        'charts': entries,
+    }
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, default=str)
+
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('chart', choices=sorted(CHARTS))
+    parser.add_argument('--columns', nargs='+', required=True, help='columns to group by')
+    parser.add_argument('--values', nargs='+', required=True, help='columns to plot')
+    parser.add_argument('--years', nargs='+', default=[], help="years, e.g. 2000 or 1990:2020:10")
+    parser.add_argument('--groups', nargs='+', type=int, default=[4], help='numbers of groups')
+    parser.add_argument('--stat', default='mean', help='statistic for plot_grouped_descriptive_stats')
+    parser.add_argument('--formats', nargs='+', default=['png'], choices=['png', 'svg'])
+    parser.add_argument('--out', default='renders', help='output directory')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes')
+    args = parser.parse_args()
+
+    if CHARTS[args.chart][0] and not args.years:
+        parser.error(f"{args.chart} needs --years")
+
+    jobs = build_jobs(args.chart, args.columns, args.values, parse_years(args.years), args.groups, args.stat)
+    manifest = render_batch(jobs, args.out, args.formats, args.workers)
+
+    failed = [entry for entry in manifest['charts'] if 'error' in entry]
+    print(f"rendered {len(jobs) - len(failed)} of {len(jobs)} charts in {manifest['seconds']}s to {args.out}")
+    for entry in failed:
+        print(f"  failed {entry['chart']} {entry['arguments']}: {entry['error']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+Bitmap indexes over the rows of co2_data_countries.
+
+Callbacks select rows by country and year, and summary_growth by whether a column has a non-zero value, by comparing a
+column of the data set with every call, e.g. co2_data_countries['country'].isin(countries) scans every row's country
+name. Here every such set of rows is computed once per dataset version, as a bitmap with a bit per row packed into
+bytes (np.packbits):
+    - a bitmap per country and per year
+    - a bitmap per column of the rows where it isn't null, and where it isn't null or zero
+
+A filter is then a bitwise OR of the bitmaps of the selected countries or years, ANDed with the other filters, which
+works on 1 bit per row rather than a string or number per row:
+    rows = countries_bitmap(['France', 'Peru']) & years_bitmap(1990, 2020) & available_bitmap('co2')
+    select(rows)                                    the rows as a data frame
+
+Bitmaps of countries, years, and columns are rows of 2-d arrays, so combining a range of them is a single reduction.
+"""
+import numpy as np
+
+from download_data import co2_data_countries
+from cache import memoize
+import tracing as tr
+
+
+def pack(mask):
+    """
+    Takes a boolean mask with an element per row, returns it as a bitmap
+    :param mask: boolean array, or 2-d array with a mask per row of the array
+    :return: uint8 array with a bit per element along the last axis
+    """
+    return np.packbits(mask, axis=-1)
+
+
+def unpack(bitmap):
+    """
+    Takes a bitmap of co2_data_countries, returns it as a boolean mask with an element per row
+    :param bitmap: uint8 array returned by pack
+    :return: boolean array
+    """
+    return np.unpackbits(bitmap, count=len(co2_data_countries)).view(bool)
+
+
+def frozen(array):
+    array.setflags(write=False)
+
+    return array
+
+
+@memoize
+def build_index():
+    """
+    Builds the bitmaps of every country, year, and column of co2_data_countries
+
+    :return: dict of {'countries': {country : position}, 'country_bitmaps': array of shape (countries, bytes),
+    'years': sorted array of years, 'year_bitmaps': array of shape (years, bytes), 'columns': {column : position},
+    'non_null_bitmaps' and 'non_zero_bitmaps': arrays of shape (columns, bytes)}
+    """
+    n_rows = len(co2_data_countries)
+
+    # a row of a one-hot matrix per country and per year, which are packed into a bitmap each
+    country_codes, countries = co2_data_countries['country'].factorize()
+    year_codes, years = co2_data_countries['year'].factorize(sort=True)
+    country_masks = np.zeros((len(countries), n_rows), dtype=bool)
+    country_masks[country_codes, np.arange(n_rows)] = True
+    year_masks = np.zeros((len(years), n_rows), dtype=bool)
+    year_masks[year_codes, np.arange(n_rows)] = True
+
+    # the masks of the numeric columns, as one block with a row per column
+    columns = [col for col in co2_data_countries.columns if co2_data_countries[col].dtype.kind in 'fiu']
+    values = co2_data_countries[columns].to_numpy(dtype=np.float64).T
+    non_null_masks = ~np.isnan(values)
+
+    return {
+        'countries': {country: position for position, country in enumerate(countries)},
+        'country_bitmaps': frozen(pack(country_masks)),
+        'years': frozen(np.asarray(years)),
+        'year_bitmaps': frozen(pack(year_masks)),
+        'columns': {col: position for position, col in enumerate(columns)},
+        'non_null_bitmaps': frozen(pack(non_null_masks)),
+        'non_zero_bitmaps': frozen(pack(non_null_masks & (values != 0))),
+    }
+
+
+def empty_bitmap():
+    return np.zeros((len(co2_data_countries) + 7) // 8, dtype=np.uint8)
+
+
+def countries_bitmap(countries):
+    """
+    Takes a country or a list of countries, returns the bitmap of their rows
+    :param countries: country name, or list of country names. Countries that aren't in the data set have no rows
+    :return: bitmap
+    """
+    index = build_index()
+    if isinstance(countries, str):
+        countries = [countries]
+    positions = [index['countries'][country] for country in countries if country in index['countries']]
+    if not positions:
+        return empty_bitmap()
+
+    return np.bitwise_or.reduce(index['country_bitmaps'][positions], axis=0)
+
+
+def years_bitmap(year_1, year_2=None):
+    """
+    Takes a year or a year range, returns the bitmap of the rows in that range
+    :param year_1: first year of the range
+    :param year_2: last year of the range, included, or None for only year_1. The years may be in either order
+    :return: bitmap
+    """
+    index = build_index()
+    year_2 = year_1 if year_2 is None else year_2
+    year_1, year_2 = min(year_1, year_2), max(year_1, year_2)
+
+    # the years are sorted, so the range is a contiguous block of bitmaps
+    first = np.searchsorted(index['years'], year_1, side='left')
+    last = np.searchsorted(index['years'], year_2, side='right')
+    if first >= last:
+        return empty_bitmap()
+
+    return np.bitwise_or.reduce(index['year_bitmaps'][first:last], axis=0)
+
+
+def available_bitmap(column_name, non_zero=True):
+    """
+    Takes a numeric column, returns the bitmap of the rows where it has data
+    :param column_name: name of a numeric column
+    :param non_zero: whether zeros count as missing, like in summary_growth.find_earliest_data
+    :return: bitmap
+    """
+    index = build_index()
+
+    return index['non_zero_bitmaps' if non_zero else 'non_null_bitmaps'][index['columns'][column_name]]
+
+
+@tr.traced('filter')
+def select(bitmap):
+    """
+    Takes a bitmap and returns the rows of co2_data_countries it selects
+    :param bitmap: bitmap of co2_data_countries
+    :return: df of the selected rows, in data set order
+    """
+    return co2_data_countries.take(np.flatnonzero(unpack(bitmap)))
+
+
+@tr.traced('filter')
+def select_countries(countries):
+    """
+    Takes a country or a list of countries, returns their rows of co2_data_countries, i.e.
+    co2_data_countries[co2_data_countries['country'].isin(countries)]
+    :param countries: country name, or list of country names
+    :return: df of the countries' rows, in data set order
+    """
+    return select(countries_bitmap(countries))
+
+
+def available_rows(data, column_name):
+    """
+    Takes a data set and a column, returns the mask of the rows where the column isn't null or zero
+
+    The mask comes from the bitmap index if data is co2_data_countries, and is computed otherwise.
+    :param data: co2_data_countries, or any other df with the column
+    :param column_name: name of a numeric column
+    :return: boolean array with an element per row of data
+    """
+    if data is co2_data_countries:
+        return unpack(available_bitmap(column_name))
+
+    return ~(data[column_name].isnull() | (data[column_name] == 0)).to_numpy()
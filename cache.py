@@ -0,0 +1,294 @@
+"""
+Memoization of results derived from the co2 data set.
+
+Results are stored per dataset version and arguments, so a new download never serves results that were derived from an
+old one. Every memoized function registers its store by name in caches, so all caches can be listed and cleared together.
+
+The dataset version is a hash of the data set's content, so a result stays valid for as long as the content doesn't
+change, across restarts and processes. Functions memoized with persist=True also keep their results on disk, under the
+directory set by the CO2_CACHE_DIR environment variable (disabled when it isn't set), in a subdirectory per dataset
+version, so a restarted app or a new worker loads expensive results instead of computing them again. Every function
+persists its results in a directory named with its code version, a hash of its source, CACHE_FORMAT and the versions of
+pandas, numpy, and plotly, so results persisted by other code are never loaded, e.g. after a deploy.
+
+Persisted functions can declare the columns and countries each result is derived from with inputs=. When a new download
+is laid out, it's compared to the previous one (see dataset_diff.py), and the persisted results of the previous version
+whose inputs didn't change are carried over to the new version, relabelled with it, so only results whose inputs changed
+are computed again. Only results of the same code version are carried over.
+
+A stored result is returned to every caller, in every thread, so data frame results are stored read-only (see
+shared_data.freeze), and callers derive new frames from them instead of changing them.
+
+Results are kept until the dataset version changes, which suits functions called with a few arguments. Functions called
+with arguments from requests (e.g. any selection of countries) are memoized with max_entries=, which keeps only their
+most recently used results, so clients can't grow the cache without limit.
+"""
+import collections
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+import plotly
+
+from download_data import dataset_changes, dataset_version
+import dataset_diff as dsd
+import shared_data as sd
+
+# registry of {cache name : {(dataset version, args, kwargs) : result}} for every memoized function
+caches = {}
+_lock = threading.Lock()
+
+# part of the code version of every persisted result, increased whenever persisted results change in a way the source of
+# the memoized functions doesn't show, e.g. a change to a helper they call
+CACHE_FORMAT = 1
+
+# {'migrated', 'invalidated'} numbers of persisted results carried over from the previous download, see
+# migrate_persisted_results
+migrated_results = {'migrated': 0, 'invalidated': 0}
+
+
+def code_version(func):
+    """
+    Takes a memoized function, returns a hash of its source, CACHE_FORMAT, and the versions of the libraries its results
+    are built with, which changes whenever the function could return a different result for the same data
+    :param func: function deriving a result from the data set
+    :return: str of 12 hex digits
+    """
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        # e.g. a function defined in the interpreter, whose results are only persisted for its name
+        source = func.__qualname__
+    versions = f"{CACHE_FORMAT} {pd.__version__} {np.__version__} {plotly.__version__}"
+
+    return hashlib.sha1(f"{versions}\n{source}".encode('utf-8')).hexdigest()[:12]
+
+
+def persistent_path(cache_name, key):
+    """
+    Takes the name of a cache and a key, returns the file the result for that key is persisted in
+    :param cache_name: name of the cache with its code version, see memoize
+    :param key: key of the result, starting with its dataset version
+    :return: path of the file, or None if persistence is disabled
+    """
+    cache_directory = os.environ.get('CO2_CACHE_DIR')
+    if not cache_directory:
+        return None
+
+    key_hash = hashlib.sha1(repr(key[1:]).encode('utf-8')).hexdigest()
+
+    return os.path.join(cache_directory, key[0], cache_name, f"{key_hash}.pickle")
+
+
+def inputs_path(path):
+    """
+    Takes the path of a persisted result and returns the file its inputs are recorded in
+    :param path: path returned by persistent_path
+    :return: path of the inputs file
+    """
+    return path[:-len('.pickle')] + '.inputs.json'
+
+
+def load_persisted(path):
+    """
+    Takes the path of a persisted result and loads it
+    :param path: path returned by persistent_path
+    :return: the result, or None if it isn't persisted or can't be read
+    """
+    if path is None:
+        return None
+
+    try:
+        with open(path, 'rb') as persisted_file:
+            return pickle.load(persisted_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        # written by an incompatible version of the code, it's simply computed again and overwritten
+        return None
+
+
+def persist(path, result):
+    """
+    Takes the path returned by persistent_path and a result, and writes the result to it
+
+    The result is written to a temporary file that is renamed when complete, so other processes never load a
+    half-written result. A result that can't be written is only kept in memory.
+    :param path: path returned by persistent_path
+    :param result: result to persist
+    :return: None
+    """
+    if path is None:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(file_descriptor, 'wb') as persisted_file:
+            pickle.dump(result, persisted_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+    except (OSError, pickle.PicklingError, TypeError, AttributeError):
+        pass
+
+
+def memoize(func=None, persist_results=False, inputs=None, max_entries=None):
+    """
+    Decorates a function deriving a result from the data set so its results are stored per dataset version and arguments
+
+    Arguments must be hashable, so lists of countries or columns should be passed as tuples. Use as @memoize, or as
+    @memoize(persist_results=True) to also keep the results on disk when CO2_CACHE_DIR is set.
+    :param func: function deriving a result from the data set
+    :param persist_results: whether results are also persisted to disk
+    :param inputs: optional function taking the same arguments as func, returning a tuple of (columns, countries) the
+    result is derived from, with None for all countries, so persisted results can be carried over to a new dataset
+    version in which none of them changed (see migrate_persisted_results)
+    :param max_entries: optional number of results to keep in memory, the least recently used result is dropped when
+    another one is stored, for functions called with arguments from requests
+    :return: the memoized function, with its store available as .cache
+    """
+    if func is None:
+        return functools.partial(memoize, persist_results=persist_results, inputs=inputs, max_entries=max_entries)
+
+    cache_name = f"{func.__module__}.{func.__qualname__}"
+    store = caches.setdefault(cache_name, {} if max_entries is None else collections.OrderedDict())
+
+    # persisted results are kept per code version, and those of the previous download are carried over if their inputs
+    # didn't change
+    persisted_name = f"{cache_name}-{code_version(func)}" if persist_results else None
+    if persist_results and inputs is not None:
+        for count, number in migrate_persisted_results(dataset_changes, dataset_version, persisted_name).items():
+            migrated_results[count] += number
+
+    @functools.wraps(func)
+    def memoized(*args, **kwargs):
+        key = (dataset_version, args, tuple(sorted(kwargs.items())))
+        try:
+            if max_entries is None:
+                return store[key]
+            # a bounded store is ordered from least to most recently used
+            with _lock:
+                store.move_to_end(key)
+                return store[key]
+        except KeyError:
+            pass
+
+        # load a result persisted by an earlier run or another process, or compute it outside the lock, two threads
+        # computing the same result at once simply store the same value twice
+        path = persistent_path(persisted_name, key) if persist_results else None
+        result = load_persisted(path)
+        if result is None:
+            result = func(*args, **kwargs)
+            persist(path, result)
+            if inputs is not None and path is not None:
+                columns, countries = inputs(*args, **kwargs)
+                persist_inputs(path, columns, countries)
+        if isinstance(result, pd.DataFrame):
+            result = sd.freeze(result)
+        with _lock:
+            store[key] = result
+            while max_entries is not None and len(store) > max_entries:
+                store.popitem(last=False)
+
+        return result
+
+    memoized.cache = store
+
+    return memoized
+
+
+def persist_inputs(path, columns, countries):
+    """
+    Takes the path of a persisted result and the inputs it was derived from, and records them next to it
+    :param path: path returned by persistent_path
+    :param columns: columns the result is derived from
+    :param countries: countries the result is derived from, or None for all countries
+    :return: None
+    """
+    try:
+        with open(inputs_path(path), 'w') as inputs_file:
+            json.dump({'columns': list(columns), 'countries': None if countries is None else list(countries)},
+                      inputs_file)
+    except OSError:
+        pass
+
+
+def relabel(result, version):
+    """
+    Takes a persisted result and relabels the data frames and figures in it with a dataset version
+    :param result: result of a memoized function, e.g. a df or a tuple of a figure and some text
+    :param version: dataset version
+    :return: the result, relabelled
+    """
+    if isinstance(result, pd.DataFrame):
+        result.attrs['dataset_version'] = version
+    elif isinstance(result, (tuple, list)):
+        for item in result:
+            relabel(item, version)
+    elif isinstance(getattr(getattr(result, 'layout', None), 'meta', None), dict) and \
+            'dataset_version' in result.layout.meta:
+        result.update_layout(meta={**result.layout.meta, 'dataset_version': version})
+
+    return result
+
+
+def migrate_persisted_results(changes, version, cache_name):
+    """
+    Takes the changes of the current download, its dataset version, and a cache, and carries the persisted results of
+    the cache from the previous version whose inputs didn't change over to the current version
+
+    Only results that recorded their inputs (see memoize) are carried over, the others are computed again when needed.
+    Only results of the cache's current code version are carried over, since its name holds the code version. Results
+    that are already persisted for the current version are left alone, so this can run in several processes.
+    :param changes: dict of changes, see dataset_diff.diff_data_sets
+    :param version: current dataset version
+    :param cache_name: name of the cache with its code version, see memoize
+    :return: dict of {'migrated', 'invalidated'} numbers of results
+    """
+    counts = {'migrated': 0, 'invalidated': 0}
+    cache_directory = os.environ.get('CO2_CACHE_DIR')
+    if not cache_directory or changes is None or changes['previous_dataset_version'] == version:
+        return counts
+
+    previous_directory = os.path.join(cache_directory, changes['previous_dataset_version'])
+    for previous_inputs_path in glob.glob(os.path.join(glob.escape(previous_directory), glob.escape(cache_name),
+                                                       '*.inputs.json')):
+        previous_path = previous_inputs_path[:-len('.inputs.json')] + '.pickle'
+        path = os.path.join(cache_directory, version, os.path.relpath(previous_path, previous_directory))
+        if os.path.exists(path):
+            continue
+
+        try:
+            with open(previous_inputs_path) as inputs_file:
+                recorded_inputs = json.load(inputs_file)
+        except (OSError, ValueError):
+            continue
+        if dsd.is_affected(changes, recorded_inputs['columns'], recorded_inputs['countries']):
+            counts['invalidated'] += 1
+            continue
+
+        result = load_persisted(previous_path)
+        if result is None:
+            continue
+        persist(path, relabel(result, version))
+        persist_inputs(path, recorded_inputs['columns'], recorded_inputs['countries'])
+        counts['migrated'] += 1
+
+    return counts
+
+
+def clear_caches():
+    """
+    Empties every registered cache
+    :return: None
+    """
+    with _lock:
+        for store in caches.values():
+            store.clear()
@@ -0,0 +1,129 @@
+"""
+Response compression and conditional responses for app.server.
+
+Callback responses (/_dash-update-component), layouts, page html, and the API are JSON or html documents that
+compress very well, mostly Plotly figures and table records. Every such response gets a content hash as its ETag, so
+GET responses (layout, dependencies, pages, API) are answered with 304 when the client already has them; POST callback
+responses can't be cached by the client, but carry the hash as well. Bodies are gzip-compressed for clients that
+accept it, and the compressed bodies of recent responses are kept by hash, so an identical response (e.g. the same
+figure requested by many users) is only compressed once. A compressed body is another representation than the
+uncompressed one, so it gets the ETag of the uncompressed body with GZIP_ETAG_SUFFIX, and every response varies by
+Accept-Encoding, 304s included, so a shared cache never answers a client with the encoding another client asked for.
+"""
+import collections
+import gzip
+import hashlib
+import threading
+
+import flask
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'application/vnd.apache.arrow.stream'}
+
+# responses smaller than this aren't worth compressing
+MIN_SIZE = 1024
+
+# level 6 gets nearly all of the size reduction on plotly json, larger bodies use a faster level to bound cpu time
+COMPRESS_LEVEL = 6
+LARGE_BODY_SIZE = 1024 * 1024
+LARGE_BODY_COMPRESS_LEVEL = 4
+
+# number of compressed bodies kept by content hash
+MAX_CACHED_BODIES = 128
+
+# added to the ETag of a body when it's gzip-compressed
+GZIP_ETAG_SUFFIX = '-gzip'
+
+_compressed_bodies = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def content_hash(body):
+    """
+    Takes a response body and returns its content hash
+    :param body: bytes of the body
+    :return: hash as a hex string
+    """
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def compress_body(body, body_hash):
+    """
+    Takes a response body and its hash, returns the gzip-compressed body, reusing it if it was compressed recently
+    :param body: bytes of the body
+    :param body_hash: content hash of the body
+    :return: bytes of the compressed body
+    """
+    with _lock:
+        if body_hash in _compressed_bodies:
+            _compressed_bodies.move_to_end(body_hash)
+            return _compressed_bodies[body_hash]
+
+    level = LARGE_BODY_COMPRESS_LEVEL if len(body) >= LARGE_BODY_SIZE else COMPRESS_LEVEL
+    compressed = gzip.compress(body, compresslevel=level, mtime=0)
+
+    with _lock:
+        _compressed_bodies[body_hash] = compressed
+        while len(_compressed_bodies) > MAX_CACHED_BODIES:
+            _compressed_bodies.popitem(last=False)
+
+    return compressed
+
+
+def not_modified(etag):
+    """
+    Takes the ETag of an uncompressed body, returns a 304 response if the client already has the body, uncompressed or
+    compressed if it accepts gzip, so a route can answer before building the body
+    :param etag: entity tag of the uncompressed body
+    :return: flask.Response with status 304, or None if the client doesn't have the body
+    """
+    tags = (etag, f"{etag}{GZIP_ETAG_SUFFIX}") if 'gzip' in flask.request.accept_encodings else (etag,)
+    for tag in tags:
+        if flask.request.if_none_match.contains(tag):
+            response = flask.Response(status=304)
+            response.set_etag(tag)
+            response.vary.add('Accept-Encoding')
+            return response
+
+    return None
+
+
+def compress_response(response):
+    """
+    Takes a response and adds a content hash ETag, answers it with 304 if the client already has it, and compresses it
+
+    Registered as an after_request hook, so it applies to Dash's routes and the API alike. Streamed responses (static
+    files), responses that are already encoded, and errors are passed through unchanged.
+    :param response: flask.Response
+    :return: flask.Response
+    """
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed or \
+            'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    body = response.get_data()
+    body_hash = content_hash(body)
+    etag = response.get_etag()[0] or body_hash
+
+    # the compressed body gets its own ETag, and the response varies by Accept-Encoding before it may become a 304
+    compress = len(body) >= MIN_SIZE and 'gzip' in flask.request.accept_encodings
+    response.set_etag(f"{etag}{GZIP_ETAG_SUFFIX}" if compress else etag)
+    response.vary.add('Accept-Encoding')
+
+    # werkzeug only answers GET and HEAD requests with 304, which are the ones a client can safely reuse
+    response.make_conditional(flask.request)
+    if response.status_code == 304 or not compress:
+        return response
+
+    response.set_data(compress_body(body, body_hash))
+    response.headers['Content-Encoding'] = 'gzip'
+
+    return response
+
+
+def register(server):
+    """
+    Takes the Flask server of the Dash app and registers compression and conditional responses on it
+    :param server: app.server
+    :return: None
+    """
+    server.after_request(compress_response)
@@ -0,0 +1,215 @@
+"""
+Contributions of groups of countries to the data set, for every year at once.
+
+utils.group_pct_of_total and utils.find_summary_statistics_per_group group the countries of one year and loop over the
+groups. Here the countries are ranked within every year in one pass over the country x year cube (see shared_data.py):
+the cube's matrix of the grouping column is sorted along the country axis, the group edges of every year are
+interpolated from the sorted values the way pd.qcut does, and each country's group is found by comparing it to its
+year's edges. The year x group shares and statistics of another column then follow from sums over (year, group)
+blocks, without a mask per group or year.
+
+So e.g. the share of global co2 emitted by each tenth of countries by gdp, for every year, is one call:
+    group_shares_by_year('gdp', 'co2', 10)
+
+Groups match pd.qcut: a year in which the grouping column has too few distinct values to form unique group edges
+(where pd.qcut raises) has no groups. With a weight column, groups are weighted quantiles, see
+utils.find_weighted_quantile_groups. The MAX_CACHED_RESULTS most recently used results of each function are memoized
+per dataset version, since the API (see api.py) calls them with any number of groups.
+"""
+import numpy as np
+import pandas as pd
+
+from download_data import co2_data_countries, download_key
+from cache import memoize
+import shared_data as sd
+import utils as u
+
+# statistics of every (year, group), in the order of pd.Series.describe
+STATISTICS = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+
+# number of results kept in memory per function
+MAX_CACHED_RESULTS = 128
+
+
+def country_year_matrix(column_name):
+    """
+    Takes a column and returns its country x year matrix from the cube
+
+    :param column_name: name of a float column of the data set
+    :return: tuple of (read-only array of shape (countries, years) with NaN for missing data, array of years)
+    """
+    cube, countries, years, columns = sd.country_year_cube(download_key)
+    if column_name not in columns:
+        raise ValueError(f"{column_name} is not a numeric column of the data set")
+
+    return cube[columns.index(column_name)], years
+
+
+def sorted_positions_to_values(sorted_values, positions):
+    """
+    Takes values sorted along the first axis and fractional positions, returns the values at the positions,
+    interpolated linearly between neighbouring values like np.quantile
+
+    :param sorted_values: array of shape (rows, columns), sorted along the rows
+    :param positions: array of shape (k, columns) of fractional row positions within each column's values
+    :return: array of shape (k, columns)
+    """
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, len(sorted_values) - 1)
+    fraction = positions - lower
+    lower_values = np.take_along_axis(sorted_values, lower, axis=0)
+    upper_values = np.take_along_axis(sorted_values, upper, axis=0)
+
+    # the second neighbour isn't needed (and may be NaN) where a position falls on a value
+    return np.where(fraction > 0, lower_values + (upper_values - lower_values) * fraction, lower_values)
+
+
+def quantile_group_matrix(values, number_of_groups):
+    """
+    Takes a country x year matrix, returns the quantile group of every country within its year, like pd.qcut per year
+
+    :param values: array of shape (countries, years), with NaN for missing values
+    :param number_of_groups: number of groups
+    :return: float array of shape (countries, years) with groups 1 to number_of_groups, NaN where the value is missing
+    or the year's values can't be divided into unique groups
+    """
+    # rank the countries within every year by sorting each year's values, missing values sort last
+    sorted_values = np.sort(values, axis=0)
+    counts = np.count_nonzero(~np.isnan(values), axis=0)
+
+    # group edges at the quantiles 0, 1/n, ..., 1 of every year's values, interpolated from the sorted values
+    positions = np.maximum(counts - 1, 0)[None, :] * np.arange(number_of_groups + 1)[:, None] / number_of_groups
+    edges = sorted_positions_to_values(sorted_values, positions)
+
+    # a value is in group k if it's above the first k - 1 inner edges, and at most the k-th (bins include their right
+    # edge, like pd.qcut)
+    groups = 1.0 + np.sum(values[None, :, :] > edges[1:-1, None, :], axis=0)
+
+    # pd.qcut can't form groups when edges coincide, and there are no groups without values
+    valid_years = (counts > 0) & np.all(np.diff(edges, axis=0) > 0, axis=0)
+    groups[np.isnan(values) | ~valid_years[None, :]] = np.nan
+
+    return groups
+
+
+@memoize(max_entries=MAX_CACHED_RESULTS)
+def groups_by_year(column_to_group, number_of_groups, weight_column=None):
+    """
+    Takes a grouping column and number of groups, returns the group of every country in every year
+
+    :param column_to_group: column to group the countries by
+    :param number_of_groups: number of groups
+    :param weight_column: optional column (e.g. 'population') to weight groups by, so each group holds an equal share
+    of the weight in its year instead of an equal number of countries
+    :return: tuple of (read-only float array of shape (countries, years) with groups 1 to number_of_groups, NaN for
+    countries without a group, array of years)
+    """
+    values, years = country_year_matrix(column_to_group)
+    if not weight_column:
+        groups = quantile_group_matrix(values, number_of_groups)
+    else:
+        # the weighted groups of every year at once, with the year of each cell as its key
+        weights, _ = country_year_matrix(weight_column)
+        year_keys = np.broadcast_to(years[None, :], values.shape)
+        groups = u.find_weighted_quantile_groups(values.ravel(), weights.ravel(), number_of_groups,
+                                                 year_keys.ravel()).reshape(values.shape)
+    groups.setflags(write=False)
+
+    return groups, years
+
+
+def group_blocks(column_to_group, value_column, number_of_groups, weight_column=None):
+    """
+    Takes a grouping and a column, returns the column's values of every country with a group, sorted into contiguous
+    (year, group) blocks
+
+    :param column_to_group: column to group the countries by
+    :param value_column: column to aggregate
+    :param number_of_groups: number of groups
+    :param weight_column: optional column to weight groups by
+    :return: tuple of (block number of each value, i.e. year position * number_of_groups + group - 1, sorted values,
+    array of years)
+    """
+    groups, years = groups_by_year(column_to_group, number_of_groups, weight_column)
+    values, _ = country_year_matrix(value_column)
+
+    # keep the cells with a group and a value, and number their (year, group) block
+    valid = ~(np.isnan(groups) | np.isnan(values))
+    year_position = np.broadcast_to(np.arange(len(years))[None, :], values.shape)[valid]
+    blocks = year_position * number_of_groups + groups[valid].astype(int) - 1
+    block_values = values[valid]
+
+    # sort by block, then value, so every block is contiguous and sorted
+    order = np.lexsort((block_values, blocks))
+
+    return blocks[order], block_values[order], years
+
+
+@memoize(max_entries=MAX_CACHED_RESULTS)
+def group_shares_by_year(column_to_group, value_column, number_of_groups, weight_column=None):
+    """
+    Takes a grouping column, a column, and number of groups, returns each group's share of the column's total in every
+    year, i.e. utils.group_pct_of_total for all years
+
+    :param column_to_group: column to group the countries by
+    :param value_column: column whose total the groups contribute to, e.g. 'co2'
+    :param number_of_groups: number of groups
+    :param weight_column: optional column (e.g. 'population') to weight groups by
+    :return: df indexed by year, with a column per group holding its share (0 to 1) of the total of all countries, NaN
+    in years without groups (where group_pct_of_total raises, or gives 0 for every weighted group)
+    """
+    blocks, block_values, years = group_blocks(column_to_group, value_column, number_of_groups, weight_column)
+    values, _ = country_year_matrix(value_column)
+
+    # sum every (year, group) block and divide by the year's total over all countries, grouped or not
+    group_totals = np.bincount(blocks, weights=block_values, minlength=len(years) * number_of_groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = group_totals.reshape(len(years), number_of_groups) / np.nansum(values, axis=0)[:, None]
+
+    # years without groups have no shares
+    groups, _ = groups_by_year(column_to_group, number_of_groups, weight_column)
+    shares[np.all(np.isnan(groups), axis=0)] = np.nan
+
+    shares_df = pd.DataFrame(shares, index=pd.Index(years, name='year'),
+                             columns=pd.Index(range(1, number_of_groups + 1), name=f"{column_to_group} group"))
+
+    return u.record_dataset_version(shares_df, co2_data_countries)
+
+
+@memoize(max_entries=MAX_CACHED_RESULTS)
+def group_statistics_by_year(column_to_group, value_column, number_of_groups, weight_column=None):
+    """
+    Takes a grouping column, a column, and number of groups, returns the descriptive statistics of the column within
+    every group in every year, i.e. utils.find_summary_statistics_per_group for all years
+
+    :param column_to_group: column to group the countries by
+    :param value_column: column to describe
+    :param number_of_groups: number of groups
+    :param weight_column: optional column (e.g. 'population') to weight groups by
+    :return: df indexed by (year, group), with the columns of STATISTICS, for the (year, group) blocks with values
+    """
+    blocks, block_values, years = group_blocks(column_to_group, value_column, number_of_groups, weight_column)
+
+    # find where every non-empty block starts and how many values it has
+    block_starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]]) if len(blocks) else np.array([], int)
+    block_ids = blocks[block_starts]
+    counts = np.diff(np.r_[block_starts, len(blocks)])
+
+    # mean and sample standard deviation (ddof=1, like describe) from the sums of every block
+    sums = np.add.reduceat(block_values, block_starts) if len(blocks) else np.array([])
+    means = sums / counts
+    squared_deviations = (block_values - np.repeat(means, counts)) ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stds = np.sqrt((np.add.reduceat(squared_deviations, block_starts) if len(blocks) else np.array([])) /
+                       (counts - 1))
+
+    # quartiles interpolated within each sorted block, the minimum and maximum are its first and last values
+    positions = block_starts[None, :] + (counts - 1)[None, :] * np.array([0, 0.25, 0.5, 0.75, 1])[:, None]
+    quantiles = sorted_positions_to_values(block_values[:, None], positions.ravel()[:, None]).reshape(positions.shape)
+
+    statistics = np.column_stack([counts, means, stds, *quantiles])
+    index = pd.MultiIndex.from_arrays([years[block_ids // number_of_groups], block_ids % number_of_groups + 1],
+                                      names=['year', f"{column_to_group} group"])
+    statistics_df = pd.DataFrame(statistics, index=index, columns=STATISTICS)
+
+    return u.record_dataset_version(statistics_df, co2_data_countries)
@@ -0,0 +1,248 @@
+"""
+Correlations between the data columns of the co2 data set, per year and per group of countries.
+
+Correlation matrices are computed for every year at once from the country x year cube (see shared_data.py), as batched
+matrix products over a stack of (columns x countries) matrices, one per year. Missing values are masked, and every pair
+of columns is correlated over the countries that have data for both (pairwise complete), like pandas' DataFrame.corr.
+
+Spearman correlations are the Pearson correlations of the values' ranks, where the two columns of every pair are ranked
+over the countries that have data for both, like pandas. Every column is sorted once, and a column's ranks within the
+countries of a pair are then counted from its sorted order with a cumulative sum, for all pairs of the column at once.
+
+Derived columns (see derived_columns.py) are only included when asked for, as extra columns of the cube.
+
+Results are memoized per dataset version.
+"""
+import numpy as np
+import pandas as pd
+
+from download_data import co2_data_countries, download_key
+from cache import memoize
+import derived_columns as dc
+import shared_data as sd
+import utils as u
+
+# a correlation over fewer countries than this is NaN
+MIN_PERIODS = 3
+
+# number of batches (e.g. years) ranked together by spearman_stack
+SPEARMAN_BATCHES = 8
+
+METHODS = ['pearson', 'spearman']
+
+
+def sorted_ties(values):
+    """
+    Takes a stack of (columns x rows) matrices, returns the sorted order of every column and its groups of equal values
+
+    :param values: array of shape (batches, columns, rows), with NaN for missing values
+    :return: tuple of (order of the rows sorting each column, missing values last, the inverse of that order, whether
+    each sorted position starts a group of equal values, and whether it ends one), each of the shape of values
+    """
+    order = np.argsort(values, axis=2, kind='stable')
+    inverse_order = np.argsort(order, axis=2, kind='stable')
+    sorted_values = np.take_along_axis(values, order, axis=2)
+
+    # a group of ties starts where the value differs from the one before it, and ends where it differs from the next
+    differs = sorted_values[..., 1:] != sorted_values[..., :-1]
+    edge = np.ones(values.shape[:2] + (1,), dtype=bool)
+
+    return order, inverse_order, np.concatenate([edge, differs], axis=2), np.concatenate([differs, edge], axis=2)
+
+
+def ranks_within(mask, order, inverse_order, starts_group, ends_group):
+    """
+    Takes masks of rows and sorted columns, returns the average rank (1 = lowest) of every column among its masked rows
+
+    :param mask: array of shape (batches, columns, rows), True for the rows each column is ranked among
+    :param order: sorted order of the columns' rows, see sorted_ties, of the shape of mask or broadcast to it
+    :param inverse_order: inverse of order, see sorted_ties
+    :param starts_group: whether each sorted position starts a group of equal values, see sorted_ties
+    :param ends_group: whether each sorted position ends a group of equal values, see sorted_ties
+    :return: array of the shape of mask with the ranks, in the order of the rows, only valid inside the mask
+    """
+    # count the masked rows up to and before every sorted position
+    sorted_mask = np.take_along_axis(mask, order, axis=2)
+    through = np.cumsum(sorted_mask, axis=2, dtype=np.int32)
+    before = through - sorted_mask
+
+    # every value of a group of ties gets the group's average rank among the masked rows, from the count before the
+    # group's first position and the count through its last. The counts never decrease, so those are running maxima of
+    # the counts at group starts, and running minima (from the end) of the counts at group ends
+    below = np.maximum.accumulate(np.where(starts_group, before, 0), axis=2)
+    group_through = np.minimum.accumulate(np.where(ends_group, through, mask.shape[2])[..., ::-1], axis=2)[..., ::-1]
+    sorted_ranks = below + (group_through - below + 1) / 2
+
+    return np.take_along_axis(sorted_ranks, inverse_order, axis=2)
+
+
+def spearman_stack(values, min_periods=MIN_PERIODS):
+    """
+    Takes a stack of (columns x rows) matrices, returns the pairwise Spearman correlation matrix of the columns of each
+
+    Both columns of a pair are ranked over the rows that have data for both, like pandas' DataFrame.corr.
+    :param values: array of shape (batches, columns, rows), with NaN for missing values
+    :param min_periods: minimum number of rows with data for both columns, fewer gives NaN
+    :return: array of shape (batches, columns, columns)
+    """
+    correlation = np.full(values.shape[:2] + (values.shape[1],), np.nan)
+
+    # the cube is sparse in early years, so every block of batches is correlated over the columns and rows with data in
+    # it. A column with fewer than min_periods values in every batch of the block only has NaN correlations there
+    for start in range(0, len(values), SPEARMAN_BATCHES):
+        block = values[start:start + SPEARMAN_BATCHES]
+        present = ~np.isnan(block)
+        columns = np.flatnonzero((present.sum(axis=2) >= min_periods).any(axis=0))
+        rows = np.flatnonzero(present[:, columns].any(axis=(0, 1)))
+        if len(columns):
+            correlation[start:start + SPEARMAN_BATCHES, columns[:, None], columns[None, :]] = \
+                spearman_block(block[:, columns][:, :, rows], min_periods)
+
+    return correlation
+
+
+def spearman_block(values, min_periods):
+    """
+    Takes a stack of (columns x rows) matrices, returns the pairwise Spearman correlation matrix of the columns of each,
+    see spearman_stack
+    :param values: array of shape (batches, columns, rows), with NaN for missing values
+    :param min_periods: minimum number of rows with data for both columns, fewer gives NaN
+    :return: array of shape (batches, columns, columns)
+    """
+    present = ~np.isnan(values)
+    order, inverse_order, starts_group, ends_group = sorted_ties(values)
+    correlation = np.empty(values.shape[:2] + (values.shape[1],))
+
+    # one column against itself and the columns after it at a time, ranking both over the rows every pair has data for
+    for column in range(values.shape[1]):
+        both = present[:, column:column + 1, :] & present[:, column:, :]
+        own, others = slice(column, column + 1), slice(column, None)
+        x = ranks_within(both, order[:, own], inverse_order[:, own], starts_group[:, own], ends_group[:, own])
+        y = ranks_within(both, order[:, others], inverse_order[:, others], starts_group[:, others],
+                         ends_group[:, others])
+
+        # pearson correlation of the ranks over the rows of each pair, NaN for pairs with too few rows. The average
+        # ranks of n rows always have the mean (n + 1) / 2
+        n = both.sum(axis=2)
+        mean_rank = (n[..., None] + 1) / 2
+        x = np.where(both, x - mean_rank, 0.0)
+        y = np.where(both, y - mean_rank, 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pair_correlation = (x * y).sum(axis=2) / np.sqrt((x ** 2).sum(axis=2) * (y ** 2).sum(axis=2))
+        pair_correlation[n < min_periods] = np.nan
+        correlation[:, column, column:] = correlation[:, column:, column] = pair_correlation
+
+    return np.clip(correlation, -1, 1)
+
+
+def correlation_stack(values, method='pearson', min_periods=MIN_PERIODS):
+    """
+    Takes a stack of (columns x rows) matrices, returns the pairwise correlation matrix of the columns of each of them
+
+    :param values: array of shape (batches, columns, rows), with NaN for missing values
+    :param method: 'pearson' or 'spearman'
+    :param min_periods: minimum number of rows with data for both columns, fewer gives NaN
+    :return: array of shape (batches, columns, columns)
+    """
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {METHODS}")
+    if method == 'spearman':
+        return spearman_stack(values, min_periods)
+
+    # mask missing values and standardize each column, which keeps the sums below well conditioned. A column without
+    # any variation is masked entirely, so its correlations are NaN
+    masked = np.ma.masked_invalid(values)
+    masked = (masked - masked.mean(axis=2)[..., None]) / masked.std(axis=2)[..., None]
+    present = (~np.ma.getmaskarray(masked)).astype(np.float64)
+    filled = masked.filled(0.0)
+
+    # for every pair of columns (x, y), sum over the rows where both are present, as batched matrix products. Missing
+    # values are 0 in filled, so they drop out of every sum
+    present_t = present.transpose(0, 2, 1)
+    n = present @ present_t
+    sum_x = filled @ present_t
+    sum_xx = (filled ** 2) @ present_t
+    sum_xy = filled @ filled.transpose(0, 2, 1)
+    sum_y = sum_x.transpose(0, 2, 1)
+    sum_yy = sum_xx.transpose(0, 2, 1)
+
+    # pearson correlation from the sums, NaN for pairs with too few rows
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = sum_xy - sum_x * sum_y / n
+        variance_x = sum_xx - sum_x ** 2 / n
+        variance_y = sum_yy - sum_y ** 2 / n
+        correlation = covariance / np.sqrt(variance_x * variance_y)
+    correlation[n < min_periods] = np.nan
+
+    return np.clip(correlation, -1, 1)
+
+
+def stack_to_frame(correlation, keys, key_name, columns):
+    """
+    Takes a stack of correlation matrices, returns it as a df with one correlation matrix per key
+
+    :param correlation: array of shape (keys, columns, columns)
+    :param keys: the key (e.g. year) of each matrix
+    :param key_name: name of the key, the first level of the index
+    :param columns: names of the columns
+    :return: df indexed by (key, column), with a column per column, so df.loc[key] is the key's correlation matrix
+    """
+    index = pd.MultiIndex.from_product([keys, columns], names=[key_name, 'column'])
+
+    return pd.DataFrame(correlation.reshape(-1, len(columns)), index=index, columns=columns)
+
+
+@memoize
+def correlations_by_year(method='pearson', derived_columns=()):
+    """
+    Takes a correlation method, returns the correlation matrix of all data columns across countries for every year
+
+    :param method: 'pearson' or 'spearman'
+    :param derived_columns: tuple of derived columns to correlate with the data columns as well
+    :return: df indexed by (year, column), with a column per column, so df.loc[year] is that year's matrix
+    """
+    # take the (columns, countries, years) cube, with the matrices of the derived columns after the data columns, and
+    # make the years the batch axis
+    cube, countries, years, columns = sd.country_year_cube(download_key)
+    if derived_columns:
+        cube = np.concatenate([cube, np.stack([dc.country_year_matrix(col) for col in derived_columns])])
+        columns = columns + list(derived_columns)
+    values = np.ascontiguousarray(np.transpose(cube, (2, 0, 1)))
+
+    correlation = correlation_stack(values, method)
+
+    return u.record_dataset_version(stack_to_frame(correlation, years, 'year', columns), co2_data_countries)
+
+
+@memoize
+def correlations_by_group(year, column_to_group, number_of_groups, method='pearson', weight_column=None,
+                          derived_columns=()):
+    """
+    Takes a year and a grouping, returns the correlation matrix of all data columns across the countries of each group
+
+    Countries are grouped with utils.divide_data_into_groups_for_year, so e.g. grouping by gdp into 4 groups gives the
+    correlations among the poorest to the richest quarter of countries.
+    :param year: year of the data
+    :param column_to_group: column to group the countries by
+    :param number_of_groups: number of groups
+    :param method: 'pearson' or 'spearman'
+    :param weight_column: optional column to weight the groups by, see utils.divide_data_into_groups_for_year
+    :param derived_columns: tuple of derived columns to correlate with the data columns as well, and to group or
+    weight by
+    :return: df indexed by (group, column), with a column per column, so df.loc[group] is that group's matrix
+    """
+    data = dc.with_derived_columns(co2_data_countries, list(derived_columns))
+    grouped_df, group_column_name = u.divide_data_into_groups_for_year(data, year, column_to_group, number_of_groups,
+                                                                      weight_column)
+    columns = [col for col in grouped_df.columns if pd.api.types.is_float_dtype(grouped_df[col])]
+    groups = list(range(1, number_of_groups + 1))
+
+    # stack one (columns, countries) matrix per group, with the countries outside the group missing
+    values = grouped_df[columns].to_numpy(dtype=np.float64).T
+    in_group = grouped_df[group_column_name].to_numpy()[None, :] == np.array(groups)[:, None]
+    values = np.where(in_group[:, None, :], values[None, :, :], np.nan)
+
+    correlation = correlation_stack(values, method)
+
+    return u.record_dataset_version(stack_to_frame(correlation, groups, group_column_name, columns),
+                                    co2_data_countries)
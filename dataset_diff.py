@@ -0,0 +1,118 @@
+"""
+Differences between two downloads of the co2 data set, at (country, column) granularity.
+
+When OWID republishes the data set, usually only a few countries or columns are revised. When a new download is laid
+out in shared memory (see shared_data.attach_shared_data), it's compared to the download it replaces, and the changes
+are stored in its layout:
+    {'previous_dataset_version': '...',
+     'axes_changed': False,                       whether countries or years were added or removed
+     'changed_columns': ['methane', ...],         columns added, removed, or described differently in the codebook
+     'changed': {'co2': ['Chad', 'Peru'], ...},   for every other column, the countries with a different value
+     'seconds': 0.05}
+
+Every value of both data sets is compared in one vectorized pass, on both frames aligned by (country, year).
+
+A result derived from some columns of some countries is still valid for the new download if none of those changed,
+see is_affected. Persisted results (see cache.py) are carried over to the new dataset version that way, so a refresh
+only recomputes the results whose inputs changed.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+KEY_COLUMNS = ['country', 'year']
+
+
+def changed_cells(previous_values, values):
+    """
+    Takes the values of a set of columns in two aligned frames, returns where they differ, with NaN equal to NaN
+    :param previous_values: array of shape (rows, columns)
+    :param values: array of the same shape
+    :return: bool array of the same shape
+    """
+    equal = previous_values == values
+    if previous_values.dtype == object or values.dtype == object:
+        return ~(equal | (pd.isnull(previous_values) & pd.isnull(values)))
+
+    return ~(equal | (np.isnan(previous_values) & np.isnan(values)))
+
+
+def diff_data_sets(previous_data, data, previous_descriptions=None, descriptions=None):
+    """
+    Takes two downloads of the data set (and optionally their codebook descriptions), returns what changed between them
+
+    :param previous_data: the full data set of the previous download
+    :param data: the full data set of the new download
+    :param previous_descriptions: optional dict of {column : codebook description} of the previous download
+    :param descriptions: optional dict of {column : codebook description} of the new download
+    :return: dict of changes, see the module docstring, which can be serialized to json
+    """
+    start = time.perf_counter()
+
+    # columns only one of the downloads has, or that are described differently, changed for every country
+    previous_columns = [col for col in previous_data.columns if col not in KEY_COLUMNS]
+    columns = [col for col in data.columns if col not in KEY_COLUMNS]
+    changed_columns = [col for col in columns if col not in previous_columns] + \
+        [col for col in previous_columns if col not in columns]
+    if previous_descriptions is not None and descriptions is not None:
+        changed_columns += [col for col in columns if col in previous_columns and
+                            previous_descriptions.get(col) != descriptions.get(col)]
+
+    # align both frames on every (country, year) either of them has, a missing row reads as NaN
+    previous_index = pd.MultiIndex.from_frame(previous_data[KEY_COLUMNS])
+    index = pd.MultiIndex.from_frame(data[KEY_COLUMNS])
+    all_rows = index.union(previous_index, sort=False)
+    axes_changed = len(all_rows) != len(index) or len(all_rows) != len(previous_index)
+
+    # compare the numeric columns as one block, and the text columns (iso_code) on their own
+    common_columns = [col for col in columns if col in previous_columns and col not in changed_columns]
+    numeric_columns = [col for col in common_columns if pd.api.types.is_numeric_dtype(data[col]) and
+                       pd.api.types.is_numeric_dtype(previous_data[col])]
+    text_columns = [col for col in common_columns if col not in numeric_columns]
+    changed = np.zeros((len(all_rows), len(common_columns)), dtype=bool)
+    for positions, block_columns in ((slice(0, len(numeric_columns)), numeric_columns),
+                                     (slice(len(numeric_columns), None), text_columns)):
+        if not block_columns:
+            continue
+        previous_values = pd.DataFrame(previous_data[block_columns].to_numpy(), index=previous_index) \
+            .reindex(all_rows).to_numpy()
+        values = pd.DataFrame(data[block_columns].to_numpy(), index=index).reindex(all_rows).to_numpy()
+        changed[:, positions] = changed_cells(previous_values, values)
+
+    # a country changed in a column if any of its years did, which only the few changed cells need to be looked up for
+    country_codes, countries = pd.factorize(all_rows.get_level_values('country'))
+    changed_by_country = np.zeros((len(countries), len(common_columns)), dtype=bool)
+    changed_rows, changed_positions = np.nonzero(changed)
+    changed_by_country[country_codes[changed_rows], changed_positions] = True
+    ordered_columns = numeric_columns + text_columns
+
+    return {
+        'axes_changed': bool(axes_changed),
+        'changed_columns': changed_columns,
+        'changed': {col: [str(country) for country in countries[changed_by_country[:, position]]]
+                    for position, col in enumerate(ordered_columns) if changed_by_country[:, position].any()},
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def is_affected(changes, columns, countries=None):
+    """
+    Takes the changes of a download and the inputs of a result, returns whether the result may have changed
+
+    :param changes: dict returned by diff_data_sets, or None if the download wasn't compared to an earlier one
+    :param columns: columns the result is derived from
+    :param countries: countries the result is derived from, or None for all countries
+    :return: bool, True unless none of the inputs changed
+    """
+    if changes is None or changes['axes_changed']:
+        return True
+
+    for col in columns:
+        if col in changes['changed_columns']:
+            return True
+        changed_countries = changes['changed'].get(col, [])
+        if changed_countries and (countries is None or set(countries) & set(changed_countries)):
+            return True
+
+    return False
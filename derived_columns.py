@@ -0,0 +1,238 @@
+"""
+Derived columns: series the data set doesn't ship, defined as vectorized expressions over its columns, which the pages
+offer in their dataset dropdowns next to the native columns.
+
+Every derived column is computed on country x year matrices of its input columns, taken from the cube (see
+shared_data.py), so an expression can work along the years of a country (e.g. index to a base year) or across the
+countries of a year (e.g. share of the selected countries) as well as on single values:
+    co2_indexed_1990        co2 relative to the country's 1990 value, which is 100
+    co2_per_energy          co2 per unit of primary energy consumption
+    co2_share_of_selection  share of the selected countries' total co2 in the year, in %
+    gdp_per_capita          gdp per person, from the population column
+    methane_per_capita      methane per person, from the population column
+A derived column is only offered if its inputs are columns of the data set, and it isn't a native column already.
+
+Nothing is computed up front: a column is computed the first time somebody selects it, and only the columns somebody
+selected take memory. Columns of every country on their own are memoized per dataset version, as one matrix each.
+Columns of a selection of countries are computed for the selected countries whenever they're needed.
+
+The pages add the derived columns they were asked for to their selected rows with with_derived_columns, after
+selecting countries and before filtering years, and read whole matrices with country_year_matrix.
+"""
+import numpy as np
+import pandas as pd
+
+from download_data import download_key
+from cache import memoize
+import shared_data as sd
+import tracing as tr
+import utils as u
+
+# base year of the indexed columns
+BASE_YEAR = 1990
+
+
+def indexed_to_year(column_name, base_year):
+    """
+    Takes a column and a base year, returns the expression of the column as an index, with the base year's value at 100
+    :param column_name: name of the column
+    :param base_year: year whose value is 100
+    :return: function of (matrix getter, years) returning the matrix of the index, NaN for countries without a non-zero
+    value in the base year
+    """
+    def compute(matrix, years):
+        values = matrix(column_name)
+        base_values = values[:, years == base_year]
+        if not base_values.shape[1]:
+            return np.full(values.shape, np.nan)
+        base_values = np.where(base_values != 0, base_values, np.nan)
+
+        return values / base_values * 100
+
+    return compute
+
+
+def ratio(numerator_column, denominator_column, scale=1.0):
+    """
+    Takes two columns, returns the expression of their ratio
+    :param numerator_column: name of the numerator column
+    :param denominator_column: name of the denominator column
+    :param scale: factor converting the ratio to the unit of the derived column
+    :return: function of (matrix getter, years) returning the matrix of the ratio, NaN where the denominator is 0
+    """
+    def compute(matrix, years):
+        denominator = matrix(denominator_column)
+
+        return matrix(numerator_column) / np.where(denominator != 0, denominator, np.nan) * scale
+
+    return compute
+
+
+def share_of_selection(column_name):
+    """
+    Takes a column, returns the expression of every country's share of the selected countries' total in each year
+    :param column_name: name of the column
+    :return: function of (matrix getter, years) returning the matrix of shares in %, NaN for years in which the selected
+    countries have no data or a total of 0
+    """
+    def compute(matrix, years):
+        values = matrix(column_name)
+        totals = np.nansum(values, axis=0)
+
+        return values / np.where(totals != 0, totals, np.nan)[None, :] * 100
+
+    return compute
+
+
+# {derived column : {'inputs': columns it's computed from, 'selection': whether its values depend on the selected
+# countries, 'compute': expression, 'description': description in the style of the codebook}}
+DERIVED_COLUMNS = {
+    f'co2_indexed_{BASE_YEAR}': {
+        'inputs': ['co2'],
+        'selection': False,
+        'compute': indexed_to_year('co2', BASE_YEAR),
+        'description': f"Annual total emissions of carbon dioxide (CO₂) relative to {BASE_YEAR}, indexed so that the "
+                       f"country's emissions in {BASE_YEAR} are 100. Derived from co2.",
+    },
+    'co2_per_energy': {
+        'inputs': ['co2', 'primary_energy_consumption'],
+        'selection': False,
+        'compute': ratio('co2', 'primary_energy_consumption'),
+        'description': "Annual total emissions of carbon dioxide (CO₂) per unit of primary energy consumption, "
+                       "measured in kilograms per kilowatt-hour. Derived from co2 and primary_energy_consumption.",
+    },
+    'co2_share_of_selection': {
+        'inputs': ['co2'],
+        'selection': True,
+        'compute': share_of_selection('co2'),
+        'description': "Annual total emissions of carbon dioxide (CO₂) as a share of the total of the selected "
+                       "countries (all countries if none are selected) in the same year, measured as a percentage. "
+                       "Derived from co2.",
+    },
+    'gdp_per_capita': {
+        'inputs': ['gdp', 'population'],
+        'selection': False,
+        'compute': ratio('gdp', 'population'),
+        'description': "Gross domestic product (GDP) per person, measured in international-$ using 2011 prices. "
+                       "Derived from gdp and population.",
+    },
+    'methane_per_capita': {
+        'inputs': ['methane', 'population'],
+        'selection': False,
+        'compute': ratio('methane', 'population', 1e6),
+        'description': "Annual emissions of methane per person, measured in tonnes of carbon dioxide-equivalents per "
+                       "person. Derived from methane and population.",
+    },
+}
+
+
+@memoize
+def available_columns():
+    """
+    Returns the derived columns that can be computed from the data set, and aren't native columns of it
+    :return: list of derived column names
+    """
+    _, _, _, columns = sd.country_year_cube(download_key)
+
+    return [name for name, derived in DERIVED_COLUMNS.items()
+            if name not in columns and all(col in columns for col in derived['inputs'])]
+
+
+def is_derived(column_name):
+    return column_name in available_columns()
+
+
+def descriptions():
+    """
+    Returns the description of every available derived column
+    :return: dict of {derived column : description}
+    """
+    return {name: DERIVED_COLUMNS[name]['description'] for name in available_columns()}
+
+
+def compute_matrix(column_name, country_index=None):
+    """
+    Takes a derived column and a selection of countries, returns its values for those countries in every year
+
+    :param column_name: name of an available derived column
+    :param country_index: positions of the countries in the cube, or None for all countries
+    :return: array of shape (countries, years)
+    """
+    cube, _, years, columns = sd.country_year_cube(download_key)
+
+    def matrix(input_column):
+        values = cube[columns.index(input_column)]
+        return values if country_index is None else values[country_index]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.asarray(DERIVED_COLUMNS[column_name]['compute'](matrix, years), dtype=np.float64)
+
+
+@memoize
+@tr.traced('compute')
+def derived_matrix(column_name):
+    """
+    Takes a derived column, returns its values for every country in every year, computed once per dataset version
+    :param column_name: name of an available derived column
+    :return: read-only array of shape (countries, years), in the order of the cube
+    """
+    values = compute_matrix(column_name)
+    values.setflags(write=False)
+
+    return values
+
+
+def country_year_matrix(column_name, country_index=None):
+    """
+    Takes a native or derived column and a selection of countries, returns its values for those countries in every year
+
+    :param column_name: name of a numeric column of the data set, or of an available derived column
+    :param country_index: positions of the countries in the cube, which are the selection of a column depending on it,
+    or None for all countries
+    :return: array of shape (countries, years), in the order of country_index
+    """
+    cube, _, _, columns = sd.country_year_cube(download_key)
+    if column_name in columns:
+        values = cube[columns.index(column_name)]
+    elif not is_derived(column_name):
+        raise ValueError(f"{column_name} is not a numeric or derived column of the data set")
+    elif DERIVED_COLUMNS[column_name]['selection']:
+        return compute_matrix(column_name, country_index)
+    else:
+        values = derived_matrix(column_name)
+
+    return values if country_index is None else values[country_index]
+
+
+def with_derived_columns(data, column_names):
+    """
+    Takes rows of the data set and a selection of columns, returns the rows with the selected derived columns added
+
+    Columns depending on the selected countries are computed for the countries of data, so data should hold all rows of
+    the selected countries (e.g. from bitmap_index.select_countries), before any years are filtered out.
+    :param data: co2_data_countries, or rows of it
+    :param column_names: column name, list of column names, or None. Native columns and None are ignored
+    :return: data, or a new df with the derived columns added, see utils.with_column
+    """
+    if not isinstance(column_names, (list, tuple)):
+        column_names = [column_names]
+    derived_names = [col for col in column_names if col and col not in data.columns and is_derived(col)]
+    if not derived_names:
+        return data
+
+    # the cube position of every row's country and year
+    _, cube_countries, years, _ = sd.country_year_cube(download_key)
+    country_positions = pd.Index(cube_countries).get_indexer(data['country'])
+    year_positions = data['year'].to_numpy() - years[0]
+
+    # the countries of data, as the selection of the columns depending on it
+    selected_positions, row_countries = np.unique(country_positions, return_inverse=True)
+
+    for column_name in dict.fromkeys(derived_names):
+        if DERIVED_COLUMNS[column_name]['selection']:
+            values = country_year_matrix(column_name, selected_positions)[row_countries, year_positions]
+        else:
+            values = country_year_matrix(column_name)[country_positions, year_positions]
+        data = u.with_column(data, column_name, values)
+
+    return data
@@ -1,30 +1,192 @@
+import hashlib
 import io
+import os
+import tempfile
+import warnings
 
 import pandas as pd
 import numpy as np
-from matplotlib import pyplot as plt
-import requests
+import dataset_diff as dsd
+import json_ingest as ji
+import shared_data as sd
+import tracing as tr
+import validation as v
 
 
 pd.options.display.width = 0
 pd.options.display.max_rows = 90
 pd.set_option('display.float_format', lambda x: '%0.2f' % x)
 
-# download the csv file from the co2-data repository on GitHub
 
-url = "https://raw.githubusercontent.com/owid/co2-data/master/owid-co2-data.csv"
-download = requests.get(url).content
+@tr.traced('ingest')
+def fetch(url):
+    """
+    Takes a url and returns the content of the response as bytes
 
-# save the contents of the csv to a pd DataFrame
+    requests is imported here rather than at the top of the module, so it's only loaded when something is downloaded.
+    If the CO2_DATA_SNAPSHOT environment variable is set, the file is read from that directory instead (by the file
+    name at the end of the url), so the app can run offline, e.g. for load tests. See load_test.py to save a snapshot.
+    :param url: url of the file to download
+    :return: content of the file as bytes
+    """
+    snapshot_directory = os.environ.get('CO2_DATA_SNAPSHOT')
+    if snapshot_directory:
+        with open(os.path.join(snapshot_directory, url.rsplit('/', 1)[1]), 'rb') as snapshot_file:
+            return snapshot_file.read()
 
-co2_data = pd.DataFrame(pd.read_csv(io.StringIO(download.decode('utf-8'))))
-#co2_data.to_excel(r'C:\Users\chille\Python\historical-co2-data\emissions_data_app\co2_data.xlsx')
-co2_data_countries = co2_data[~co2_data['iso_code'].isnull()]
-co2_data_regions = co2_data[co2_data['iso_code'].isnull()]
+    import requests
+
+    return requests.get(url).content
+
+
+@tr.traced('ingest')
+def fetch_to_file(url):
+    """
+    Takes a url and streams the file to a temporary file, returns its path and the sha1 of its content
+
+    The file is written in chunks, so a large file is never held in memory. If the CO2_DATA_SNAPSHOT environment
+    variable is set, the file in that directory is used in place instead, see fetch.
+    :param url: url of the file to download
+    :return: tuple of (path of the file, hashlib sha1 object of its content, whether the file is temporary)
+    """
+    digest = hashlib.sha1()
+    snapshot_directory = os.environ.get('CO2_DATA_SNAPSHOT')
+    if snapshot_directory:
+        path = os.path.join(snapshot_directory, url.rsplit('/', 1)[1])
+        for chunk in ji.iter_file_chunks(path):
+            digest.update(chunk)
+        return path, digest, False
+
+    import requests
+
+    with requests.get(url, stream=True) as response, \
+            tempfile.NamedTemporaryFile(prefix='co2-download-', delete=False) as download_file:
+        for chunk in response.iter_content(chunk_size=ji.CHUNK_SIZE):
+            digest.update(chunk)
+            download_file.write(chunk)
+
+    return download_file.name, digest, True
+
+
+@tr.traced('ingest')
+def content_version(data, codebook):
+    """
+    Takes the data set and the codebook, returns a hash of their content to be used as the dataset version
+
+    The hash is taken over the parsed values rather than the downloaded bytes, with rows sorted by country and year
+    (codebook by column) and columns sorted by name, so it only changes when a value, a column, or a definition
+    changes, and not when the csv is re-exported in a different order or format.
+    :param data: the full co2 data set, as read from the csv
+    :param codebook: the codebook, as read from its csv
+    :return: dataset version as a hex string
+    """
+    digest = hashlib.sha1()
+    for df, sort_columns in ((data, ['country', 'year']), (codebook, ['column'])):
+        # put rows and columns in a canonical order
+        df = df.sort_values(sort_columns, kind='stable')[sorted(df.columns)]
+
+        # hash the column names and types, then the values of every row
+        digest.update(repr([(col, str(df[col].dtype)) for col in df.columns]).encode('utf-8'))
+        digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+
+    return digest.hexdigest()[:12]
+
+
+# download the data set and the codebook for dataset definitions from the co2-data repository on GitHub. The data set
+# is the csv file, or with CO2_DATA_FORMAT=json the json file, which is streamed to disk instead of into memory and
+# ingested one country at a time (see json_ingest.py). Both give the same table
+data_format = os.environ.get('CO2_DATA_FORMAT', 'csv')
+if data_format not in ('csv', 'json'):
+    raise ValueError(f"CO2_DATA_FORMAT must be 'csv' or 'json', not '{data_format}'")
 
-# download codebook for dataset definitions
+url = f"https://raw.githubusercontent.com/owid/co2-data/master/owid-co2-data.{data_format}"
+if data_format == 'json':
+    download_path, download_digest, download_is_temporary = fetch_to_file(url)
+else:
+    download = fetch(url)
+    download_digest = hashlib.sha1(download)
 url_codebook = "https://raw.githubusercontent.com/owid/co2-data/master/owid-co2-codebook.csv"
-download_codebook = requests.get(url_codebook).content
+download_codebook = fetch(url_codebook)
+
+# identify the downloaded files, which name their shared-memory layout
+download_digest.update(download_codebook)
+download_key = download_digest.hexdigest()[:12]
+
+
+
+def read_codebook(codebook_csv):
+    """
+    Takes the text of the codebook csv, returns the codebook and the description of every column
+    :param codebook_csv: str of the codebook csv, as downloaded or as stored in a layout file
+    :return: tuple of read-only pd.DataFrame of the codebook and dict of {column : description}
+    """
+    frame = sd.freeze(pd.DataFrame(pd.read_csv(io.StringIO(codebook_csv))))
+    return frame, dict(zip(frame['column'], frame['description'].fillna('')))
+
 
 #save codebook to a df
-codebook = pd.DataFrame(pd.read_csv(io.StringIO(download_codebook.decode('utf-8'))))
+codebook_csv = download_codebook.decode('utf-8')
+codebook, descriptions = read_codebook(codebook_csv)
+
+
+@tr.traced('ingest')
+def read_download():
+    """
+    Reads the downloaded data set into a df, only called when the download hasn't been laid out in shared memory yet
+    :return: pd.DataFrame of the data set
+    """
+    if data_format == 'json':
+        return ji.read_owid_json(ji.iter_file_chunks(download_path), codebook['column'])
+
+    return pd.DataFrame(pd.read_csv(io.StringIO(download.decode('utf-8'))))
+
+
+@tr.traced('ingest')
+def diff_download(previous_data, previous_layout, data):
+    """
+    Takes the data set of the previous download with its layout and the data set of this download, returns what
+    changed between them, only called when the download is laid out in shared memory
+    :param previous_data: the full data set of the previous download
+    :param previous_layout: the layout of the previous download, see shared_data.read_layout
+    :param data: the full data set of this download
+    :return: dict of changes, see dataset_diff.diff_data_sets
+    """
+    return {'previous_dataset_version': previous_layout['dataset_version'],
+            **dsd.diff_data_sets(previous_data, data, previous_layout.get('descriptions'), descriptions)}
+
+
+# save the contents of the download to a pd DataFrame laid out in shared memory, which is written once by the gunicorn
+# master and mapped read-only by every worker. Countries come first, so the country and region frames are views. All
+# three frames are read-only, see shared_data.py. The download is validated before it's laid out (see validation.py),
+# and compared to the download before it (see dataset_diff.py)
+try:
+    with tr.span('shared_data.attach_shared_data', 'ingest', download_key=download_key):
+        co2_data, n_country_rows = sd.attach_shared_data(download_key, read_download,
+                                                         lambda data: content_version(data, codebook),
+                                                         lambda data: v.validate_or_refuse(data, codebook),
+                                                         diff_download,
+                                                         {'descriptions': descriptions, 'codebook': codebook_csv})
+except v.DataValidationError as error:
+    # refuse the refresh, and keep serving the last download that passed validation if it's still laid out, with the
+    # codebook and descriptions stored with it rather than the refused ones
+    previous_download_key = sd.latest_download_key()
+    if previous_download_key is None:
+        raise
+    warnings.warn(f"{error}\nkeeping the data set of download {previous_download_key}")
+    download_key = previous_download_key
+    codebook, descriptions = read_codebook(sd.read_layout(download_key)['codebook'])
+    co2_data, n_country_rows = sd.read_shared_data(sd.shared_directory(download_key))
+finally:
+    if data_format == 'json' and download_is_temporary:
+        os.remove(download_path)
+#co2_data.to_excel(r'C:\Users\chille\Python\historical-co2-data\emissions_data_app\co2_data.xlsx')
+co2_data_countries = sd.freeze(co2_data.iloc[:n_country_rows])
+co2_data_regions = sd.freeze(co2_data.iloc[n_country_rows:])
+
+# content hash of the data set and codebook, which every derived result and cache is keyed and labelled with
+dataset_version = co2_data.attrs['dataset_version']
+
+# checks and timings of the validation of the data set being served, and what changed since the download before it
+download_layout = sd.read_layout(download_key)
+validation_report = download_layout.get('validation')
+dataset_changes = download_layout.get('changes')
@@ -1,12 +1,16 @@
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
-from matplotlib import pyplot as plt
-import requests
 from download_data import co2_data_regions, co2_data_countries
 import summary_growth as sg
+import tracing as tr
 import utils as u
 
 
+@tr.traced('compute')
 def find_multiplier(original_data, mult_columns):
     """
     Takes the co2 data and two selected columns, returns the multiplier between the columns' growth rates
@@ -36,19 +40,19 @@ def find_multiplier(original_data, mult_columns):
     # i.e. multiplier = 2nd column's growth rate divided by 1st column's growth rate
     # e.g. passing factor_columns = ['gdp','co2'] will calculate: multiplier = co2 growth rate / gdp growth rate
     mult_col_name = (str(mult_columns[1]) + ' / ' + str(mult_columns[0]) + ' multiplier')
-    multiplier_df[mult_col_name] = \
-        (multiplier_df[col_growth_names[1]] / multiplier_df[col_growth_names[0]])
+    multiplier = multiplier_df[col_growth_names[1]] / multiplier_df[col_growth_names[0]]
 
     # if the denominator of the calculation is negative, then we need to reverse the sign of the multiplier
     # this is because, in previous example, if gdp growth rate has been negative but co2 growth has been positive,
     # it would be incorrect to interpret this as a negative multiplier (i.e. when gdp contracts, co2 contracts too),
     # even though the division results in a negative
     positive_denominator = multiplier_df[col_growth_names[0]] > 0
-    multiplier_df[mult_col_name].where(positive_denominator, -multiplier_df[mult_col_name], inplace=True)
+    multiplier_df = u.with_column(multiplier_df, mult_col_name, multiplier.where(positive_denominator, -multiplier))
 
-    return multiplier_df
+    return u.record_dataset_version(multiplier_df, original_data)
 
 
+@tr.traced('compute')
 def grouped_growth_rate_multipliers(original_data, mult_columns, number_of_groups):
     """
     Takes the full data set, chosen columns, and desired number of groups, returns df with multipliers and group labels
@@ -85,14 +89,15 @@ def grouped_growth_rate_multipliers(original_data, mult_columns, number_of_group
 
     # slice df into specified number of equal groups based on first passed column's growth rate and
     # add a column that labels the group
-    grouped_growth_df = multiplier_df
     grouping_column_name = col_growth_names[0]
-    grouped_growth_df['Growth Rate Group'] = pd.qcut(grouped_growth_df[grouping_column_name], q=number_of_groups,
-                                              labels=range(1, number_of_groups + 1))
+    grouped_growth_df = u.with_column(multiplier_df, 'Growth Rate Group',
+                                      pd.qcut(multiplier_df[grouping_column_name], q=number_of_groups,
+                                              labels=range(1, number_of_groups + 1)))
 
-    return grouped_growth_df
+    return u.record_dataset_version(grouped_growth_df, original_data)
 
 
+@tr.traced('compute')
 def find_grouped_mean_multiplier(original_data, mult_columns, number_of_groups):
     """
     Takes the full data set, chosen columns, and desired number of groups, returns the mean of multipliers for
@@ -123,6 +128,7 @@ def find_grouped_mean_multiplier(original_data, mult_columns, number_of_groups):
     return mean_multiplier_dict
 
 
+@tr.traced('compute')
 def find_grouped_multiplier_statistics(original_data, mult_columns, number_of_groups):
     """
     Takes the full data set, chosen columns, and desired number of groups, returns the summary statistics of multipliers
@@ -154,5 +160,248 @@ def find_grouped_multiplier_statistics(original_data, mult_columns, number_of_gr
     return multiplier_statistics_dict
 
 
+# number of bootstrap resamples of every group, and the confidence level of the intervals
+N_RESAMPLES = 5000
+CONFIDENCE = 0.95
+
+
+def bootstrap_mean_and_median(values, n_resamples, seed_sequence, confidence):
+    """
+    Takes the values of a group, returns the mean and median with their bootstrap percentile confidence intervals
+
+    All resamples are drawn at once as a (n_resamples, len(values)) matrix of positions into values, so the statistics
+    of every resample are reductions along its rows.
+
+    :param values: array of the group's values, without NaN
+    :param n_resamples: number of resamples
+    :param seed_sequence: np.random.SeedSequence of the group
+    :param confidence: confidence level of the intervals, e.g. 0.95
+    :return: array of (mean, lower, upper, median, lower, upper), NaN if values is empty
+    """
+    if len(values) == 0:
+        return np.full(6, np.nan)
+
+    # draw every resample of the group in one matrix of positions, with replacement
+    generator = np.random.default_rng(seed_sequence)
+    resamples = values[generator.integers(0, len(values), size=(n_resamples, len(values)))]
+
+    # the interval is the central confidence share of the resampled statistics
+    tails = [100 * (1 - confidence) / 2, 100 * (1 + confidence) / 2]
+    mean_interval = np.percentile(resamples.mean(axis=1), tails)
+    median_interval = np.percentile(np.median(resamples, axis=1), tails)
+
+    return np.array([values.mean(), *mean_interval, np.median(values), *median_interval])
+
+
+@tr.traced('compute')
+def find_grouped_multiplier_intervals(original_data, mult_columns, number_of_groups, n_resamples=N_RESAMPLES,
+                                      confidence=CONFIDENCE, seed=0, workers=None):
+    """
+    Takes the full data set, chosen columns, and desired number of groups, returns the mean and median multiplier of
+    each group of growth rates of the first passed column with bootstrap confidence intervals
+
+    find_grouped_mean_multiplier gives a point mean per group, which in small groups can be dominated by a few
+    countries. Here the countries of every group are resampled with replacement, and the intervals are the central
+    percentiles of the resampled means and medians. A wide interval means the group's mean or median depends a lot on
+    which countries it happens to hold.
+
+    :param original_data: pass the original, unaltered owid co2 data dataframe that was downloaded from the owid GitHub
+    :param mult_columns: the names of the columns for which you want to calculate the growth rate multipliers
+    :param number_of_groups: the number of groups you want to split the data into. The set will be divided into chosen
+     number of groups using the number_of_groups - 1 quantiles of the growth rates of the first passed column
+    :param n_resamples: number of bootstrap resamples of every group
+    :param confidence: confidence level of the intervals, e.g. 0.95
+    :param seed: seed of the random generators, the same arguments always give the same intervals
+    :param workers: number of processes to resample the groups in, or None to resample them in this process. Every
+     group has its own generator spawned from the seed, so both give the same intervals
+    :return: dataframe with a row per group, holding its number of countries with a multiplier, and the mean and
+    median multiplier with the lower and upper ends of their intervals
+    """
+    # create a copy of df showing multipliers between chosen quantiles
+    grouped_multiplier_df = grouped_growth_rate_multipliers(original_data, mult_columns, number_of_groups)
+    # define the multiplier column name that was generated by find_multiplier()
+    mult_col_name = (str(mult_columns[1]) + ' / ' + str(mult_columns[0]) + ' multiplier')
+
+    # the multipliers of every group, without countries missing one, like the NaN skipping mean of the point estimate
+    groups = range(1, number_of_groups + 1)
+    group_values = [grouped_multiplier_df.loc[grouped_multiplier_df['Growth Rate Group'] == group, mult_col_name]
+                    .dropna().to_numpy(dtype=np.float64) for group in groups]
+
+    # resample every group with its own generator
+    seed_sequences = np.random.SeedSequence(seed).spawn(number_of_groups)
+    arguments = (group_values, itertools.repeat(n_resamples), seed_sequences, itertools.repeat(confidence))
+    if workers:
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            intervals = list(executor.map(bootstrap_mean_and_median, *arguments))
+    else:
+        intervals = list(map(bootstrap_mean_and_median, *arguments))
+
+    intervals_df = pd.DataFrame(np.array(intervals).reshape(number_of_groups, 6),
+                                index=pd.Index(groups, name='Growth Rate Group'),
+                                columns=['mean', 'mean lower', 'mean upper', 'median', 'median lower', 'median upper'])
+    intervals_df.insert(0, 'countries', [len(values) for values in group_values])
+
+    return u.record_dataset_version(intervals_df, original_data)
+
+
+# a regression over fewer years than this is NaN
+MIN_REGRESSION_YEARS = 5
+
+
+def find_log_country_year_matrix(original_data, column_name):
+    """
+    Takes the co2 data and a column, returns the log of the column as a country x year matrix
+
+    Years are the full range of years in the data, so consecutive matrix columns are consecutive calendar years.
+    Values of 0 or below have no log, and are NaN like missing values.
+
+    :param original_data: pass the original, unaltered owid co2 data dataframe that was downloaded from the owid GitHub
+    :param column_name: the name of the column to take the log of
+    :return: df with a row per country and a column per year
+    """
+    matrix = original_data.pivot(index='country', columns='year', values=column_name)
+    matrix = matrix.reindex(columns=range(int(original_data['year'].min()), int(original_data['year'].max()) + 1))
+
+    return np.log(matrix.where(matrix > 0))
 
 
+def regression_terms(x, y):
+    """
+    Takes two arrays of series, returns the terms whose sums give the least-squares fit of y on x
+
+    :param x: array with a series per row, NaN for missing values
+    :param y: array of the same shape as x
+    :return: array of shape (6, *x.shape) holding, for every point where both series have data, 1, x, y, x², xy, and y²,
+    and 0 for points where either is missing
+    """
+    present = np.isfinite(x) & np.isfinite(y)
+    x = np.where(present, x, 0.0)
+    y = np.where(present, y, 0.0)
+
+    return np.stack([present.astype(np.float64), x, y, x * x, x * y, y * y])
+
+
+def fit_from_sums(sums, min_points=MIN_REGRESSION_YEARS):
+    """
+    Takes sums of regression terms, returns the least-squares fit they describe
+
+    :param sums: array of shape (6, ...), the terms from regression_terms summed over the points of each fit
+    :param min_points: minimum number of points of a fit, fits with fewer are NaN
+    :return: tuple of arrays of shape (...) with the (slope, intercept, r², number of points) of each fit
+    """
+    n, sum_x, sum_y, sum_xx, sum_xy, sum_yy = sums
+
+    # slope, intercept, and r² from the centered sums of squares and products
+    with np.errstate(divide='ignore', invalid='ignore'):
+        squares_x = sum_xx - sum_x * sum_x / n
+        products = sum_xy - sum_x * sum_y / n
+        squares_y = sum_yy - sum_y * sum_y / n
+        slope = products / squares_x
+        intercept = (sum_y - slope * sum_x) / n
+        r2 = products * products / (squares_x * squares_y)
+
+    too_few_points = n < min_points
+    for fit in (slope, intercept, r2):
+        fit[too_few_points] = np.nan
+
+    return slope, intercept, r2, n
+
+
+def sliding_window_sums(terms, window):
+    """
+    Takes regression terms and a window length, returns the sums of the terms over every window of consecutive points
+
+    :param terms: array of shape (6, rows, points) from regression_terms
+    :param window: number of consecutive points in a window
+    :return: array of shape (6, rows, points - window + 1), where [..., i] is the sum over points i to i + window - 1
+    """
+    cumulative = np.cumsum(terms, axis=-1)
+    cumulative = np.concatenate([np.zeros(terms.shape[:-1] + (1,)), cumulative], axis=-1)
+
+    return cumulative[..., window:] - cumulative[..., :-window]
+
+
+@tr.traced('compute')
+def find_rolling_elasticities(original_data, elasticity_columns, window=20):
+    """
+    Takes the co2 data, two columns, and a window length, returns the elasticity between the columns for every country
+    over every window of consecutive years
+
+    The elasticity is the slope of the log-log regression of the second column on the first, so e.g. passing
+    ['gdp', 'co2'] gives the % change in co2 that goes with a 1% change in gdp. All countries and windows are fitted
+    at once from sliding sums of the regression terms.
+
+    :param original_data: pass the original, unaltered owid co2 data dataframe that was downloaded from the owid GitHub
+    :param elasticity_columns: the names of the two columns, the first is the explanatory one
+    :param window: number of years in a window, windows with fewer than MIN_REGRESSION_YEARS years of data are NaN
+    :return: df with a row per country and a column per year a window ends in
+    """
+    # error handling to raise error when more or less than two column names are passed, or a window is too short
+    if len(elasticity_columns) != 2:
+        raise ValueError('elasticity_columns must contain two columns')
+    if window < MIN_REGRESSION_YEARS:
+        raise ValueError(f"window must be at least {MIN_REGRESSION_YEARS} years")
+
+    # take the log of both columns as country x year matrices
+    log_x = find_log_country_year_matrix(original_data, elasticity_columns[0])
+    log_y = find_log_country_year_matrix(original_data, elasticity_columns[1])
+
+    # fit every country and window at once
+    terms = regression_terms(log_x.to_numpy(), log_y.to_numpy())
+    elasticity, _, _, _ = fit_from_sums(sliding_window_sums(terms, window))
+
+    rolling_elasticity_df = pd.DataFrame(elasticity, index=log_x.index, columns=log_x.columns[window - 1:])
+
+    return u.record_dataset_version(rolling_elasticity_df, original_data)
+
+
+@tr.traced('compute')
+def find_elasticities(original_data, elasticity_columns, window=20):
+    """
+    Takes the co2 data, two columns, and a window length, returns the elasticity between the columns for every country
+    over its full series, and how the elasticity has moved across windows of consecutive years
+
+    Compared to find_multiplier, which divides the growth rates between the earliest and latest years, the regression
+    uses every year of data, and r² shows how well a constant elasticity describes the country. An elasticity below 1
+    means the second column grows slower than the first (relative decoupling, e.g. of co2 from gdp), below 0 means it
+    falls while the first grows (absolute decoupling). A negative trend means the elasticity has been falling.
+
+    :param original_data: pass the original, unaltered owid co2 data dataframe that was downloaded from the owid GitHub
+    :param elasticity_columns: the names of the two columns, the first is the explanatory one
+    :param window: number of years in a window
+    :return: dataframe with a row per country, holding the elasticity, r² and number of years of the full series
+    regression, the elasticity in the latest window and the year it ends, and the trend of the window elasticities
+    (change per year)
+    """
+    # run the find_rolling_elasticities function to fit every window
+    rolling_elasticity_df = find_rolling_elasticities(original_data, elasticity_columns, window)
+
+    # fit the full series of every country at once
+    log_x = find_log_country_year_matrix(original_data, elasticity_columns[0])
+    log_y = find_log_country_year_matrix(original_data, elasticity_columns[1])
+    elasticity, _, r2, n = fit_from_sums(regression_terms(log_x.to_numpy(), log_y.to_numpy()).sum(axis=-1))
+
+    # find the latest window with an elasticity for every country
+    rolling_elasticity = rolling_elasticity_df.to_numpy()
+    has_elasticity = np.isfinite(rolling_elasticity)
+    latest_window = rolling_elasticity.shape[1] - 1 - np.argmax(has_elasticity[:, ::-1], axis=1)
+    latest_elasticity = np.where(has_elasticity.any(axis=1),
+                                 rolling_elasticity[np.arange(len(rolling_elasticity)), latest_window], np.nan)
+    latest_year = pd.Series(rolling_elasticity_df.columns[latest_window], index=rolling_elasticity_df.index)
+
+    # fit a linear trend through the window elasticities of every country at once
+    window_years = np.broadcast_to(rolling_elasticity_df.columns.to_numpy(dtype=np.float64), rolling_elasticity.shape)
+    trend, _, _, _ = fit_from_sums(regression_terms(window_years, rolling_elasticity).sum(axis=-1))
+
+    elasticity_col_name = f"{elasticity_columns[1]} / {elasticity_columns[0]} elasticity"
+    elasticity_df = pd.DataFrame({
+        elasticity_col_name: elasticity,
+        'r2': r2,
+        'years of data': n.astype(int),
+        'latest window elasticity': latest_elasticity,
+        'latest window end year': latest_year.where(has_elasticity.any(axis=1)).astype(pd.Int64Dtype()),
+        'window elasticity trend': trend,
+    }, index=log_x.index)
+
+    return u.record_dataset_version(elasticity_df, original_data)
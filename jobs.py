@@ -0,0 +1,96 @@
+"""
+Background jobs for heavy callbacks.
+
+Callbacks registered with background=True and manager=jobs.manager run in a separate process instead of the request
+thread, and the browser polls for their progress and result, so a slow chart doesn't hold a worker. Jobs, progress, and
+results are kept in a diskcache directory shared by all gunicorn workers (CO2_JOBS_DIR, or co2-jobs in the temp
+directory), so no broker is needed.
+
+Identical jobs, i.e. the same callback, arguments, and dataset version, share one process: a request for a job that is
+already running subscribes to it instead of starting another one, and cancelling (e.g. because the user changed an
+input) only stops the process once every subscriber has cancelled. Results are kept for RESULT_EXPIRE seconds, so an
+identical request in that time is answered without starting a process at all.
+"""
+import os
+import tempfile
+
+import diskcache
+from dash import DiskcacheManager
+
+from download_data import dataset_version
+
+JOBS_DIRECTORY = os.environ.get('CO2_JOBS_DIR') or os.path.join(tempfile.gettempdir(), 'co2-jobs')
+
+# seconds results and job records are kept for
+RESULT_EXPIRE = 600
+
+# job id returned for a request answered from a finished result, which no process belongs to
+FINISHED_JOB = -1
+
+
+def ignore_progress(progress_value):
+    """
+    Takes a progress value and ignores it, passed as set_progress when a background callback is called directly
+    :param progress_value: progress value set by the callback
+    :return: None
+    """
+
+
+class JobManager(DiskcacheManager):
+    """
+    Dash background callback manager that runs every distinct job once, in a process per job, and shares its progress
+    and result with every request for it
+    """
+
+    def call_job_fn(self, key, job_fn, args, context):
+        # hold a lock on the key while checking for and starting its job, so identical requests arriving together
+        # don't both start one
+        with diskcache.Lock(self.handle, f"job-lock-{key}", expire=60):
+            # answer from the finished result, unless it's an error, which is retried
+            result = self.handle.get(key)
+            if result is not None and not (isinstance(result, dict) and 'long_callback_error' in result):
+                return FINISHED_JOB
+
+            # subscribe to the job if it's running already
+            job = self.handle.get(f"job-{key}")
+            if job is not None and self.job_running(job['pid']):
+                job['subscribers'] += 1
+                self.handle.set(f"job-{key}", job, expire=RESULT_EXPIRE)
+                return job['pid']
+
+            # otherwise start it
+            self.handle.delete(key)
+            pid = super().call_job_fn(key, job_fn, args, context)
+            self.handle.set(f"job-{key}", {'pid': pid, 'subscribers': 1}, expire=RESULT_EXPIRE)
+            self.handle.set(f"job-pid-{pid}", key, expire=RESULT_EXPIRE)
+
+        return pid
+
+    def terminate_job(self, job):
+        if job is None or int(job) <= 0:
+            return
+        job = int(job)
+
+        # unsubscribe, and only stop the process when nobody else is waiting for it
+        with self.handle.transact():
+            key = self.handle.get(f"job-pid-{job}")
+            record = self.handle.get(f"job-{key}") if key is not None else None
+            if record is not None and record['pid'] == job and record['subscribers'] > 1:
+                record['subscribers'] -= 1
+                self.handle.set(f"job-{key}", record, expire=RESULT_EXPIRE)
+                return
+            if record is not None and record['pid'] == job:
+                self.handle.delete(f"job-{key}")
+            self.handle.delete(f"job-pid-{job}")
+
+        super().terminate_job(job)
+
+    def job_running(self, job):
+        if job is None or int(job) <= 0:
+            return False
+
+        return super().job_running(job)
+
+
+# results are cached per dataset version, which also keeps finished results available to every subscriber
+manager = JobManager(diskcache.Cache(JOBS_DIRECTORY), cache_by=[lambda: dataset_version], expire=RESULT_EXPIRE)
@@ -0,0 +1,168 @@
+"""
+Streaming ingestion of the OWID co2 data set from its json file.
+
+owid-co2-data.json is nested by country:
+    {"Afghanistan": {"iso_code": "AFG", "data": [{"year": 1949, "population": 7663783.0, "co2": 0.015, ...}, ...]},
+     "Africa": {"data": [...]}, ...}
+where every record only holds the columns with data for that year. Loading the whole document with json.loads keeps
+every record as a dict of Python objects, many times the size of the table they describe. Instead, the document is
+read in chunks and decoded one country at a time, and each country's records are appended straight to an array per
+column, so only the columns being built, one country's records, and one chunk are in memory at once.
+
+The result is the same table pd.read_csv builds from owid-co2-data.csv: one row per country and year, with the
+country, year and iso_code columns first (iso_code is missing for regions), float columns with NaN where a record has
+no value, and the columns in the order of the codebook.
+"""
+import array
+import codecs
+import json
+import math
+
+import numpy as np
+import pandas as pd
+
+# bytes read from the file at a time
+CHUNK_SIZE = 1 << 20
+
+# columns that aren't floats, which come first in the table like in the csv
+FIRST_COLUMNS = ['country', 'year', 'iso_code']
+
+_whitespace = ' \t\n\r'
+
+
+def iter_file_chunks(path, chunk_size=CHUNK_SIZE):
+    """
+    Takes the path of a file and yields its content in chunks of bytes
+    :param path: path of the file
+    :param chunk_size: number of bytes per chunk
+    :return: generator of bytes
+    """
+    with open(path, 'rb') as json_file:
+        while True:
+            chunk = json_file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def iter_object_items(chunks):
+    """
+    Takes a json document with an object at its top level, as chunks of bytes, and yields the object's items one at a
+    time, without holding more of the document than the item being decoded
+
+    :param chunks: iterable of bytes, e.g. iter_file_chunks(path)
+    :return: generator of (key, decoded value)
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    chunks = iter(chunks)
+    state = {'buffer': '', 'position': 0, 'exhausted': False}
+
+    def read_more():
+        # append the next chunk to the buffer, dropping the part that has been decoded already
+        chunk = next(chunks, None)
+        if chunk is None:
+            state['exhausted'] = True
+            state['buffer'] += text_decoder.decode(b'', final=True)
+        else:
+            state['buffer'] = state['buffer'][state['position']:] + text_decoder.decode(chunk)
+            state['position'] = 0
+        return not state['exhausted']
+
+    def next_character():
+        # skip whitespace and return the next character, or '' at the end of the document
+        while True:
+            buffer, position = state['buffer'], state['position']
+            while position < len(buffer) and buffer[position] in _whitespace:
+                position += 1
+            state['position'] = position
+            if position < len(buffer):
+                return buffer[position]
+            if not read_more():
+                return ''
+
+    def expect(characters):
+        character = next_character()
+        if character not in characters or not character:
+            raise ValueError(f"expected one of {characters!r} in the json document, found {character!r}")
+        state['position'] += 1
+        return character
+
+    def decode_value():
+        # decode the next value, reading more of the document while it's incomplete. A value is only accepted with
+        # something after it (or at the end of the document), so a number split between chunks isn't cut short
+        next_character()
+        while True:
+            try:
+                value, end = decoder.raw_decode(state['buffer'], state['position'])
+                if end < len(state['buffer']) or state['exhausted']:
+                    state['position'] = end
+                    return value
+            except json.JSONDecodeError:
+                if state['exhausted']:
+                    raise
+            # at least double the text available for the value before decoding it again, so a value spanning many
+            # chunks is decoded a few times rather than once per chunk
+            pending = len(state['buffer']) - state['position']
+            while read_more() and len(state['buffer']) - state['position'] < 2 * pending:
+                pass
+
+    expect('{')
+    if next_character() == '}':
+        return
+    while True:
+        key = decode_value()
+        expect(':')
+        yield key, decode_value()
+        if expect(',}') == '}':
+            return
+
+
+def value_or_nan(value):
+    return math.nan if value is None else value
+
+
+def read_owid_json(chunks, column_order=()):
+    """
+    Takes owid-co2-data.json as chunks of bytes, returns the data set as the same df pd.read_csv builds from the csv
+
+    :param chunks: iterable of bytes, e.g. iter_file_chunks(path)
+    :param column_order: column names in the order of the table, e.g. the codebook's column column. Columns that
+    aren't listed follow in the order they're found in
+    :return: pd.DataFrame with a row per country and year
+    """
+    column_order = list(column_order)
+    countries = []
+    iso_codes = []
+    years = array.array('q')
+    # {column : float array}, every array has a value per row appended so far
+    float_columns = {}
+    n_rows = 0
+
+    for country, entry in iter_object_items(chunks):
+        records = entry.get('data', [])
+
+        # country columns, repeated for every record
+        countries.extend([country] * len(records))
+        iso_codes.extend([entry.get('iso_code', math.nan)] * len(records))
+        years.extend(int(record['year']) for record in records)
+
+        # columns seen for the first time are missing for every row before
+        for col in dict.fromkeys(col for record in records for col in record):
+            if col not in float_columns and col != 'year':
+                float_columns[col] = array.array('d', [math.nan]) * n_rows
+
+        # append every column's values, NaN where the record doesn't have the column
+        for col, values in float_columns.items():
+            values.extend([value_or_nan(record.get(col)) for record in records])
+        n_rows += len(records)
+
+    # build the table on the arrays without copying them, in the order of the csv
+    columns = {'country': np.array(countries, dtype=object), 'year': np.frombuffer(years, dtype=np.int64),
+               'iso_code': np.array(iso_codes, dtype=object),
+               **{col: np.frombuffer(values, dtype=np.float64) for col, values in float_columns.items()}}
+    ordered_columns = FIRST_COLUMNS + \
+        [col for col in column_order if col in float_columns] + \
+        [col for col in float_columns if col not in set(column_order)]
+
+    return pd.DataFrame({col: columns[col] for col in ordered_columns}, copy=False)
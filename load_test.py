@@ -0,0 +1,448 @@
+"""
+Load test for the Dash callbacks, to see how the app behaves under concurrent users and size its workers.
+
+Simulated users send /_dash-update-component requests like the browser does, either to app.server in this process
+(through Flask's test client) or to a running server (e.g. gunicorn) at --url. Request bodies are built from the app's
+own callback definitions (/_dash-dependencies) and data set (/api/v1/version), so they have the shapes of real callback
+requests. Every user follows one of the scenarios below, chosen by --mix, repeats it --iterations times or until
+--duration runs out, and waits --think-time between requests. Users start --ramp seconds apart in total.
+
+Scenarios:
+    analyze_scrub    scrubbing the Analyze year slider through every decade for a few countries
+    compare_many     Compare time series of many countries, dragging the year range
+    aggregate_box    grouped Aggregate box plots with different groupings and numbers of groups
+    replay           requests captured from real traffic, see below
+
+The report lists throughput, errors, and p50/p95/p99 latency per callback (by its first output).
+
+Real traffic is captured by starting the app with CO2_CAPTURE_CALLBACKS=<file.jsonl>, which appends every callback
+request body to the file; --replay <file.jsonl> then has every user replay them in order.
+
+To run offline, save the data set once with the snapshot command and set CO2_DATA_SNAPSHOT to its directory, which
+download_data reads instead of downloading.
+
+Usage:
+    python load_test.py snapshot data_snapshot
+    CO2_DATA_SNAPSHOT=data_snapshot python load_test.py run --users 8 --iterations 3
+    python load_test.py run --url http://127.0.0.1:8000 --users 32 --duration 60 --mix analyze_scrub=2,compare_many=1
+    python load_test.py run --replay callbacks.jsonl --users 4
+"""
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+CALLBACK_PATH = '/_dash-update-component'
+
+# seconds between polls for the result of a background callback (see jobs.py)
+POLL_INTERVAL = 0.05
+
+_capture_lock = threading.Lock()
+
+
+def open_session(url=None):
+    """
+    Takes the url of a running server, or None for app.server in this process, returns a function sending requests to it
+
+    :param url: base url of the server, e.g. http://127.0.0.1:8000, or None
+    :return: function taking (method, path, body) and returning (status code, response body as bytes)
+    """
+    if url is None:
+        from app import server
+
+        client = server.test_client()
+
+        def send(method, path, body=None):
+            response = client.open(path, method=method, json=body)
+            return response.status_code, response.get_data()
+
+        return send
+
+    import requests
+
+    session = requests.Session()
+
+    def send(method, path, body=None):
+        response = session.request(method, url.rstrip('/') + path, json=body)
+        return response.status_code, response.content
+
+    return send
+
+
+def load_callback_specs(send):
+    """
+    Takes a session, returns the app's callback definitions by their outputs
+    :param send: function returned by open_session
+    :return: dict of {output string : callback definition from /_dash-dependencies}
+    """
+    status, body = send('GET', '/_dash-dependencies')
+    if status != 200:
+        raise RuntimeError(f"couldn't load the callback definitions, status {status}")
+
+    return {spec['output']: spec for spec in json.loads(body)}
+
+
+def load_data_info(send):
+    """
+    Takes a session, returns the countries, columns, and years of the data set the app serves
+    :param send: function returned by open_session
+    :return: dict of {'countries', 'columns', 'years'}, see api.version
+    """
+    status, body = send('GET', '/api/v1/version')
+    if status != 200:
+        raise RuntimeError(f"couldn't load the data set info, status {status}")
+
+    return json.loads(body)
+
+
+def split_outputs(output):
+    """
+    Takes the output string of a callback, returns its outputs
+    :param output: e.g. 'plot.figure' or '..plot.figure...error.children..'
+    :return: list of (component id, property)
+    """
+    outputs = output[2:-2].split('...') if output.startswith('..') else [output]
+
+    return [tuple(item.rsplit('.', 1)) for item in outputs]
+
+
+def callback_body(specs, first_output, values, changed):
+    """
+    Takes the callback definitions and values for the inputs and state of one callback, returns its request body
+
+    :param specs: dict returned by load_callback_specs
+    :param first_output: the callback's first output as 'component id.property', e.g. 'scatter-plot.figure'
+    :param values: dict of {'component id.property' : value}, inputs and state that aren't given are None
+    :param changed: the input that triggered the callback, as 'component id.property'
+    :return: request body as a dict
+    """
+    output, spec = next((output, spec) for output, spec in specs.items()
+                        if '.'.join(split_outputs(output)[0]) == first_output)
+    outputs = [{'id': component_id, 'property': prop} for component_id, prop in split_outputs(output)]
+
+    def with_values(dependencies):
+        return [{**dependency, 'value': values.get(f"{dependency['id']}.{dependency['property']}")}
+                for dependency in dependencies]
+
+    return {
+        'output': output,
+        'outputs': outputs if output.startswith('..') else outputs[0],
+        'inputs': with_values(spec['inputs']),
+        'state': with_values(spec['state']),
+        'changedPropIds': [changed],
+    }
+
+
+def analyze_scrub(specs, data_info, rng):
+    """
+    Takes the callback definitions, data set info, and a random generator, returns the requests of a user scrubbing
+    the Analyze year slider through every decade
+    """
+    countries = rng.sample(data_info['countries'], min(5, len(data_info['countries'])))
+    first_year, last_year = data_info['years']
+    years = [year for year in range(first_year, last_year + 1) if year % 10 == 0] + [last_year]
+
+    return [callback_body(specs, 'scatter-plot.figure',
+                          {'year-slider.value': year, 'country-selector.value': countries,
+                           'dataset-selector.value': 'co2', 'bubble-size-selector.value': 'population'},
+                          'year-slider.value')
+            for year in years]
+
+
+def compare_many(specs, data_info, rng):
+    """
+    Takes the callback definitions, data set info, and a random generator, returns the requests of a user comparing
+    many countries and dragging the year range
+    """
+    countries = rng.sample(data_info['countries'], min(40, len(data_info['countries'])))
+    first_year, last_year = data_info['years']
+    dataset = rng.choice([col for col in ['co2', 'gdp', 'population'] if col in data_info['columns']])
+
+    return [callback_body(specs, 'compare-timeseries-plot.figure',
+                          {'compare-year-slider.value': [start_year, last_year],
+                           'compare-country-selector.value': countries, 'compare-dataset-selector.value': dataset},
+                          'compare-year-slider.value')
+            for start_year in range(max(first_year, last_year - 60), last_year - 10, 10)]
+
+
+def aggregate_box(specs, data_info, rng):
+    """
+    Takes the callback definitions, data set info, and a random generator, returns the requests of a user drawing
+    grouped Aggregate box plots
+    """
+    last_year = data_info['years'][1]
+    groupings = [col for col in ['gdp', 'population', 'co2_per_capita'] if col in data_info['columns']]
+
+    return [callback_body(specs, 'agg-plot.figure',
+                          {'agg-generate.n_clicks': click, 'agg-year-slider.value': [last_year - 20, last_year],
+                           'agg-country-selector.value': None, 'agg-dataset-selector.value': 'co2',
+                           'agg-group-button-on.active': True, 'agg-group-button-off.active': False,
+                           'agg-stacked-bar-button.active': False, 'agg-box-plot-button.active': True,
+                           'n-groups-input.value': str(rng.randint(3, 6)),
+                           'agg-grouping-selector.value': rng.choice(groupings),
+                           'agg-weight-selector.value': rng.choice([None, 'population'])},
+                          'agg-generate.n_clicks')
+            for click in range(1, 5)]
+
+
+def load_captured_requests(path):
+    """
+    Takes a file written with CO2_CAPTURE_CALLBACKS, returns the captured request bodies in order
+    :param path: path of the jsonl file
+    :return: list of request bodies
+    """
+    with open(path) as capture_file:
+        return [json.loads(line)['body'] for line in capture_file if line.strip()]
+
+
+SCENARIOS = {
+    'analyze_scrub': analyze_scrub,
+    'compare_many': compare_many,
+    'aggregate_box': aggregate_box,
+}
+
+
+def parse_mix(mix):
+    """
+    Takes a scenario mix like 'analyze_scrub=2,compare_many=1', returns the scenario of each user slot in proportion
+    :param mix: comma separated scenario=weight pairs, a scenario without a weight has weight 1
+    :return: list of scenario names, repeated by weight
+    """
+    scenarios = []
+    for item in mix.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in SCENARIOS:
+            raise ValueError(f"unknown scenario '{name}', choose from {', '.join(SCENARIOS)}")
+        scenarios += [name] * int(weight or 1)
+
+    return scenarios
+
+
+def callback_label(body):
+    """
+    Takes a callback request body, returns the callback's first output as its label
+    """
+    return '.'.join(split_outputs(body['output'])[0])
+
+
+def send_callback(send, body):
+    """
+    Takes a session and a callback request body, sends it and returns once the callback has answered
+
+    Background callbacks (see jobs.py) answer with the key of their job, and are polled like the browser does until
+    their result is ready.
+    :param send: function returned by open_session
+    :param body: request body
+    :return: status code of the final response
+    """
+    status, content = send('POST', CALLBACK_PATH, body)
+    job = json.loads(content) if status == 200 else {}
+    if 'cacheKey' not in job:
+        return status
+
+    # poll until the job has answered, i.e. with a response, or with no update (204)
+    while True:
+        time.sleep(POLL_INTERVAL)
+        status, content = send('POST', f"{CALLBACK_PATH}?cacheKey={job['cacheKey']}&job={job['job']}", body)
+        if status != 200 or json.loads(content).get('response'):
+            return status
+
+
+def run_user(send, bodies, iterations, deadline, think_time, results):
+    """
+    Takes a session and the requests of a user, and sends them in order until the iterations or the time run out
+
+    :param send: function returned by open_session
+    :param bodies: list of request bodies
+    :param iterations: number of times to send the requests, or None to send them until the deadline
+    :param deadline: time.perf_counter() value to stop at, or None
+    :param think_time: seconds to wait after every request
+    :param results: list to append (label, seconds, status code) of every request to
+    :return: None
+    """
+    iteration = 0
+    while iterations is None or iteration < iterations:
+        for body in bodies:
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            start = time.perf_counter()
+            try:
+                status = send_callback(send, body)
+            except Exception:
+                status = None
+            results.append((callback_label(body), time.perf_counter() - start, status))
+            if think_time:
+                time.sleep(think_time)
+        iteration += 1
+
+
+def run_load_test(url=None, users=4, mix='analyze_scrub,compare_many,aggregate_box', iterations=3, duration=None,
+                  think_time=0.0, ramp=0.0, replay=None, seed=0):
+    """
+    Runs the load test and returns its results
+
+    :param url: base url of a running server, or None to test app.server in this process
+    :param users: number of concurrent users
+    :param mix: scenario mix, see parse_mix
+    :param iterations: number of times every user repeats its scenario, or None to run for the duration
+    :param duration: seconds to run for, or None to run the iterations
+    :param think_time: seconds every user waits after a request
+    :param ramp: seconds over which the users are started
+    :param replay: path of captured requests every user replays instead of a scenario, or None
+    :param seed: seed of the random choices of the scenarios
+    :return: tuple of (list of (label, seconds, status code) per request, total seconds)
+    """
+    rng = random.Random(seed)
+    send = open_session(url)
+    if replay:
+        user_bodies = [load_captured_requests(replay)] * users
+    else:
+        specs, data_info = load_callback_specs(send), load_data_info(send)
+        scenarios = parse_mix(mix)
+        user_bodies = [SCENARIOS[scenarios[user % len(scenarios)]](specs, data_info, rng) for user in range(users)]
+
+    results = []
+    start = time.perf_counter()
+    deadline = start + duration + ramp if duration else None
+
+    def start_user(user):
+        time.sleep(ramp * user / users)
+        # every user gets its own session, or test client in this process, like every browser has its own connection
+        run_user(open_session(url), user_bodies[user], None if duration else iterations, deadline, think_time, results)
+
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        list(executor.map(start_user, range(users)))
+
+    return results, time.perf_counter() - start
+
+
+def summarize(results, seconds):
+    """
+    Takes the results of a load test, returns throughput, errors, and latency percentiles per callback and overall
+    :param results: list of (label, seconds, status code) per request
+    :param seconds: duration of the test
+    :return: dict of {label : statistics}, with the overall statistics under 'all'
+    """
+    by_label = collections.defaultdict(list)
+    for label, elapsed, status in sorted(results):
+        by_label[label].append((elapsed, status))
+    by_label['all'] = [(elapsed, status) for _, elapsed, status in results]
+
+    summary = {}
+    for label, requests in by_label.items():
+        latencies = np.array([elapsed for elapsed, _ in requests]) * 1000
+        summary[label] = {
+            'requests': len(requests),
+            'errors': sum(1 for _, status in requests if status not in (200, 204)),
+            'requests_per_second': round(len(requests) / seconds, 2),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 1),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 1),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 1),
+            'max_ms': round(float(latencies.max()), 1),
+        }
+
+    return summary
+
+
+def print_report(summary, seconds, users):
+    print(f"{users} users, {summary.get('all', {}).get('requests', 0)} requests in {seconds:.1f}s")
+    print(f"{'callback':<36}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for label, stats in summary.items():
+        print(f"{label:<36}{stats['requests']:>9}{stats['errors']:>8}{stats['requests_per_second']:>9}"
+              f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['p99_ms']:>9}{stats['max_ms']:>9}")
+
+
+def capture_callback(response):
+    """
+    Registered as an after_request hook, appends the body of every callback request to the CO2_CAPTURE_CALLBACKS file
+    :param response: flask.Response
+    :return: the response, unchanged
+    """
+    import flask
+
+    if flask.request.path.endswith(CALLBACK_PATH) and flask.request.method == 'POST':
+        body = flask.request.get_json(silent=True)
+        if body is not None:
+            with _capture_lock, open(os.environ['CO2_CAPTURE_CALLBACKS'], 'a') as capture_file:
+                capture_file.write(json.dumps({'time': time.time(), 'body': body}) + '\n')
+
+    return response
+
+
+def register(server):
+    """
+    Takes the Flask server of the Dash app and registers the capture of callback requests on it if
+    CO2_CAPTURE_CALLBACKS is set
+    :param server: app.server
+    :return: None
+    """
+    if os.environ.get('CO2_CAPTURE_CALLBACKS'):
+        server.after_request(capture_callback)
+
+
+def save_snapshot(directory):
+    """
+    Takes a directory and saves the downloaded data set and codebook to it, to be used with CO2_DATA_SNAPSHOT
+    :param directory: directory to save the files in, created if it doesn't exist
+    :return: None
+    """
+    import download_data as dd
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, dd.url_codebook.rsplit('/', 1)[1]), 'wb') as snapshot_file:
+        snapshot_file.write(dd.download_codebook)
+
+    # the json data set isn't kept after it's ingested, so it's downloaded again
+    if dd.data_format == 'json':
+        path, _, is_temporary = dd.fetch_to_file(dd.url)
+        (shutil.move if is_temporary else shutil.copy)(path, os.path.join(directory, dd.url.rsplit('/', 1)[1]))
+    else:
+        with open(os.path.join(directory, dd.url.rsplit('/', 1)[1]), 'wb') as snapshot_file:
+            snapshot_file.write(dd.download)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    snapshot = commands.add_parser('snapshot', help='save the data set for offline runs')
+    snapshot.add_argument('directory')
+
+    run = commands.add_parser('run', help='run the load test')
+    run.add_argument('--url', help='base url of a running server, by default app.server runs in this process')
+    run.add_argument('--users', type=int, default=4)
+    run.add_argument('--mix', default='analyze_scrub,compare_many,aggregate_box',
+                     help=f"scenario=weight pairs, scenarios: {', '.join(SCENARIOS)}")
+    run.add_argument('--iterations', type=int, default=3)
+    run.add_argument('--duration', type=float, help='seconds to run for, instead of a number of iterations')
+    run.add_argument('--think-time', type=float, default=0.0)
+    run.add_argument('--ramp', type=float, default=0.0)
+    run.add_argument('--replay', help='jsonl file of requests captured with CO2_CAPTURE_CALLBACKS')
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    if args.command == 'snapshot':
+        save_snapshot(args.directory)
+        print(f"saved the data set to {args.directory}, run with CO2_DATA_SNAPSHOT={args.directory} to use it")
+        return
+
+    results, seconds = run_load_test(args.url, args.users, args.mix, args.iterations, args.duration, args.think_time,
+                                     args.ramp, args.replay, args.seed)
+    summary = summarize(results, seconds)
+    print_report(summary, seconds, args.users)
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump({'users': args.users, 'seconds': round(seconds, 3), 'callbacks': summary}, report_file,
+                      indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Memory introspection for app.server, to find which structures use the memory of a worker.
+
+With CO2_MEMORY_DEBUG=1, /debug/memory returns a json report of the worker answering the request:
+    - its resident memory
+    - the deep size of every data frame held by download_data and of the codebook, split into private memory and memory
+      shared with the other workers through the shared-memory layout (see shared_data.py)
+    - the number of entries and deep size of every memoized cache (see cache.py) and of the compressed response bodies
+
+With CO2_MEMORY_TRACE=1 as well, every Dash callback request is traced with tracemalloc, and the report also lists, per
+callback, the peak memory allocated while answering it (including transient copies, e.g. of to_dict('records')) and
+the memory still held afterwards. Traced requests are answered one at a time so the peaks don't mix, and tracemalloc
+slows every allocation down, so this mode is only meant for finding copies, not for production.
+
+Every worker is a separate process, so a report only describes the worker that answered it.
+"""
+import collections
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import types
+
+import flask
+import numpy as np
+import pandas as pd
+
+import cache
+import compression
+import download_data as dd
+
+debug = flask.Blueprint('memory_debug', __name__, url_prefix='/debug')
+
+# {callback output : {calls, peak bytes, retained bytes}} for every traced callback
+callback_allocations = collections.defaultdict(lambda: {'calls': 0, 'last_peak_bytes': 0, 'max_peak_bytes': 0,
+                                                        'total_peak_bytes': 0, 'retained_bytes': 0})
+_trace_lock = threading.Lock()
+
+# objects that are part of the program rather than data held by it, which deep_size doesn't descend into
+_program_types = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+
+def is_shared(array):
+    """
+    Takes a numpy array and returns whether its memory belongs to a memory map, i.e. is shared between workers
+    :param array: numpy array
+    :return: bool
+    """
+    while array is not None:
+        if isinstance(array, np.memmap) or type(array).__name__ == 'mmap':
+            return True
+        array = getattr(array, 'base', None)
+
+    return False
+
+
+def frame_size(df):
+    """
+    Takes a data frame and returns its deep size, split into private memory and memory shared through memory maps
+    :param df: pd.DataFrame or pd.Series
+    :return: dict of {'bytes', 'shared_bytes', 'rows', 'columns'}
+    """
+    df = pd.DataFrame(df)
+    shared_bytes = sum(int(df[col].to_numpy().nbytes) for col in df.columns if is_shared(df[col].to_numpy()))
+    total_bytes = int(df.memory_usage(deep=True).sum())
+
+    return {'bytes': total_bytes - shared_bytes, 'shared_bytes': shared_bytes, 'rows': len(df),
+            'columns': len(df.columns)}
+
+
+def deep_size(obj, seen=None):
+    """
+    Takes any object and returns the private memory it holds, following containers, attributes, frames and arrays
+
+    Objects reached more than once are counted once, and memory shared through memory maps isn't counted.
+    :param obj: object to measure
+    :param seen: ids of the objects already counted
+    :return: size in bytes
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen or isinstance(obj, _program_types):
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return frame_size(obj)['bytes']
+    if isinstance(obj, np.ndarray):
+        if is_shared(obj):
+            return 0
+        # a view is counted as the array it belongs to
+        return sys.getsizeof(obj) if obj.base is None else deep_size(obj.base, seen)
+
+    size = sys.getsizeof(obj, 0)
+    if isinstance(obj, (str, bytes, bytearray, int, float, bool)) or obj is None:
+        return size
+    if isinstance(obj, dict):
+        return size + sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        return size + sum(deep_size(item, seen) for item in obj)
+
+    # plotly figures keep their traces and layout in _data and _layout, next to validators shared by all figures
+    if hasattr(obj, '_data') and hasattr(obj, '_layout') and hasattr(obj, 'to_plotly_json'):
+        return size + deep_size(obj._data, seen) + deep_size(obj._layout, seen)
+    # other objects, e.g. Dash components, hold their data in their attributes
+    if hasattr(obj, '__dict__'):
+        return size + deep_size(vars(obj), seen)
+
+    return size
+
+
+def resident_memory():
+    """
+    Returns the resident and peak resident memory of this process
+    :return: dict of {'rss_bytes', 'peak_rss_bytes'}, with None where the platform doesn't report it
+    """
+    memory = {'rss_bytes': None, 'peak_rss_bytes': None}
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key = 'rss_bytes' if line.startswith('VmRSS:') else 'peak_rss_bytes'
+                    memory[key] = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return memory
+
+
+def memory_report():
+    """
+    Returns a report of the memory held by this worker's data frames and caches
+    :return: dict that can be serialized to json
+    """
+    structures = {
+        'co2_data': frame_size(dd.co2_data),
+        'co2_data_countries': frame_size(dd.co2_data_countries),
+        'co2_data_regions': frame_size(dd.co2_data_regions),
+        'codebook': frame_size(dd.codebook),
+    }
+
+    # measure the caches with a shared set of seen objects, so results held by several caches are counted once
+    seen = set()
+    caches = {name: {'entries': len(store), 'bytes': deep_size(dict(store), seen)}
+              for name, store in sorted(cache.caches.items())}
+    caches['compression._compressed_bodies'] = {'entries': len(compression._compressed_bodies),
+                                                'bytes': deep_size(dict(compression._compressed_bodies), seen)}
+
+    report = {
+        'pid': os.getpid(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'dataset_version': dd.dataset_version,
+        **resident_memory(),
+        'structures': structures,
+        'caches': dict(sorted(caches.items(), key=lambda item: item[1]['bytes'], reverse=True)),
+        'cache_bytes': sum(entry['bytes'] for entry in caches.values()),
+    }
+    if tracemalloc.is_tracing():
+        traced_bytes, traced_peak_bytes = tracemalloc.get_traced_memory()
+        report['traced_bytes'] = traced_bytes
+        report['callbacks'] = dict(sorted(((output, {**stats, 'mean_peak_bytes': stats['total_peak_bytes'] //
+                                                     max(stats['calls'], 1)})
+                                           for output, stats in callback_allocations.items()),
+                                          key=lambda item: item[1]['max_peak_bytes'], reverse=True))
+
+    return report
+
+
+@debug.route('/memory')
+def memory():
+    response = flask.Response(json.dumps(memory_report(), indent=2), mimetype='application/json')
+    response.headers['Cache-Control'] = 'no-store'
+
+    return response
+
+
+def is_callback_request():
+    return flask.request.path.endswith('/_dash-update-component') and flask.request.method == 'POST'
+
+
+def start_callback_trace():
+    """
+    Registered as a before_request hook, starts tracing the allocations of a callback request
+    :return: None
+    """
+    if not is_callback_request():
+        return
+
+    _trace_lock.acquire()
+    flask.g.memory_trace_locked = True
+    flask.g.memory_trace_start = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+
+
+def stop_callback_trace(response):
+    """
+    Registered as an after_request hook, records the peak and retained allocations of a traced callback request
+    :param response: flask.Response
+    :return: the response, unchanged
+    """
+    start = flask.g.pop('memory_trace_start', None)
+    if start is None:
+        return response
+
+    current, peak = tracemalloc.get_traced_memory()
+    output = (flask.request.get_json(silent=True) or {}).get('output', 'unknown')
+    stats = callback_allocations[output]
+    stats['calls'] += 1
+    stats['last_peak_bytes'] = peak - start
+    stats['max_peak_bytes'] = max(stats['max_peak_bytes'], peak - start)
+    stats['total_peak_bytes'] += peak - start
+    stats['retained_bytes'] = current - start
+
+    return response
+
+
+def release_callback_trace(exception):
+    """
+    Registered as a teardown_request hook, lets the next callback request be traced, also after an error
+    :param exception: exception raised while handling the request, if any
+    :return: None
+    """
+    if flask.g.pop('memory_trace_locked', False):
+        _trace_lock.release()
+
+
+def register(server):
+    """
+    Takes the Flask server of the Dash app and registers the memory report on it if CO2_MEMORY_DEBUG is set, and the
+    callback allocation tracing if CO2_MEMORY_TRACE is set as well
+    :param server: app.server
+    :return: None
+    """
+    if not os.environ.get('CO2_MEMORY_DEBUG'):
+        return
+
+    server.register_blueprint(debug)
+
+    if os.environ.get('CO2_MEMORY_TRACE'):
+        tracemalloc.start()
+        server.before_request(start_callback_trace)
+        server.after_request(stop_callback_trace)
+        server.teardown_request(release_callback_trace)
@@ -0,0 +1,106 @@
+"""
+Initial page payloads: dropdown options, slider bounds and marks, and codebook descriptions.
+
+Everything here is computed once per dataset version and served from cache, so rendering a page layout doesn't need to
+scan the data set. The dataset dropdowns also offer the derived columns (see derived_columns.py), which are only computed
+when selected. The pages memoize their initial figures and tables the same way, and warm_page_cache() builds all of
+them up front so that gunicorn (with --preload) does the work once in the master before forking its workers.
+"""
+from download_data import co2_data_countries, codebook
+from cache import memoize
+import derived_columns as dc
+
+# columns that identify a row rather than hold data
+ID_COLUMNS = ['country', 'year', 'iso_code']
+
+
+@memoize
+def country_options():
+    """
+    Returns the list of unique countries in the data set, in data set order
+    :return: list of country names
+    """
+    return list(co2_data_countries['country'].unique())
+
+
+@memoize
+def column_options():
+    """
+    Returns all columns of the data set, including the identifying columns
+    :return: list of column names
+    """
+    return list(co2_data_countries.columns)
+
+
+@memoize
+def dataset_options():
+    """
+    Returns the columns of the data set that hold data, i.e. without country, year, and iso_code
+    :return: list of column names
+    """
+    return [col for col in co2_data_countries.columns if col not in ID_COLUMNS]
+
+
+@memoize
+def derived_options():
+    """
+    Returns the derived columns that can be computed from the data set
+    :return: list of column names
+    """
+    return dc.available_columns()
+
+
+@memoize
+def dropdown_options():
+    """
+    Returns the columns offered by the dataset dropdowns, i.e. the columns that hold data and the derived columns
+    :return: list of column names
+    """
+    return dataset_options() + derived_options()
+
+
+@memoize
+def year_range():
+    """
+    Returns the first and last year in the data set
+    :return: tuple of (first year, last year) as ints
+    """
+    return int(co2_data_countries['year'].min()), int(co2_data_countries['year'].max())
+
+
+@memoize
+def year_marks():
+    """
+    Returns slider marks for every decade in the data set
+    :return: dict of {year as str : label}
+    """
+    return {str(year): str(year) for year in co2_data_countries['year'].unique() if year % 10 == 0}
+
+
+@memoize
+def column_descriptions():
+    """
+    Returns the codebook description of every column, and the description of every derived column
+    :return: dict of {column : description}
+    """
+    return {**dict(zip(codebook['column'], codebook['description'])), **dc.descriptions()}
+
+
+def column_description(column_name):
+    """
+    Takes a column name and returns its description from the codebook
+    :param column_name: name of the column in the co2 data set
+    :return: description of the column, or an empty string if the codebook doesn't describe it
+    """
+    return column_descriptions().get(column_name, '')
+
+
+def warm_page_cache(page_registry):
+    """
+    Takes the Dash page registry and renders every page layout once, so all initial payloads are cached
+    :param page_registry: dash.page_registry
+    :return: None
+    """
+    for page in page_registry.values():
+        if callable(page['layout']):
+            page['layout']()
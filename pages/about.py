@@ -2,7 +2,7 @@ import dash
 from dash import html, dcc
 import dash_bootstrap_components as dbc
 
-dash.register_page(__name__, order=5)
+dash.register_page(__name__, order=6)
 
 about_sidebar_style = \
     {
@@ -4,7 +4,13 @@ from dash import html, dcc, Input, Output, callback, ctx, State
 from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 import plotly.express as px
-from download_data import co2_data_countries, codebook
+from download_data import co2_data_countries, dataset_version
+from cache import memoize
+import bitmap_index as bi
+import derived_columns as dc
+import jobs
+import page_data as pg
+import tracing as tr
 import utils as u
 
 # Purpose:
@@ -34,9 +40,6 @@ dash.register_page(__name__, order=3)
 # #D07C2E - orange
 # #F1F1E6 - gray
 
-initial_country_selection = co2_data_countries.country.unique()[:10]
-initial_year_range = list(range(co2_data_countries['year'].max() - 20, co2_data_countries['year'].max()))
-
 # Build sidebar
 agg_sidebar_style = \
     {
@@ -49,8 +52,9 @@ agg_sidebar_style = \
         # "color": "#D07C2E",
     }
 
-agg_sidebar = \
-    dbc.Container(
+
+def build_agg_sidebar():
+    return dbc.Container(
         [
             html.H2("Filters"),
             html.Hr(),
@@ -60,8 +64,8 @@ agg_sidebar = \
                         "Countries", className="lead"
                     ),
                     dcc.Dropdown(
-                        co2_data_countries.country.unique(),
-                        initial_country_selection,
+                        pg.country_options(),
+                        pg.country_options()[:10],
                         id='agg-country-selector',
                         placeholder='All countries selected',
                         multi=True
@@ -72,8 +76,7 @@ agg_sidebar = \
                         "Dataset", className="lead"
                     ),
                     dcc.Dropdown(
-                        co2_data_countries.loc[:, ~co2_data_countries.columns.isin(
-                            ['country', 'year', 'iso_code'])].columns,
+                        pg.dropdown_options(),
                         'co2',
                         id='agg-dataset-selector',
                         placeholder='Select a dataset to plot...'
@@ -102,17 +105,25 @@ agg_sidebar = \
                     dbc.Input(placeholder='Number of groups', id='n-groups-input'),
                     html.Br(),
                     dcc.Dropdown(
-                        co2_data_countries.loc[:, ~co2_data_countries.columns.isin(
-                            ['country', 'year', 'iso_code'])].columns,
+                        pg.dropdown_options(),
                         id='agg-grouping-selector',
                         placeholder='Select a dataset to group by...',
                     ),
+                    html.Br(),
+                    dcc.Dropdown(
+                        pg.dropdown_options(),
+                        id='agg-weight-selector',
+                        placeholder='Weight groups by (optional)...',
+                    ),
                     html.A("Dataset definitions",
                            href='https://github.com/owid/co2-data/blob/master/owid-co2-codebook.csv',
                            target="_blank"),
                     html.P(id='agg-grouping-error-display'),
                     dbc.Button("Generate Chart", active=False, outline=True, color="secondary",
                                id='agg-generate'),
+                    html.Br(),
+                    dbc.Progress(value=0, label='', striped=True, animated=True, color='#D07C2E',
+                                 id='agg-progress'),
                 ],
                 vertical=True,
                 pills=True
@@ -122,59 +133,75 @@ agg_sidebar = \
         fluid=True
     )
 
-layout = dbc.Container(
-    [
-        dbc.Row(
-            [
-                dbc.Col(
-                    dbc.Card(
-                        dbc.CardBody(
-                            agg_sidebar, style={'margin-left': '-20px', 'margin-right': '-20px'}
-                        )
-                    ),
-                    width=3
-                ),
-                dbc.Col(
-                    [
-                        html.H2(style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '1rem',
-                                       'color': '#D07C2E', 'font-weight': 'bold'},
-                                children='Aggregate'),
-                        html.P(style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '7px',
-                                      'color': '#D07C2E', 'font-style': 'italics'},
-                               children=
-                               '''
-                               Group countries by their characteristics to learn more about their tendencies and 
-                               how similarities and differences affect their contributions to climate change.
-                               Countries are selected into evenly distributed groups by percentile
-                               (e.g., selecting 5 groups will let you analyze countries grouped into quintiles). 
-                               '''),
-                        html.Hr(),
-                        dcc.RangeSlider(
-                            co2_data_countries['year'].min(),
-                            co2_data_countries['year'].max(),
-                            step=None,
-                            value=[co2_data_countries['year'].max() - 20, co2_data_countries['year'].max()],
-                            marks={str(year): str(year) for year in co2_data_countries['year'].unique()
-                                   if year % 10 == 0},
-                            allowCross=True,
-                            included=True,
-                            id='agg-year-slider'
-                        ),
-                        html.Br(),
-                        dcc.Graph(
-                            id='agg-plot'
+# Create page layout, built once per dataset version with the initial chart already drawn
+@memoize
+def build_layout():
+    initial_figure, _, _, _, initial_dataset_def, _ = initial_agg_plot()
+
+    return dbc.Container(
+        [
+            dbc.Row(
+                [
+                    dbc.Col(
+                        dbc.Card(
+                            dbc.CardBody(
+                                build_agg_sidebar(), style={'margin-left': '-20px', 'margin-right': '-20px'}
+                            )
                         ),
-                        html.A(id='agg-dataset-explainer'),
-                        html.Hr(),
-                        html.A(id='agg-grouping-dataset-explainer')
-                    ]
-                )
-            ]
-        )
-    ],
-    fluid=True,
-    class_name="g-0"
-)
+                        width=3
+                    ),
+                    dbc.Col(
+                        [
+                            html.H2(style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '1rem',
+                                           'color': '#D07C2E', 'font-weight': 'bold'},
+                                    children='Aggregate'),
+                            html.P(style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '7px',
+                                          'color': '#D07C2E', 'font-style': 'italics'},
+                                   children=
+                                   '''
+                                   Group countries by their characteristics to learn more about their tendencies and 
+                                   how similarities and differences affect their contributions to climate change.
+                                   Countries are selected into evenly distributed groups by percentile
+                                   (e.g., selecting 5 groups will let you analyze countries grouped into quintiles). 
+                                   Weight the groups by a dataset such as population to give each group an equal share 
+                                   of it instead (e.g., the richest 10% of the world's people).
+                                   '''),
+                            html.Hr(),
+                            dcc.RangeSlider(
+                                *pg.year_range(),
+                                step=None,
+                                value=[pg.year_range()[1] - 20, pg.year_range()[1]],
+                                marks=pg.year_marks(),
+                                allowCross=True,
+                                included=True,
+                                id='agg-year-slider'
+                            ),
+                            html.Br(),
+                            dcc.Graph(
+                                figure=initial_figure,
+                                id='agg-plot'
+                            ),
+                            html.A(initial_dataset_def, id='agg-dataset-explainer'),
+                            html.Hr(),
+                            html.A(id='agg-grouping-dataset-explainer')
+                        ]
+                    )
+                ]
+            )
+        ],
+        fluid=True,
+        class_name="g-0"
+    )
+
+
+def layout(**kwargs):
+    return build_layout()
+
+
+@memoize(persist_results=True, inputs=lambda: (['co2'], pg.country_options()[:10]))
+def initial_agg_plot():
+    return update_agg_plot(jobs.ignore_progress, None, [pg.year_range()[1] - 20, pg.year_range()[1]],
+                           pg.country_options()[:10], 'co2', False, True, False, False, None, None, None)
 
 
 # callback to update button active status
@@ -212,7 +239,9 @@ def update_agg_button_status(on_clicks, off_clicks, stacked_clicks, box_clicks,
         raise PreventUpdate
 
 
-# Callback to update aggregate plot with changes to dropdown selections or slider adjustments
+# Callback to update aggregate plot when the chart is generated. Grouping all countries over a wide year range is slow,
+# so it runs as a background job (see jobs.py) that shows its progress, is cancelled when an input changes before it's
+# done, and is shared by everyone requesting the same chart
 @callback(
     Output('agg-plot', 'figure'),
     Output('agg-country-error-display', 'children'),
@@ -229,10 +258,23 @@ def update_agg_button_status(on_clicks, off_clicks, stacked_clicks, box_clicks,
     State('agg-stacked-bar-button', 'active'),
     State('agg-box-plot-button', 'active'),
     State('n-groups-input', 'value'),
-    State('agg-grouping-selector', 'value')
+    State('agg-grouping-selector', 'value'),
+    State('agg-weight-selector', 'value'),
+    background=True,
+    manager=jobs.manager,
+    running=[(Output('agg-generate', 'disabled'), True, False)],
+    progress=[Output('agg-progress', 'value'), Output('agg-progress', 'label')],
+    progress_default=[0, ''],
+    cancel=[Input('agg-year-slider', 'value'), Input('agg-country-selector', 'value'),
+            Input('agg-dataset-selector', 'value'), Input('n-groups-input', 'value'),
+            Input('agg-grouping-selector', 'value'), Input('agg-weight-selector', 'value')],
+    # identical charts are the same job, whatever the number of clicks on the button
+    cache_args_to_ignore=[0],
+    prevent_initial_call=True
 )
-def update_agg_plot(agg_generate, year_range, country_value, dataset_value, group_on, group_off, stacked_bar_on,
-                    box_plot_on, n_groups, grouping_dataset_value):
+@tr.traced('callback')
+def update_agg_plot(set_progress, agg_generate, year_range, country_value, dataset_value, group_on, group_off,
+                    stacked_bar_on, box_plot_on, n_groups, grouping_dataset_value, weight_dataset_value):
     # check if no dataset selected, return an error and don't update dashboard
     if not dataset_value:
         return dash.no_update, dash.no_update, html.P(f'Please select a dataset.', style={
@@ -240,30 +282,35 @@ def update_agg_plot(agg_generate, year_range, country_value, dataset_value, grou
                dash.no_update
 
     # access codebook for full description of selected dataset to be updated under scatter plot
-    dataset_codebook_description = codebook.loc[codebook['column'] == dataset_value]['description'].values[0]
+    dataset_codebook_description = pg.column_description(dataset_value)
     dataset_def = f"* {dataset_value}: {dataset_codebook_description}"
 
+    set_progress((10, 'Selecting countries'))
+
     # if no countries selected, all countries are included
     if not country_value:
         selected_country_df = co2_data_countries
-        country_value = list(co2_data_countries['country'].unique())
-    # check if more than one country has been passed
-    elif isinstance(country_value, list):
-        # if country-selector value is a list, there is more than one country selected, then .isin() should be used
-        selected_country_df = co2_data_countries[co2_data_countries['country'].isin(country_value)]
+        country_value = pg.country_options()
+    # otherwise select the rows of the country, or list of countries, from the bitmap index
     else:
-        # if it's not a list, only one country is selected, which means we should use boolean comparison to select
-        selected_country_df = co2_data_countries[co2_data_countries['country'] == country_value]
+        selected_country_df = bi.select_countries(country_value)
+
+    # add the selected datasets that are derived columns, computed for the selected countries
+    selected_country_df = dc.with_derived_columns(selected_country_df,
+                                                  [dataset_value, grouping_dataset_value, weight_dataset_value])
 
     # if grouping is not active, build a normal stacked bar chart
     if group_off:
 
         # use the utils function to find the dataset for only the selected countries and years
+        set_progress((40, 'Aggregating'))
         df = u.find_all_data_for_year_range(selected_country_df, year_range[0], year_range[1])
-        aggregated_df = pd.DataFrame(df.groupby('country')[dataset_value].sum())
-        aggregated_df['year_range'] = f"{year_range[0]} - {year_range[1]}"
+        with tr.span('aggregate', 'compute'):
+            aggregated_df = pd.DataFrame(df.groupby('country')[dataset_value].sum())
+            aggregated_df['year_range'] = f"{year_range[0]} - {year_range[1]}"
 
-        fig = px.bar(aggregated_df, x='year_range', y=dataset_value, color=aggregated_df.index)
+        with tr.span('px.bar', 'figure'):
+            fig = px.bar(aggregated_df, x='year_range', y=dataset_value, color=aggregated_df.index)
         fig.update_xaxes(
             title_text='Year Range',
             title_standoff=25,
@@ -274,7 +321,8 @@ def update_agg_plot(agg_generate, year_range, country_value, dataset_value, grou
             title_standoff=25,
             showgrid=True, gridcolor='#1e434a', tickfont=dict(color='#839496'), title_font=dict(color='#839496')
         )
-        fig.update_layout(transition_duration=100, plot_bgcolor= "#002b36", paper_bgcolor="#1e434a",
+        fig.update_layout(meta={'dataset_version': dataset_version},
+                          transition_duration=100, plot_bgcolor= "#002b36", paper_bgcolor="#1e434a",
                           legend=dict(title_font=dict(color='#839496'),font=dict(color='#839496')))
 
         return fig, None, None, None, dataset_def, None
@@ -287,14 +335,18 @@ def update_agg_plot(agg_generate, year_range, country_value, dataset_value, grou
             return dash.no_update, dash.no_update, dash.no_update, \
                    "Groups must be greater than 0 and fewer than number of countries", dash.no_update, dash.no_update
         else:
+            set_progress((40, 'Grouping countries'))
             df, grouped_column_name = u.divide_data_into_groups_for_year_range(selected_country_df, year_range[0],
                                                                                year_range[1], grouping_dataset_value,
-                                                                               int(n_groups))
-            df = pd.DataFrame(df.groupby(grouped_column_name)[dataset_value].sum())
-            df['year_range'] = f"{year_range[0]} - {year_range[1]}"
+                                                                               int(n_groups), weight_dataset_value)
+            with tr.span('aggregate', 'compute'):
+                df = pd.DataFrame(df.groupby(grouped_column_name)[dataset_value].sum())
+                df['year_range'] = f"{year_range[0]} - {year_range[1]}"
+            set_progress((80, 'Drawing chart'))
 
             # use px to plot stacked chart by group
-            fig = px.bar(df, x='year_range', y=dataset_value, color=df.index)
+            with tr.span('px.bar', 'figure'):
+                fig = px.bar(df, x='year_range', y=dataset_value, color=df.index)
             fig.update_xaxes(
                 title_text='Year Range',
                 title_standoff=25,
@@ -305,14 +357,16 @@ def update_agg_plot(agg_generate, year_range, country_value, dataset_value, grou
                 title_standoff=25,
                 showgrid=True, gridcolor='#1e434a', tickfont=dict(color='#839496'), title_font=dict(color='#839496')
             )
-            fig.update_layout(transition_duration=100, plot_bgcolor= "#002b36", paper_bgcolor="#1e434a",
-                             legend=dict(title_font=dict(color='#839496'),font=dict(color='#839496')))
+            fig.update_layout(meta={'dataset_version': dataset_version},
+                              transition_duration=100, plot_bgcolor= "#002b36", paper_bgcolor="#1e434a",
+                              legend=dict(title_font=dict(color='#839496'),font=dict(color='#839496')))
 
             # access codebook for full description of grouping dataset to be updated under plot
-            group_codebook_description = codebook.loc[codebook['column'] ==
-                                                      grouping_dataset_value]['description'].values[0]
+            group_codebook_description = pg.column_description(grouping_dataset_value)
             grouped_def = f"** {grouping_dataset_value}: {group_codebook_description} " \
                           f"Please note that there may be fewer groups than requested due to data availability."
+            if weight_dataset_value:
+                grouped_def += f" Groups are weighted by {weight_dataset_value}, so each holds an equal share of it."
 
             return fig, None, None, None, dataset_def, grouped_def
 
@@ -324,13 +378,17 @@ def update_agg_plot(agg_generate, year_range, country_value, dataset_value, grou
                    "Groups must be greater than 0 and fewer than number of countries", dash.no_update, dash.no_update
         else:
             try:
+                set_progress((40, 'Grouping countries'))
                 df, grouped_column_name = u.divide_data_into_groups_for_year_range(selected_country_df, year_range[0],
                                                                                    year_range[1], grouping_dataset_value,
-                                                                                   int(n_groups))
+                                                                                   int(n_groups), weight_dataset_value)
                 df['year_range'] = f"{year_range[0]} - {year_range[1]}"
+                set_progress((80, 'Drawing chart'))
 
                 # use px to draw box plots for each group
-                fig = px.box(df, x=grouped_column_name, y=dataset_value, color=grouped_column_name, notched=False)
+                with tr.span('px.box', 'figure'):
+                    fig = px.box(df, x=grouped_column_name, y=dataset_value, color=grouped_column_name,
+                                 notched=False)
                 fig.update_xaxes(
                     title_text=grouped_column_name,
                     title_standoff=25,
@@ -341,16 +399,18 @@ def update_agg_plot(agg_generate, year_range, country_value, dataset_value, grou
                     title_standoff=25,
                     showgrid=True, gridcolor='#1e434a', tickfont=dict(color='#839496'), title_font=dict(color='#839496')
                 )
-                fig.update_layout(transition_duration=100, showlegend=False, plot_bgcolor= "#002b36", paper_bgcolor="#1e434a")
+                fig.update_layout(meta={'dataset_version': dataset_version},
+                                  transition_duration=100, showlegend=False, plot_bgcolor= "#002b36", paper_bgcolor="#1e434a")
 
             except KeyError:
                 raise PreventUpdate
 
             # access codebook for full description of grouping dataset to be updated under plot
-            group_codebook_description = codebook.loc[codebook['column'] ==
-                                                      grouping_dataset_value]['description'].values[0]
+            group_codebook_description = pg.column_description(grouping_dataset_value)
             grouped_def = f"** {grouping_dataset_value}: {group_codebook_description} " \
                           f"Please note that there may be fewer groups than requested due to data availability."
+            if weight_dataset_value:
+                grouped_def += f" Groups are weighted by {weight_dataset_value}, so each holds an equal share of it."
 
             return fig, None, None, None, dataset_def, grouped_def
 
@@ -1,10 +1,18 @@
 import random
 
+import numpy as np
 import dash
 from dash import html, dcc, Input, Output, callback
 import dash_bootstrap_components as dbc
 import plotly.express as px
-from download_data import co2_data_countries, codebook
+import plotly.graph_objects as go
+from download_data import co2_data_countries, dataset_version, download_key
+from cache import memoize
+import bitmap_index as bi
+import derived_columns as dc
+import page_data as pg
+import shared_data as sd
+import tracing as tr
 import utils as u
 
 dash.register_page(__name__, order=1, path='/')
@@ -27,8 +35,9 @@ sidebar_style = \
         #"color": "#D07C2E",
     }
 
-sidebar = \
-    dbc.Container(
+
+def build_sidebar():
+    return dbc.Container(
         [
             html.H2("Filters"),
             html.Hr(),
@@ -38,8 +47,8 @@ sidebar = \
                         "Countries", className="lead"
                     ),
                     dcc.Dropdown(
-                        co2_data_countries.country.unique(),
-                        co2_data_countries.country.unique()[0],
+                        pg.country_options(),
+                        pg.country_options()[0],
                         id='country-selector',
                         placeholder='Select one or more countries...',
                         multi=True
@@ -50,8 +59,7 @@ sidebar = \
                         "Dataset", className="lead"
                     ),
                     dcc.Dropdown(
-                        co2_data_countries.loc[:, ~co2_data_countries.columns.isin(
-                            ['country', 'year', 'iso_code'])].columns,
+                        pg.dropdown_options(),
                         'co2',
                         id='dataset-selector',
                         placeholder='Select a dataset to plot...'
@@ -62,15 +70,19 @@ sidebar = \
                         "Bubble size", className="lead"
                     ),
                     dcc.Dropdown(
-                        co2_data_countries.loc[:, ~co2_data_countries.columns.isin(
-                            ['country', 'year', 'iso_code'])].columns,
+                        pg.dropdown_options(),
                         id='bubble-size-selector',
                         placeholder='Select a dataset to represent size...'
                     ),
+                    html.P(id='bubble-size-error-display'),
+                    dbc.Switch(
+                        label='Play timeline',
+                        value=False,
+                        id='timeline-switch'
+                    ),
                     html.A("Dataset definitions",
                            href='https://github.com/owid/co2-data/blob/master/owid-co2-codebook.csv',
-                           target="_blank"),
-                    html.P(id='bubble-size-error-display')
+                           target="_blank")
                 ],
                 vertical=True,
                 pills=True
@@ -80,56 +92,180 @@ sidebar = \
         fluid=True
     )
 
-# Create app layout
-
-layout = dbc.Container(
-    [
-        dbc.Row(
-            [
-                dbc.Col(
-                    dbc.Card(
-                        dbc.CardBody(
-                            sidebar, style={'margin-left': '-20px', 'margin-right': '-20px'}
-                            )
-                        ),
-                    width=3
-                ),
-                dbc.Col(
-                    [
-                        html.H2(style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '1rem',
-                                       'color': '#D07C2E', 'font-weight': 'bold'},
-                                children='Analyze'),
-                        html.P(style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '7px',
-                                      'color': '#D07C2E', 'font-style': 'italics'},
-                               children=
-                               '''
-                               Analyze countries' GHG emissions and how they are influenced by various characteristics
-                               '''),
-                        html.Hr(),
-                        dcc.Graph(
-                            id='scatter-plot',
-                        ),
-                        dcc.Slider(
-                            co2_data_countries['year'].min(),
-                            co2_data_countries['year'].max(),
-                            step=None,
-                            value=co2_data_countries['year'].max(),
-                            marks={str(year): str(year) for year in co2_data_countries['year'].unique()
-                                   if year % 10 == 0},
-                            id='year-slider'
-                        ),
-                        html.A(id='dataset-explainer'),
-                        html.Hr(),
-                        html.A(id='bubble-dataset-explainer')
-                    ],
-                    width=9
-                    )
-            ]
-        ),
-    ],
-    fluid=True,
-    class_name="g-0"
-)
+
+# Create app layout, built once per dataset version with the initial figure already drawn
+@memoize
+def build_layout():
+    initial_figure, _, _, _, initial_dataset_def, _ = initial_scatter_plot()
+
+    return dbc.Container(
+        [
+            dbc.Row(
+                [
+                    dbc.Col(
+                        dbc.Card(
+                            dbc.CardBody(
+                                build_sidebar(), style={'margin-left': '-20px', 'margin-right': '-20px'}
+                                )
+                            ),
+                        width=3
+                    ),
+                    dbc.Col(
+                        [
+                            html.H2(style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '1rem',
+                                           'color': '#D07C2E', 'font-weight': 'bold'},
+                                    children='Analyze'),
+                            html.P(style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '7px',
+                                          'color': '#D07C2E', 'font-style': 'italics'},
+                                   children=
+                                   '''
+                                   Analyze countries' GHG emissions and how they are influenced by various characteristics
+                                   '''),
+                            html.Hr(),
+                            dcc.Graph(
+                                figure=initial_figure,
+                                id='scatter-plot',
+                            ),
+                            dcc.Slider(
+                                *pg.year_range(),
+                                step=None,
+                                value=pg.year_range()[1],
+                                marks=pg.year_marks(),
+                                id='year-slider'
+                            ),
+                            html.A(initial_dataset_def, id='dataset-explainer'),
+                            html.Hr(),
+                            html.A(id='bubble-dataset-explainer')
+                        ],
+                        width=9
+                        )
+                ]
+            ),
+        ],
+        fluid=True,
+        class_name="g-0"
+    )
+
+
+def layout(**kwargs):
+    return build_layout()
+
+
+@memoize(persist_results=True, inputs=lambda: (['co2'], pg.country_options()[:1]))
+def initial_scatter_plot():
+    return update_scatter_plot(pg.year_range()[1], pg.country_options()[0], 'co2', None)
+
+
+# size of the largest bubble, as passed to px.scatter
+SIZE_MAX = 70
+
+# significant digits of the values sent in timeline frames, which keeps the frames of all years small
+TIMELINE_DIGITS = 5
+
+# number of timeline figures kept in memory, each holds a frame per year of its selection of countries
+MAX_CACHED_TIMELINES = 8
+
+
+def round_significant(values, digits):
+    """
+    Takes an array and a number of significant digits, returns the values rounded to that many significant digits
+    :param values: float array, may contain NaN
+    :param digits: number of significant digits
+    :return: rounded array of the same shape
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        magnitude = np.floor(np.log10(np.abs(values)))
+    scale = 10.0 ** np.where(np.isfinite(magnitude), digits - 1 - magnitude, 0)
+
+    return np.round(values * scale) / scale
+
+
+def style_scatter_plot(fig):
+    """
+    Takes a scatter plot and applies the page's colors to it
+    :param fig: go.Figure
+    :return: the figure, styled
+    """
+    fig.update_layout(meta={'dataset_version': dataset_version},
+                      transition_duration=100, plot_bgcolor= "#002b36", paper_bgcolor="#1e434a")
+    fig.update_xaxes(showgrid=True, gridcolor='#1e434a', tickfont=dict(color='#839496'), title_font=dict(color='#839496'))
+    fig.update_yaxes(showgrid=True, gridcolor='#1e434a', tickfont=dict(color='#839496'), title_font=dict(color='#839496'))
+
+    return fig
+
+
+@memoize(max_entries=MAX_CACHED_TIMELINES)
+@tr.traced('figure')
+def build_timeline_figure(countries, dataset_value, bubble_size_value):
+    """
+    Takes countries and the selected datasets, returns the scatter plot animated over every year with data
+
+    All years are taken from the country x year cube (see shared_data.py) in one slice, or from the matrix of a derived
+    column (see derived_columns.py). The frames only carry what changes between years, the values and bubble sizes,
+    while the countries, axes, hover template, and layout are shared by all frames, and the y axis is fixed over all
+    years so the frames are comparable.
+    :param countries: tuple of countries, or an empty tuple for all countries
+    :param dataset_value: column to plot
+    :param bubble_size_value: column to size the bubbles by, or None
+    :return: go.Figure with a frame per year, a year slider, and a play button, showing the latest year, or None if
+    the countries have no data for the dataset
+    """
+    _, cube_countries, years, _ = sd.country_year_cube(download_key)
+
+    # select the countries' rows of the dataset's country x year matrix, in the order of the data set
+    selected_countries = set(countries)
+    country_index = [i for i, country in enumerate(cube_countries) if not countries or country in selected_countries]
+    country_names = [cube_countries[i] for i in country_index]
+    values = dc.country_year_matrix(dataset_value, country_index)
+
+    # only the years in which any of the countries has data get a frame, the latest one is shown first
+    years_with_data = ~np.all(np.isnan(values), axis=0)
+    values = values[:, years_with_data]
+    frame_years = years[years_with_data]
+    if not len(frame_years):
+        return None
+
+    # bubble sizes of every year, negative or missing sizes are 0, scaled like px.scatter over all years at once.
+    # Values and sizes are rounded, so the frames encode compactly
+    values = round_significant(values, TIMELINE_DIGITS)
+    marker = {'sizemode': 'area'}
+    sizes = None
+    if bubble_size_value:
+        sizes = np.clip(np.nan_to_num(dc.country_year_matrix(bubble_size_value, country_index)[:, years_with_data]),
+                        0, None)
+        sizes = round_significant(sizes, TIMELINE_DIGITS)
+        marker['sizeref'] = 2.0 * max(sizes.max(), 1e-12) / SIZE_MAX ** 2
+        marker['size'] = sizes[:, -1]
+
+    # every frame only updates the y values and bubble sizes of the trace
+    frames = [go.Frame(name=str(year), traces=[0],
+                       data=[go.Scatter(y=values[:, i], **({'marker': {'size': sizes[:, i]}} if bubble_size_value
+                                                         else {}))])
+              for i, year in enumerate(frame_years)]
+
+    hovertemplate = f"Country=%{{x}}<br>{dataset_value}=%{{y}}" + \
+        (f"<br>{bubble_size_value}=%{{marker.size}}" if bubble_size_value else "") + "<extra></extra>"
+    fig = go.Figure(data=[go.Scatter(x=country_names, y=values[:, -1], mode='markers', marker=marker,
+                                     hovertemplate=hovertemplate)],
+                    frames=frames)
+
+    # a slider step per frame, and play and pause buttons, which move between frames without redrawing the axes
+    frame_args = {'frame': {'duration': 100, 'redraw': False}, 'mode': 'immediate', 'transition': {'duration': 0}}
+    fig.update_layout(
+        sliders=[{'active': len(frames) - 1, 'currentvalue': {'prefix': 'Year: ', 'font': {'color': '#839496'}},
+                  'pad': {'t': 50}, 'font': {'color': '#839496'},
+                  'steps': [{'label': frame.name, 'method': 'animate', 'args': [[frame.name], frame_args]}
+                            for frame in frames]}],
+        updatemenus=[{'type': 'buttons', 'direction': 'left', 'x': 0, 'y': 0, 'xanchor': 'right', 'yanchor': 'top',
+                      'pad': {'t': 60, 'r': 10}, 'showactive': False,
+                      'buttons': [{'label': 'Play', 'method': 'animate', 'args': [None, {**frame_args,
+                                                                                        'fromcurrent': False}]},
+                                  {'label': 'Pause', 'method': 'animate', 'args': [[None], frame_args]}]}])
+    fig.update_xaxes(title_text='Country')
+    fig.update_yaxes(title_text=f"{dataset_value} *", range=[min(np.nanmin(values), 0) * 1.05,
+                                                             np.nanmax(values) * 1.05])
+
+    return style_scatter_plot(fig)
 
 
 # Callback to update scatter plot with changes to dropdown selections or slider adjustments
@@ -143,51 +279,64 @@ layout = dbc.Container(
     Input('year-slider', 'value'),
     Input('country-selector', 'value'),
     Input('dataset-selector', 'value'),
-    Input('bubble-size-selector', 'value'))
-def update_scatter_plot(selected_year, country_value, dataset_value, bubble_size_value):
-    if not country_value:
-        selected_country_df = co2_data_countries
-    # check if more than one country has been passed
-    elif isinstance(country_value, list):
-        # if country-selector value is a list, there is more than one country selected, then .isin() should be used
-        selected_country_df = co2_data_countries[co2_data_countries['country'].isin(country_value)]
-    else:
-        # if it's not a list, only one country is selected, which means we should use boolean comparison to select
-        selected_country_df = co2_data_countries[co2_data_countries['country'] == country_value]
-
-    # use the utils function to find the dataset for only the selected countries and years
-    df = u.find_all_data_for_year(selected_country_df, selected_year)
-
+    Input('bubble-size-selector', 'value'),
+    Input('timeline-switch', 'value'),
+    prevent_initial_call=True)
+@tr.traced('callback')
+def update_scatter_plot(selected_year, country_value, dataset_value, bubble_size_value, timeline_value=False):
     # check if no dataset selected, return an error and don't update dashboard
     if not dataset_value:
         return dash.no_update, dash.no_update, html.P(f'Please select a dataset.', style={
             'font-weight': 'bold', 'font-style': 'italics', 'color': '#D07C2E'}), dash.no_update, dash.no_update, dash.no_update
 
-    # check if any data in bubble_size set is NaN, and return an error and don't update dashboard
-    if bubble_size_value and (df[bubble_size_value].isnull().values.any() or (df[bubble_size_value] < 0).any()):
-        df = df.copy()
-        df[bubble_size_value].fillna(0, inplace=True)
-        df[bubble_size_value] = df[bubble_size_value].apply(lambda x: 0 if x < 0 else x)
+    # in timeline mode, draw all years at once from the country x year matrices, to be played under the chart
+    if timeline_value:
+        countries = tuple(country_value) if isinstance(country_value, list) else tuple(filter(None, [country_value]))
+        fig = build_timeline_figure(countries, dataset_value, bubble_size_value)
+        if fig is None:
+            return dash.no_update, html.P(f'There is no {dataset_value} data for the selected countries.', style={
+                'font-weight': 'bold', 'font-style': 'italics', 'color': '#D07C2E'}), None, None, dash.no_update, \
+                dash.no_update
+    # otherwise, draw the selected year
+    else:
+        if not country_value:
+            selected_country_df = co2_data_countries
+        # otherwise select the rows of the country, or list of countries, from the bitmap index
+        else:
+            selected_country_df = bi.select_countries(country_value)
 
-    # define the parameters of the scatter plot and update the data
-    fig = px.scatter(df, x='country', y=dataset_value, size=bubble_size_value, size_max=70,
-                     labels={'country': 'Country', dataset_value: f"{dataset_value} *"})
-    fig.update_layout(transition_duration=100, plot_bgcolor= "#002b36", paper_bgcolor="#1e434a")
-    fig.update_xaxes(showgrid=True, gridcolor='#1e434a', tickfont=dict(color='#839496'), title_font=dict(color='#839496'))
-    fig.update_yaxes(showgrid=True, gridcolor='#1e434a', tickfont=dict(color='#839496'), title_font=dict(color='#839496'))
+        # add the selected datasets that are derived columns, computed for the selected countries
+        selected_country_df = dc.with_derived_columns(selected_country_df, [dataset_value, bubble_size_value])
+
+        # use the utils function to find the dataset for only the selected countries and years
+        df = u.find_all_data_for_year(selected_country_df, selected_year)
 
+        # check if any data in bubble_size set is NaN or negative, and draw those bubbles with size 0
+        if bubble_size_value and (df[bubble_size_value].isnull().values.any() or (df[bubble_size_value] < 0).any()):
+            df = u.with_column(df, bubble_size_value, df[bubble_size_value].fillna(0).clip(lower=0))
+
+        # define the parameters of the scatter plot and update the data
+        with tr.span('px.scatter', 'figure'):
+            fig = style_scatter_plot(px.scatter(df, x='country', y=dataset_value, size=bubble_size_value,
+                                                size_max=SIZE_MAX,
+                                                labels={'country': 'Country', dataset_value: f"{dataset_value} *"}))
 
     # access codebook for full description of selected dataset to be updated under scatter plot
-    dataset_codebook_description = codebook.loc[codebook['column'] == dataset_value]['description'].values[0]
+    dataset_codebook_description = pg.column_description(dataset_value)
     dataset_def = f"* {dataset_value}: {dataset_codebook_description}"
 
     # access codebook for full description of selected bubble size dataset, if selected
     if bubble_size_value:
-        bubble_size_codebook_description = codebook.loc[codebook['column'] ==
-                                                        bubble_size_value]['description'].values[0]
+        bubble_size_codebook_description = pg.column_description(bubble_size_value)
         bubble_size_def = f"** {bubble_size_value}: {bubble_size_codebook_description}"
         return fig, None, None, None, dataset_def, bubble_size_def
 
     return fig, None, None, None, dataset_def, None
 
 
+# Callback to disable the year slider in timeline mode, where the chart has its own slider
+@callback(
+    Output('year-slider', 'disabled'),
+    Input('timeline-switch', 'value'))
+def disable_year_slider(timeline_value):
+    return bool(timeline_value)
@@ -2,7 +2,14 @@ import dash
 from dash import html, dcc, Input, Output, callback
 import dash_bootstrap_components as dbc
 import plotly.express as px
-from download_data import co2_data_countries, codebook
+import plotly.graph_objects as go
+from download_data import dataset_version
+from cache import memoize
+import bitmap_index as bi
+import derived_columns as dc
+import page_data as pg
+import projections as pj
+import tracing as tr
 import utils as u
 
 dash.register_page(__name__, order=2)
@@ -13,6 +20,10 @@ dash.register_page(__name__, order=2)
 # #D07C2E - orange
 # #F1F1E6 - gray
 
+# last year of the projection bands, and their (lower, upper percentile, opacity), see projections.py
+PROJECTION_YEAR = 2050
+PROJECTION_BANDS = [('p5', 'p95', 0.15), ('p25', 'p75', 0.3)]
+
 # Build sidebar
 compare_sidebar_style = \
     {
@@ -25,8 +36,9 @@ compare_sidebar_style = \
         #"color": "#D07C2E",
     }
 
-compare_sidebar = \
-    dbc.Container(
+
+def build_compare_sidebar():
+    return dbc.Container(
         [
             html.H2("Filters"),
             html.Hr(),
@@ -36,8 +48,8 @@ compare_sidebar = \
                         "Countries", className="lead"
                     ),
                     dcc.Dropdown(
-                        co2_data_countries.country.unique(),
-                        co2_data_countries.country.unique()[0],
+                        pg.country_options(),
+                        pg.country_options()[0],
                         id='compare-country-selector',
                         placeholder='Select one or more countries...',
                         multi=True
@@ -48,14 +60,18 @@ compare_sidebar = \
                         "Dataset", className="lead"
                     ),
                     dcc.Dropdown(
-                        co2_data_countries.loc[:, ~co2_data_countries.columns.isin(
-                            ['country', 'year', 'iso_code'])].columns,
+                        pg.dropdown_options(),
                         'co2',
                         id='compare-dataset-selector',
                         placeholder='Select a dataset to plot...'
                     ),
                     html.P(children="", style={'font-weight': 'bold', 'font-style': 'italics'},
                            id='compare-dataset-error-display'),
+                    dbc.Switch(
+                        label=f'Project trends to {PROJECTION_YEAR}',
+                        value=False,
+                        id='compare-projection-switch'
+                    ),
                     html.A("Dataset definitions",
                            href='https://github.com/owid/co2-data/blob/master/owid-co2-codebook.csv',
                            target="_blank")
@@ -68,53 +84,67 @@ compare_sidebar = \
         fluid=True
     )
 
-layout = dbc.Container(
-    [
-        dbc.Row(
-            [
-                dbc.Col(
-                    dbc.Card(
-                        dbc.CardBody(
-                            compare_sidebar, style={'margin-left': '-20px', 'margin-right': '-20px'}
-                            )
-                        ),
-                    width=3
-                ),
-                dbc.Col(
-                    [
-                        html.H2(style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '1rem',
-                                       'color': '#D07C2E', 'font-weight': 'bold'},
-                                children='Compare'),
-                        html.P(style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '7px',
-                                      'color': '#D07C2E', 'font-style': 'italics'},
-                               children=
-                               '''
-                               Compare countries' GHG emission trajectories over time
-                               '''),
-                        html.Hr(),
-                        dcc.Graph(
-                            id='compare-timeseries-plot',
-                        ),
-                        dcc.RangeSlider(
-                            co2_data_countries['year'].min(),
-                            co2_data_countries['year'].max(),
-                            step=None,
-                            value=[co2_data_countries['year'].max() - 20, co2_data_countries['year'].max()],
-                            marks={str(year): str(year) for year in co2_data_countries['year'].unique()
-                                   if year % 10 == 0},
-                            allowCross=True,
-                            included=True,
-                            id='compare-year-slider'
-                        ),
-                        html.A(id='compare-dataset-explainer')
-                    ]
-                )
-            ]
-        )
-    ],
-    fluid=True,
-    class_name="g-0"
-)
+# Create page layout, built once per dataset version with the initial figure already drawn
+@memoize
+def build_layout():
+    initial_year_range = [pg.year_range()[1] - 20, pg.year_range()[1]]
+    initial_figure, _, _, initial_dataset_def = initial_timeseries_plot()
+
+    return dbc.Container(
+        [
+            dbc.Row(
+                [
+                    dbc.Col(
+                        dbc.Card(
+                            dbc.CardBody(
+                                build_compare_sidebar(), style={'margin-left': '-20px', 'margin-right': '-20px'}
+                                )
+                            ),
+                        width=3
+                    ),
+                    dbc.Col(
+                        [
+                            html.H2(style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '1rem',
+                                           'color': '#D07C2E', 'font-weight': 'bold'},
+                                    children='Compare'),
+                            html.P(style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '7px',
+                                          'color': '#D07C2E', 'font-style': 'italics'},
+                                   children=
+                                   '''
+                                   Compare countries' GHG emission trajectories over time
+                                   '''),
+                            html.Hr(),
+                            dcc.Graph(
+                                figure=initial_figure,
+                                id='compare-timeseries-plot',
+                            ),
+                            dcc.RangeSlider(
+                                *pg.year_range(),
+                                step=None,
+                                value=initial_year_range,
+                                marks=pg.year_marks(),
+                                allowCross=True,
+                                included=True,
+                                id='compare-year-slider'
+                            ),
+                            html.A(initial_dataset_def, id='compare-dataset-explainer')
+                        ]
+                    )
+                ]
+            )
+        ],
+        fluid=True,
+        class_name="g-0"
+    )
+
+
+def layout(**kwargs):
+    return build_layout()
+
+
+@memoize(persist_results=True, inputs=lambda: (['co2'], pg.country_options()[:1]))
+def initial_timeseries_plot():
+    return update_timeseries_plot([pg.year_range()[1] - 20, pg.year_range()[1]], pg.country_options()[0], 'co2')
 
 
 @callback(
@@ -124,15 +154,13 @@ layout = dbc.Container(
     Output('compare-dataset-explainer', 'children'),
     Input('compare-year-slider', 'value'),
     Input('compare-country-selector', 'value'),
-    Input('compare-dataset-selector', 'value'))
-def update_timeseries_plot(year_range, country_value, dataset_value):
-    # check if more than one country has been passed
-    if isinstance(country_value, list):
-        # if country-selector value is a list, there is more than one country selected, then .isin() should be used
-        selected_country_df = co2_data_countries[co2_data_countries['country'].isin(country_value)]
-    else:
-        # if it's not a list, only one country is selected, which means we should use boolean comparison to select
-        selected_country_df = co2_data_countries[co2_data_countries['country'] == country_value]
+    Input('compare-dataset-selector', 'value'),
+    Input('compare-projection-switch', 'value'),
+    prevent_initial_call=True)
+@tr.traced('callback')
+def update_timeseries_plot(year_range, country_value, dataset_value, projection_value=False):
+    # select the rows of the country, or list of countries, from the bitmap index
+    selected_country_df = bi.select_countries(country_value)
 
     # check if no countries provided, return an error and don't update dashboard
     if not country_value:
@@ -144,11 +172,15 @@ def update_timeseries_plot(year_range, country_value, dataset_value):
         return dash.no_update, dash.no_update, html.P(f'Please select a dataset.', style={
             'font-weight': 'bold', 'font-style': 'italics', 'color': '#D07C2E'}), dash.no_update
 
+    # add the selected dataset if it's a derived column, computed for the selected countries
+    selected_country_df = dc.with_derived_columns(selected_country_df, dataset_value)
+
     # use the utils function to find the dataset for only the selected countries and years
     df = u.find_country_range_data(selected_country_df, dataset_value, country_value, year_range[0], year_range[1])
 
     # define the parameters of the line plot and update the data
-    fig = px.line(df, x='year', y=df.columns)
+    with tr.span('px.line', 'figure'):
+        fig = px.line(df, x='year', y=df.columns)
     
     fig.update_xaxes(
         title_text='Year',
@@ -160,12 +192,74 @@ def update_timeseries_plot(year_range, country_value, dataset_value):
         title_standoff=25,
         showgrid=True, gridcolor='#1e434a', tickfont=dict(color='#839496'), title_font=dict(color='#839496')
     )
-    fig.update_layout(transition_duration=100, plot_bgcolor= "#002b36", paper_bgcolor="#1e434a", 
+    fig.update_layout(meta={'dataset_version': dataset_version},
+                      transition_duration=100, plot_bgcolor= "#002b36", paper_bgcolor="#1e434a", 
                       legend=dict(title_font=dict(color='#839496'),font=dict(color='#839496')))
 
     # access codebook for full description of selected dataset to be updated under scatter plot
-    dataset_codebook_description = codebook.loc[codebook['column'] == dataset_value]['description'].values[0]
+    dataset_codebook_description = pg.column_description(dataset_value)
     dataset_def = f"* {dataset_value}: {dataset_codebook_description}"
 
+    # with the projection switched on, draw the bands of simulated values after each country's latest data, and
+    # explain them, or why there are none
+    if projection_value:
+        dataset_def += f" {add_projection_bands(fig, dataset_value, country_value)}"
+
     return fig, None, None, dataset_def
 
+
+def hex_to_rgba(color, opacity):
+    """
+    Takes a hex color and an opacity, returns the color as an rgba string
+    :param color: color as '#rrggbb'
+    :param opacity: opacity from 0 to 1
+    :return: 'rgba(r, g, b, opacity)'
+    """
+    red, green, blue = (int(color.lstrip('#')[i:i + 2], 16) for i in (0, 2, 4))
+
+    return f"rgba({red}, {green}, {blue}, {opacity})"
+
+
+@tr.traced('figure')
+def add_projection_bands(fig, dataset_value, country_value):
+    """
+    Takes the timeseries figure, the selected dataset and countries, and adds the projection of every country to the
+    figure, as percentile bands and a dashed median in the color of the country's line
+
+    :param fig: figure drawn by update_timeseries_plot
+    :param dataset_value: selected dataset
+    :param country_value: selected country, or list of countries
+    :return: str explaining the projection drawn, or why no country could be projected
+    """
+    try:
+        projection_df = pj.project_column(dataset_value, PROJECTION_YEAR)
+    except ValueError as error:
+        # e.g. a column that isn't numeric, or depends on the selected countries
+        return f"No projection: {error}."
+
+    colors = {trace.name: trace.line.color for trace in fig.data}
+    projected_countries = projection_df.index.get_level_values('country')
+    countries = [country for country in (country_value if isinstance(country_value, list) else [country_value])
+                 if country in projected_countries]
+    for country in countries:
+        country_projection = projection_df.loc[country]
+        years = country_projection.index
+        color = colors.get(country) or '#A4C9D7'
+
+        # every band is its upper edge, then its lower edge filled up to it
+        for lower, upper, opacity in PROJECTION_BANDS:
+            fig.add_trace(go.Scatter(x=years, y=country_projection[upper], mode='lines', line={'width': 0},
+                                     legendgroup=country, showlegend=False, hoverinfo='skip'))
+            fig.add_trace(go.Scatter(x=years, y=country_projection[lower], mode='lines', line={'width': 0},
+                                     fill='tonexty', fillcolor=hex_to_rgba(color, opacity), legendgroup=country,
+                                     showlegend=False, hoverinfo='skip'))
+        fig.add_trace(go.Scatter(x=years, y=country_projection['p50'], mode='lines', name=f"{country} projection",
+                                 line={'color': color, 'dash': 'dash'}, legendgroup=country))
+
+    if not countries:
+        return f"No projection: none of the selected countries has {pj.MIN_HISTORY_YEARS} years of growth of " \
+               f"{dataset_value} before {PROJECTION_YEAR}."
+
+    return f"Dashed lines continue each country's median trend to {PROJECTION_YEAR}, with bands holding 50% and 90% " \
+           f"of {pj.N_PATHS} paths simulated from its growth over its last {pj.HISTORY_YEARS} years of data."
+
@@ -0,0 +1,233 @@
+import numpy as np
+import dash
+from dash import html, dcc, Input, Output, callback
+import dash_bootstrap_components as dbc
+import plotly.express as px
+from download_data import dataset_version
+from cache import memoize
+import correlation as cr
+import derived_columns as dc
+import page_data as pg
+import tracing as tr
+
+dash.register_page(__name__, order=5)
+
+# Palette:
+# #002B36 - dark blue
+# #A4C9D7 - light blue
+# #D07C2E - orange
+# #F1F1E6 - gray
+
+# datasets shown when the page is first opened, where they're in the data set
+DEFAULT_DATASETS = ['population', 'gdp', 'co2', 'co2_per_capita', 'primary_energy_consumption', 'energy_per_capita',
+                    'methane', 'share_global_co2']
+
+# more groups than this don't fit on the page side by side
+MAX_GROUPS = 6
+
+# Build sidebar
+corr_sidebar_style = \
+    {
+        "position": "relative",
+        "top": 0,
+        "left": 0,
+        "bottom": 0,
+        "padding": "1rem 1rem",
+        # "background-color": "#002b36",
+        # "color": "#D07C2E",
+    }
+
+
+def build_corr_sidebar():
+    return dbc.Container(
+        [
+            html.H2("Filters"),
+            html.Hr(),
+            dbc.Nav(
+                [
+                    html.P(
+                        "Datasets", className="lead"
+                    ),
+                    dcc.Dropdown(
+                        pg.dropdown_options(),
+                        initial_dataset_selection(),
+                        multi=True,
+                        id='corr-dataset-selector',
+                        placeholder='Select two or more datasets...'
+                    ),
+                    html.P(children="", style={'font-weight': 'bold', 'font-style': 'italics'},
+                           id='corr-dataset-error-display'),
+                    html.P(
+                        "Method", className="lead"
+                    ),
+                    dcc.RadioItems(
+                        [{'label': ' Pearson', 'value': 'pearson'}, {'label': ' Spearman (rank)', 'value': 'spearman'}],
+                        'pearson',
+                        id='corr-method-selector',
+                        labelStyle={'display': 'block'}
+                    ),
+                    html.Br(),
+                    html.P(
+                        "Grouping", className="lead"
+                    ),
+                    dcc.Dropdown(
+                        pg.dropdown_options(),
+                        id='corr-grouping-selector',
+                        placeholder='Group countries by (optional)...',
+                    ),
+                    html.Br(),
+                    dbc.Input(placeholder='Number of groups', id='corr-n-groups-input'),
+                    html.P(children="", style={'font-weight': 'bold', 'font-style': 'italics'},
+                           id='corr-grouping-error-display'),
+                    html.A("Dataset definitions",
+                           href='https://github.com/owid/co2-data/blob/master/owid-co2-codebook.csv',
+                           target="_blank")
+                ],
+                vertical=True,
+                pills=True
+            ),
+        ],
+        style=corr_sidebar_style,
+        fluid=True
+    )
+
+
+# Create page layout, built once per dataset version with the initial heatmap already drawn
+@memoize
+def build_layout():
+    initial_figure, _, _, initial_explainer = initial_correlation_plot()
+
+    return dbc.Container(
+        [
+            dbc.Row(
+                [
+                    dbc.Col(
+                        dbc.Card(
+                            dbc.CardBody(
+                                build_corr_sidebar(), style={'margin-left': '-20px', 'margin-right': '-20px'}
+                            )
+                        ),
+                        width=3
+                    ),
+                    dbc.Col(
+                        [
+                            html.H2(style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '1rem',
+                                           'color': '#D07C2E', 'font-weight': 'bold'},
+                                    children='Correlate'),
+                            html.P(style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '7px',
+                                          'color': '#D07C2E', 'font-style': 'italics'},
+                                   children=
+                                   '''
+                                   Find out how economic development, population, energy use, and emissions move
+                                   together across countries, and whether those relationships differ between groups
+                                   of countries (e.g., the poorest and richest quartiles by gdp).
+                                   '''),
+                            html.Hr(),
+                            dcc.Graph(
+                                figure=initial_figure,
+                                id='corr-plot'
+                            ),
+                            dcc.Slider(
+                                *pg.year_range(),
+                                step=None,
+                                value=pg.year_range()[1],
+                                marks=pg.year_marks(),
+                                id='corr-year-slider'
+                            ),
+                            html.A(initial_explainer, id='corr-explainer')
+                        ],
+                        width=9
+                    )
+                ]
+            )
+        ],
+        fluid=True,
+        class_name="g-0"
+    )
+
+
+def layout(**kwargs):
+    return build_layout()
+
+
+@memoize
+def initial_dataset_selection():
+    return [col for col in DEFAULT_DATASETS if col in pg.dataset_options()]
+
+
+@memoize(persist_results=True, inputs=lambda: (initial_dataset_selection(), None))
+def initial_correlation_plot():
+    return update_correlation_plot(pg.year_range()[1], initial_dataset_selection(), 'pearson', None, None)
+
+
+# Callback to update the heatmap with changes to dropdown selections or slider adjustments
+@callback(
+    Output('corr-plot', 'figure'),
+    Output('corr-dataset-error-display', 'children'),
+    Output('corr-grouping-error-display', 'children'),
+    Output('corr-explainer', 'children'),
+    Input('corr-year-slider', 'value'),
+    Input('corr-dataset-selector', 'value'),
+    Input('corr-method-selector', 'value'),
+    Input('corr-grouping-selector', 'value'),
+    Input('corr-n-groups-input', 'value'),
+    prevent_initial_call=True)
+@tr.traced('callback')
+def update_correlation_plot(selected_year, dataset_value, method_value, grouping_value, n_groups_value):
+    # check if fewer than two datasets are selected, return an error and don't update dashboard
+    if not dataset_value or len(dataset_value) < 2:
+        return dash.no_update, html.P('Please select two or more datasets.', style={
+            'font-weight': 'bold', 'font-style': 'italics', 'color': '#D07C2E'}), dash.no_update, dash.no_update
+
+    # the selected datasets and grouping that are derived columns, which are added to the correlated columns
+    derived_columns = tuple(sorted(col for col in set(dataset_value + [grouping_value]) if dc.is_derived(col)))
+
+    explainer = f"* {method_value.capitalize()} correlation of each pair of datasets across the countries with data " \
+                f"for both in {selected_year}."
+
+    # without grouping, take the year's matrix from the correlations of all years
+    if not grouping_value:
+        matrix = cr.correlations_by_year(method_value, derived_columns).loc[selected_year].loc[dataset_value, dataset_value]
+        with tr.span('px.imshow', 'figure'):
+            fig = px.imshow(matrix.to_numpy(), x=dataset_value, y=dataset_value, zmin=-1, zmax=1,
+                            color_continuous_scale='RdBu_r', text_auto='.2f', aspect='auto')
+
+    # with grouping, draw the matrix of every group side by side
+    else:
+        # check if the number of groups is a whole number within the limits, return an error if it isn't
+        try:
+            number_of_groups = int(n_groups_value)
+        except (TypeError, ValueError):
+            number_of_groups = 0
+        if not 2 <= number_of_groups <= MAX_GROUPS:
+            return dash.no_update, None, html.P(f'Please enter a number of groups from 2 to {MAX_GROUPS}.', style={
+                'font-weight': 'bold', 'font-style': 'italics', 'color': '#D07C2E'}), dash.no_update
+
+        # check if the countries can be divided into the groups, e.g. the grouping dataset has no data for the year
+        try:
+            grouped_correlations = cr.correlations_by_group(selected_year, grouping_value, number_of_groups,
+                                                            method_value, derived_columns=derived_columns)
+        except (ValueError, IndexError):
+            return dash.no_update, None, html.P(f'{grouping_value} has too little data in {selected_year} to form '
+                                                f'{number_of_groups} groups.', style={
+                'font-weight': 'bold', 'font-style': 'italics', 'color': '#D07C2E'}), dash.no_update
+
+        matrices = np.stack([grouped_correlations.loc[group].loc[dataset_value, dataset_value].to_numpy()
+                             for group in range(1, number_of_groups + 1)])
+        with tr.span('px.imshow', 'figure'):
+            fig = px.imshow(matrices, facet_col=0, facet_col_wrap=min(number_of_groups, 3), x=dataset_value,
+                            y=dataset_value, zmin=-1, zmax=1, color_continuous_scale='RdBu_r', text_auto='.1f')
+        fig.for_each_annotation(lambda annotation: annotation.update(
+            text=f"{grouping_value} group {int(annotation.text.split('=')[1]) + 1}", font=dict(color='#839496')))
+
+        grouping_codebook_description = pg.column_description(grouping_value)
+        explainer = f"{explainer} Countries are divided into {number_of_groups} groups from lowest (1) to highest " \
+                    f"{grouping_value} ({grouping_codebook_description})."
+
+    fig.update_layout(meta={'dataset_version': dataset_version},
+                      transition_duration=100, plot_bgcolor= "#002b36", paper_bgcolor="#1e434a",
+                      coloraxis_colorbar=dict(tickfont=dict(color='#839496')))
+    fig.update_xaxes(tickfont=dict(color='#839496'))
+    fig.update_yaxes(tickfont=dict(color='#839496'))
+
+    return fig, None, None, explainer
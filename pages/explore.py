@@ -2,7 +2,12 @@ import dash
 from dash import html, dcc, Input, Output, callback, dash_table
 import dash_bootstrap_components as dbc
 import plotly.express as px
-from download_data import co2_data_countries, codebook
+from download_data import co2_data_countries
+from cache import memoize
+import bitmap_index as bi
+import derived_columns as dc
+import page_data as pg
+import tracing as tr
 import utils as u
 
 dash.register_page(__name__, order=4)
@@ -14,16 +19,6 @@ dash.register_page(__name__, order=4)
 # #F1F1E6 - gray
 
 
-initial_dataset_selection = co2_data_countries.columns[:5]
-initial_country_selection = co2_data_countries.country.unique()[:5]
-initial_dataset_selection = initial_dataset_selection.append(co2_data_countries[['co2', 'co2_per_capita']].columns)
-initial_year_range = list(range(co2_data_countries['year'].max() - 20, co2_data_countries['year'].max()))
-table_columns = []
-for col in initial_dataset_selection:
-    table_columns.append({"name": str(col), "id": str(col)})
-table_data = co2_data_countries[co2_data_countries['year'].isin(initial_year_range) &
-                                co2_data_countries['country'].isin(initial_country_selection)].to_dict('records')
-
 explore_sidebar_style = \
     {
         "position": "relative",
@@ -35,8 +30,9 @@ explore_sidebar_style = \
         # "color": "#D07C2E",
     }
 
-explore_sidebar = \
-    dbc.Container(
+
+def build_explore_sidebar():
+    return dbc.Container(
         [
             html.H2("Filters"),
             html.Hr(),
@@ -46,8 +42,8 @@ explore_sidebar = \
                         "Countries", className="lead"
                     ),
                     dcc.Dropdown(
-                        co2_data_countries.country.unique(),
-                        co2_data_countries.country.unique()[:5],
+                        pg.country_options(),
+                        pg.country_options()[:5],
                         id='explore-country-selector',
                         placeholder='Please select a country',
                         multi=True
@@ -58,8 +54,8 @@ explore_sidebar = \
                         "Datasets", className="lead"
                     ),
                     dcc.Dropdown(
-                        co2_data_countries.columns,
-                        initial_dataset_selection,
+                        pg.column_options() + pg.derived_options(),
+                        initial_dataset_selection(),
                         multi=True,
                         id='explore-dataset-selector',
                         placeholder='All datasets selected'
@@ -78,73 +74,91 @@ explore_sidebar = \
         fluid=True
     )
 
-layout = dbc.Container(
-    [
-        dbc.Row(
-            [
-                dbc.Col(
-                    dbc.Card(
-                        dbc.CardBody(
-                            explore_sidebar, style={'margin-left': '-20px', 'margin-right': '-20px'}
-                        )
-                    ),
-                    width=3
-                ),
-                dbc.Col(
-                    [
-                        html.H2(
-                            style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '1rem', 'color': '#D07C2E',
-                                   'font-weight': 'bold'},
-                            children='Explore'),
-                        html.P(
-                            style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '7px', 'color': '#D07C2E',
-                                   'font-style': 'italics'},
-                            children=
-                            '''
-                       Explore the full dataset to dive into countries' GHG emissions and 
-                       how they are influenced by various characteristics
-                       '''
-                        ),
-                        html.Hr(),
-                        dcc.RangeSlider(
-                            co2_data_countries['year'].min(),
-                            co2_data_countries['year'].max(),
-                            step=None,
-                            value=[co2_data_countries['year'].max() - 20, co2_data_countries['year'].max()],
-                            marks={str(year): str(year) for year in co2_data_countries['year'].unique()
-                                   if year % 10 == 0},
-                            allowCross=True,
-                            included=True,
-                            id='explore-year-slider'
+# Create page layout, built once per dataset version with the initial table already filled
+@memoize
+def build_layout():
+    table_data, table_columns, _, _ = initial_explore_table()
+
+    return dbc.Container(
+        [
+            dbc.Row(
+                [
+                    dbc.Col(
+                        dbc.Card(
+                            dbc.CardBody(
+                                build_explore_sidebar(), style={'margin-left': '-20px', 'margin-right': '-20px'}
+                            )
                         ),
-                        dash_table.DataTable(data=table_data, columns=table_columns,
-                                             style_header={
-                                                 'backgroundColor': '#002B36',
-                                                 'color': 'white',
-                                                 'border': '1px solid #A4C9D7'
-                                             },
-                                             style_data={
-                                                 'backgroundColor': '#A4C9D7',
-                                                 'color': 'black',
-                                                 'border': '1px solid #002B36'
-                                             },
-                                             style_cell={'textAlign': 'right'},
-                                             style_cell_conditional=[
-                                                 {
-                                                     'if': {'column_id': ['country', 'year', 'iso_code']},
-                                                     'textAlign': 'left'
-                                                 }
-                                             ],
-                                             id='explore-table')
-                    ],
-                    width=9
-                )
-            ]
-        )
-    ],
-    fluid=True,
-    class_name="g-0"
-)
+                        width=3
+                    ),
+                    dbc.Col(
+                        [
+                            html.H2(
+                                style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '1rem', 'color': '#D07C2E',
+                                       'font-weight': 'bold'},
+                                children='Explore'),
+                            html.P(
+                                style={'textAlign': 'left', 'margin-left': '7px', 'margin-top': '7px', 'color': '#D07C2E',
+                                       'font-style': 'italics'},
+                                children=
+                                '''
+                           Explore the full dataset to dive into countries' GHG emissions and 
+                           how they are influenced by various characteristics
+                           '''
+                            ),
+                            html.Hr(),
+                            dcc.RangeSlider(
+                                *pg.year_range(),
+                                step=None,
+                                value=[pg.year_range()[1] - 20, pg.year_range()[1]],
+                                marks=pg.year_marks(),
+                                allowCross=True,
+                                included=True,
+                                id='explore-year-slider'
+                            ),
+                            dash_table.DataTable(data=table_data, columns=table_columns,
+                                                 style_header={
+                                                     'backgroundColor': '#002B36',
+                                                     'color': 'white',
+                                                     'border': '1px solid #A4C9D7'
+                                                 },
+                                                 style_data={
+                                                     'backgroundColor': '#A4C9D7',
+                                                     'color': 'black',
+                                                     'border': '1px solid #002B36'
+                                                 },
+                                                 style_cell={'textAlign': 'right'},
+                                                 style_cell_conditional=[
+                                                     {
+                                                         'if': {'column_id': ['country', 'year', 'iso_code']},
+                                                         'textAlign': 'left'
+                                                     }
+                                                 ],
+                                                 id='explore-table')
+                        ],
+                        width=9
+                    )
+                ]
+            )
+        ],
+        fluid=True,
+        class_name="g-0"
+    )
+
+
+def layout(**kwargs):
+    return build_layout()
+
+
+@memoize
+def initial_dataset_selection():
+    return pg.column_options()[:5] + ['co2', 'co2_per_capita']
+
+
+@memoize(persist_results=True, inputs=lambda: (initial_dataset_selection(), pg.country_options()[:5]))
+def initial_explore_table():
+    return update_explore_table([pg.year_range()[1] - 20, pg.year_range()[1]], pg.country_options()[:5],
+                                initial_dataset_selection())
 
 
 @callback(
@@ -155,6 +169,7 @@ layout = dbc.Container(
     Input('explore-year-slider', 'value'),
     Input('explore-country-selector', 'value'),
     Input('explore-dataset-selector', 'value'), config_prevent_initial_callbacks=True)
+@tr.traced('callback')
 def update_explore_table(year_range, country_value, dataset_value):
     # check if no countries provided, return an error
     if not country_value:
@@ -164,13 +179,11 @@ def update_explore_table(year_range, country_value, dataset_value):
     if not dataset_value:
         dataset_value = co2_data_countries.columns
 
-    # check if more than one country has been passed
-    if isinstance(country_value, list):
-        # if country-selector value is a list, there is more than one country selected, then .isin() should be used
-        selected_country_df = co2_data_countries[co2_data_countries['country'].isin(country_value)]
-    else:
-        # if it's not a list, only one country is selected, which means we should use boolean comparison to select
-        selected_country_df = co2_data_countries[co2_data_countries['country'] == country_value]
+    # select the rows of the country, or list of countries, from the bitmap index
+    selected_country_df = bi.select_countries(country_value)
+
+    # add the selected datasets that are derived columns, computed for the selected countries
+    selected_country_df = dc.with_derived_columns(selected_country_df, list(dataset_value))
 
     # use the utils function to find the data for only the selected countries and years
     df = u.find_all_data_for_year_range(selected_country_df, year_range[0], year_range[1])
@@ -180,7 +193,8 @@ def update_explore_table(year_range, country_value, dataset_value):
     columns = []
     for column in df.columns:
         columns.append({"name": str(column), "id": str(column)})
-    table = df.to_dict('records')
+    with tr.span('DataFrame.to_dict', 'serialize'):
+        table = df.to_dict('records')
 
     # access codebook for full description of selected dataset to be updated under scatter plot
     # dataset_codebook_description = codebook.loc[codebook['column'] == dataset_value]['description'].values[0]
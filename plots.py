@@ -1,14 +1,16 @@
 import pandas as pd
 import numpy as np
 from matplotlib import pyplot as plt
-import requests
 from download_data import co2_data_regions, co2_data_countries
 import summary_growth as sg
 import utils as u
 import growth_analysis as ga
 
+# Every plot draws on the figure passed as fig. If no figure is passed, a new pyplot figure is created and shown, so the
+# functions can be used interactively. batch_render.py passes its own figures to render the plots headless and in bulk.
 
-def group_boxplot(original_data, year, column_to_group, number_of_groups, column_to_plot):
+
+def group_boxplot(original_data, year, column_to_group, number_of_groups, column_to_plot, fig=None):
     """
     Takes a year of data, groups countries based on percentiles in a certain column's values, and draws boxplots of
     each group's values in a (potentially different) column.
@@ -17,27 +19,34 @@ def group_boxplot(original_data, year, column_to_group, number_of_groups, column
     :param column_to_group:
     :param number_of_groups:
     :param column_to_plot:
-    :return:
+    :param fig: matplotlib figure to draw on, if None a new figure is created and shown
+    :return: the figure
     """
+    show = fig is None
+    if show:
+        fig = plt.figure()
+
     # create df with a column denoting group for chosen column
     grouped_df, group_column_name = u.divide_data_into_groups_for_year(original_data, year, column_to_group,
                                                                        number_of_groups)
 
     # create a plot with n= number_of_groups subplots
-    fig, axes = plt.subplots(ncols=number_of_groups, sharey=True)
+    axes = fig.subplots(ncols=number_of_groups, sharey=True, squeeze=False)[0]
     fig.subplots_adjust(wspace=0)
 
     for ax, group in zip(axes, range(1, number_of_groups + 1)):
-        print(group, grouped_df[grouped_df[group_column_name] == group][column_to_plot])
-        ax.boxplot(grouped_df[grouped_df[group_column_name] == group][column_to_plot],
+        ax.boxplot(grouped_df[grouped_df[group_column_name] == group][column_to_plot].dropna(),
                    showfliers=False)
         ax.set(xlabel=group)
 
-    plt.show()
+    if show:
+        plt.show()
+
+    return fig
 
 
 def plot_grouped_descriptive_stats(original_data, year, column_to_group, number_of_groups,
-                                   column_to_summarize, stat_to_plot):
+                                   column_to_summarize, stat_to_plot, fig=None):
     """
     Takes a year from original data, groups countries by percentiles of a chosen column,
     and plots a chosen descriptive statistic for each group for a (potentially different) chosen column
@@ -50,8 +59,13 @@ def plot_grouped_descriptive_stats(original_data, year, column_to_group, number_
     :param column_to_group:
     :param number_of_groups:
     :param column_to_summarize:
-    :return:
+    :param fig: matplotlib figure to draw on, if None a new figure is created and shown
+    :return: the figure
     """
+    show = fig is None
+    if show:
+        fig = plt.figure()
+
     # generate descriptive stat dictionary
     descriptive_stat_dictionary = u.find_summary_statistics_per_group(original_data, year, column_to_group,
                                                                     number_of_groups, column_to_summarize)
@@ -62,11 +76,16 @@ def plot_grouped_descriptive_stats(original_data, year, column_to_group, number_
         chosen_stat_dict[group] = descriptive_stat_dictionary[group][stat_to_plot]
 
     # plot the dictionary by sorting items into tuples, unpacking and unzipping their elements
-    plt.plot(*zip(*sorted(chosen_stat_dict.items())))
-    plt.show()
+    ax = fig.subplots()
+    ax.plot(*zip(*sorted(chosen_stat_dict.items())))
+
+    if show:
+        plt.show()
+
+    return fig
 
 
-def plot_pct_of_total(original_data, year, column_to_group, number_of_groups, pct_of_total_column):
+def plot_pct_of_total(original_data, year, column_to_group, number_of_groups, pct_of_total_column, fig=None):
     """
     Takes a year from original data, groups countries by percentiles of a chosen column,
     and plots the contribution of each group to the total of a (potentially different) chosen column
@@ -75,22 +94,32 @@ def plot_pct_of_total(original_data, year, column_to_group, number_of_groups, pc
     :param column_to_group:
     :param number_of_groups:
     :param pct_of_total_column:
-    :return:
+    :param fig: matplotlib figure to draw on, if None a new figure is created and shown
+    :return: the figure
     """
+    show = fig is None
+    if show:
+        fig = plt.figure()
+
     # generate pct_of_total dictionary
     pct_of_total_dict = u.group_pct_of_total(original_data, year, column_to_group, number_of_groups, pct_of_total_column)
 
     # plot the dictionary by sorting items into tuples, unpacking and unzipping their elements
-    plt.scatter(*zip(*sorted(pct_of_total_dict.items())))
-    plt.xlabel(str(column_to_group) + " group")
-    plt.ylabel("% of total " + str(pct_of_total_column))
-    plt.xticks(range(1, number_of_groups + 1))
-    plt.show()
+    ax = fig.subplots()
+    ax.scatter(*zip(*sorted(pct_of_total_dict.items())))
+    ax.set_xlabel(str(column_to_group) + " group")
+    ax.set_ylabel("% of total " + str(pct_of_total_column))
+    ax.set_xticks(range(1, number_of_groups + 1))
+
+    if show:
+        plt.show()
+
+    return fig
 
 
 
 # ------------- MULTIPLIER-SPECIFIC PLOTS ----------------
-def grouped_mean_multiplier_bar_chart(original_data, mult_columns, number_of_groups):
+def grouped_mean_multiplier_bar_chart(original_data, mult_columns, number_of_groups, fig=None):
     """
     Takes the full data set, chosen columns, and desired number of groups of growth rates, and returns a bar chart
     visualizing the mean multiplier of column growth rates for each group
@@ -99,30 +128,46 @@ def grouped_mean_multiplier_bar_chart(original_data, mult_columns, number_of_gro
     :param mult_columns: the names of the columns for which you want to calculate the mean growth rate multiplier
     :param number_of_groups: the number of groups you want to split the data into. The set will be divided into chosen
      number of groups using the number_of_groups - 1 quantiles of the growth rates of the first passed column
-    :return: bar chart of the mean multiplier for each equal group of sorted growth rates of first passed column
+    :param fig: matplotlib figure to draw on, if None a new figure is created and shown
+    :return: bar chart of the mean multiplier for each equal group of sorted growth rates of first passed column, with
+    error bars of its bootstrap confidence interval
     """
+    show = fig is None
+    if show:
+        fig = plt.figure()
 
-    # find the mean multiplier of each group
-    mean_multiplier_dict = ga.find_grouped_mean_multiplier(original_data, mult_columns, number_of_groups)
+    # find the mean multiplier of each group, and its confidence interval
+    intervals_df = ga.find_grouped_multiplier_intervals(original_data, mult_columns, number_of_groups)
 
-    # plot the dictionary items
+    # plot the means, with error bars from each mean to the ends of its interval
+    ax = fig.subplots()
+    ax.bar(intervals_df.index, intervals_df['mean'],
+           yerr=[intervals_df['mean'] - intervals_df['mean lower'], intervals_df['mean upper'] - intervals_df['mean']],
+           capsize=4)
+    # ax.set_title(result_text)
+    ax.set_xlabel(str(mult_columns[0]) + ' Growth Rate Group')
+    ax.set_ylabel('Mean Multiplier between ' + str(mult_columns[0]) + ' Growth Rate and '
+                  + str(mult_columns[1]) + ' Growth Rate')
 
-    plt.bar(*zip(*mean_multiplier_dict.items()))
-    # plt.title(result_text)
-    plt.xlabel(str(mult_columns[0]) + ' Growth Rate Group')
-    plt.ylabel('Mean Multiplier between ' + str(mult_columns[0]) + ' Growth Rate and '
-               + str(mult_columns[1]) + ' Growth Rate')
-    plt.show()
+    if show:
+        plt.show()
 
+    return fig
 
-def grouped_multiplier_boxplot(original_data, mult_columns, number_of_groups):
+
+def grouped_multiplier_boxplot(original_data, mult_columns, number_of_groups, fig=None):
     """
 
     :param original_data:
     :param mult_columns:
     :param number_of_groups:
-    :return:
+    :param fig: matplotlib figure to draw on, if None a new figure is created and shown
+    :return: the figure
     """
+    show = fig is None
+    if show:
+        fig = plt.figure()
+
     # create df with the growth rate multipliers and groups the countries belong to
     grouped_multiplier_df = ga.grouped_growth_rate_multipliers(original_data, mult_columns, number_of_groups)
 
@@ -135,16 +180,18 @@ def grouped_multiplier_boxplot(original_data, mult_columns, number_of_groups):
     #    df_group_name_dict[group] = grouped_multiplier_df[grouped_multiplier_df['Growth Rate Group'] == group]
 
     # create a plot with n= number_of_groups subplots
-    fig, axes = plt.subplots(ncols=number_of_groups, sharey=True)
+    axes = fig.subplots(ncols=number_of_groups, sharey=True, squeeze=False)[0]
     fig.subplots_adjust(wspace=0)
 
     for ax, group in zip(axes, range(1, number_of_groups+1)):
-        ax.boxplot(grouped_multiplier_df[grouped_multiplier_df['Growth Rate Group'] == group][mult_col_name],
+        ax.boxplot(grouped_multiplier_df[grouped_multiplier_df['Growth Rate Group'] == group][mult_col_name].dropna(),
                    showfliers=True)
         ax.set(xlabel=group)
 
 
     # show a box plot that summarizes multipliers for each group
     # plt.boxplot(x='Growth Rate Groups', y=mult_col_name, data=grouped_multiplier_df)
-    plt.show()
+    if show:
+        plt.show()
 
+    return fig
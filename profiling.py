@@ -0,0 +1,231 @@
+"""
+On-demand profiling of Dash callback requests, to find out why a particular selection is slow in production.
+
+With CO2_PROFILE_TOKEN set, a request carrying the token arms the worker answering it to profile its next callback
+requests, with either:
+    - the headers X-Profile-Token: <token> and optionally X-Profile-Count: <n>, e.g. on a callback request, which is
+      then the first one profiled
+    - the query flags ?profile=<token>[&profile_count=<n>], e.g. on a page, to profile the callbacks it fires on load
+n defaults to 1 and is at most MAX_PROFILED_CALLBACKS.
+
+Every armed callback request is run under cProfile and written to CO2_PROFILE_DIR (profiles/ by default) as:
+    <time>-<pid>-<n>-<output>.callgrind     the profile in callgrind format, for KCachegrind/QCachegrind or speedscope
+    <time>-<pid>-<n>-<output>.prof          the pstats dump, for python -m pstats or snakeviz
+    <time>-<pid>-<n>-<output>.json          the callback's outputs and inputs, its duration, the dataset version, and
+                                            the functions with the most own time
+where n counts the profiles of the worker and output is the callback's first output.
+Profiled requests are answered one at a time, since cProfile would otherwise also see the functions of the requests
+running next to it in the other threads.
+
+Every worker is a separate process, so a request only arms the worker that answered it, and background callbacks (see
+jobs.py) run in the job manager's processes, where they aren't profiled.
+"""
+import cProfile
+import hmac
+import json
+import os
+import pstats
+import re
+import threading
+import time
+
+import flask
+
+import download_data as dd
+
+# most callback requests a single request can arm the profiler for
+MAX_PROFILED_CALLBACKS = 50
+
+# number of functions listed in the json summary of a profile
+SUMMARY_FUNCTIONS = 25
+
+# number of callback requests this worker is still armed for, and has profiled
+_armed_count = 0
+_profiled_count = 0
+_armed_lock = threading.Lock()
+_profile_lock = threading.Lock()
+
+
+def requested_count():
+    """
+    Returns the number of callback requests the current request arms the profiler for, 0 without a valid token
+    :return: int
+    """
+    token = flask.request.headers.get('X-Profile-Token') or flask.request.args.get('profile')
+    if not token or not hmac.compare_digest(token.encode('utf-8'), os.environ['CO2_PROFILE_TOKEN'].encode('utf-8')):
+        return 0
+
+    count = flask.request.headers.get('X-Profile-Count') or flask.request.args.get('profile_count') or '1'
+    try:
+        return min(max(int(count), 1), MAX_PROFILED_CALLBACKS)
+    except ValueError:
+        return 1
+
+
+def take_armed():
+    """
+    Returns whether this worker is armed for another callback request, and counts that request if so
+    :return: bool
+    """
+    global _armed_count, _profiled_count
+    with _armed_lock:
+        if _armed_count <= 0:
+            return False
+        _armed_count -= 1
+        _profiled_count += 1
+        flask.g.profile_number = _profiled_count
+
+    return True
+
+
+def is_callback_request():
+    return flask.request.path.endswith('/_dash-update-component') and flask.request.method == 'POST'
+
+
+def start_profile():
+    """
+    Registered as a before_request hook, arms the profiler for a request carrying the token, and starts profiling an
+    armed callback request
+    :return: None
+    """
+    global _armed_count
+    count = requested_count()
+    if count:
+        with _armed_lock:
+            _armed_count = max(_armed_count, count)
+
+    if not is_callback_request() or not take_armed():
+        return
+
+    _profile_lock.acquire()
+    flask.g.profile_locked = True
+    flask.g.profile = cProfile.Profile()
+    flask.g.profile_start = time.perf_counter()
+    flask.g.profile.enable()
+
+
+def stop_profile(response):
+    """
+    Registered as an after_request hook, stops profiling a callback request and writes its profile
+    :param response: flask.Response
+    :return: the response, unchanged
+    """
+    profile = flask.g.pop('profile', None)
+    if profile is None:
+        return response
+
+    profile.disable()
+    seconds = time.perf_counter() - flask.g.pop('profile_start')
+    body = flask.request.get_json(silent=True) or {}
+    write_profile(profile, {
+        'output': body.get('output', 'unknown'),
+        'inputs': body.get('inputs', []),
+        'state': body.get('state', []),
+        'number': flask.g.pop('profile_number'),
+        'status': response.status_code,
+        'seconds': seconds,
+        'pid': os.getpid(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'dataset_version': dd.dataset_version,
+    })
+
+    return response
+
+
+def release_profile(exception):
+    """
+    Registered as a teardown_request hook, lets the next callback request be profiled, also after an error
+    :param exception: exception raised while handling the request, if any
+    :return: None
+    """
+    profile = flask.g.pop('profile', None)
+    if profile is not None:
+        profile.disable()
+    if flask.g.pop('profile_locked', False):
+        _profile_lock.release()
+
+
+def function_label(function):
+    """
+    Takes a pstats function key, returns it as 'file:line(name)'
+    :param function: tuple of (file, line, name)
+    :return: str
+    """
+    file_name, line, name = function
+
+    return f"{file_name}:{line}({name})"
+
+
+def write_callgrind(stats, path):
+    """
+    Takes profile stats and writes them to a file in callgrind format, with times in microseconds
+
+    pstats records every function's callers, callgrind every function's callees, so the call edges are inverted.
+    :param stats: pstats.Stats of the profile
+    :param path: path of the file
+    :return: None
+    """
+    # {caller : [(callee, calls, inclusive seconds of the callee in these calls)]}
+    callees = {}
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        for caller, (calls, _, _, inclusive_seconds) in callers.items():
+            callees.setdefault(caller, []).append((function, calls, inclusive_seconds))
+
+    lines = ['# callgrind format', 'version: 1', 'creator: co2 profiling.py', 'positions: line',
+             'events: Microseconds', '']
+    for function, (_, _, own_seconds, _, _) in stats.stats.items():
+        file_name, line, name = function
+        lines += [f"fl={file_name}", f"fn={name}:{line}", f"{line} {round(own_seconds * 1e6)}"]
+        for (callee_file, callee_line, callee_name), calls, inclusive_seconds in callees.get(function, []):
+            lines += [f"cfl={callee_file}", f"cfn={callee_name}:{callee_line}", f"calls={calls} {callee_line}",
+                      f"{line} {round(inclusive_seconds * 1e6)}"]
+        lines.append('')
+
+    with open(path, 'w') as callgrind_file:
+        callgrind_file.write('\n'.join(lines))
+
+
+def write_profile(profile, metadata):
+    """
+    Takes the profile of a callback request and its metadata, writes the profile files to CO2_PROFILE_DIR
+    :param profile: cProfile.Profile, disabled
+    :param metadata: dict describing the request, which can be serialized to json
+    :return: path of the files, without extension
+    """
+    directory = os.environ.get('CO2_PROFILE_DIR', 'profiles')
+    os.makedirs(directory, exist_ok=True)
+
+    # name the files after the time, the worker and its count of profiles, and the callback's first output, e.g.
+    # compare-timeseries-plot.figure for ..compare-timeseries-plot.figure...compare-country-error-display.children..
+    output_name = re.sub(r'[^A-Za-z0-9_.-]+', '-', metadata['output'].strip('.').split('...')[0])[:80]
+    path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{metadata['number']}-"
+                                   f"{output_name}")
+
+    stats = pstats.Stats(profile)
+    stats.dump_stats(path + '.prof')
+    write_callgrind(stats, path + '.callgrind')
+
+    # list the functions taking the most time themselves, e.g. a pandas operation or the figure build
+    slowest = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:SUMMARY_FUNCTIONS]
+    summary = {**metadata, 'functions': [{'function': function_label(function), 'calls': calls,
+                                          'own_seconds': own_seconds, 'cumulative_seconds': cumulative_seconds}
+                                         for function, (_, calls, own_seconds, cumulative_seconds, _) in slowest]}
+    with open(path + '.json', 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2, default=str)
+
+    return path
+
+
+def register(server):
+    """
+    Takes the Flask server of the Dash app and registers the profiling of armed callback requests on it if
+    CO2_PROFILE_TOKEN is set
+    :param server: app.server
+    :return: None
+    """
+    if not os.environ.get('CO2_PROFILE_TOKEN'):
+        return
+
+    server.before_request(start_profile)
+    server.after_request(stop_profile)
+    server.teardown_request(release_profile)
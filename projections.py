@@ -0,0 +1,167 @@
+"""
+Monte Carlo projections of the data set's columns from their historical growth, e.g. "where will co2 be in 2050 if
+trends continue".
+
+For every country, the year-on-year growth of a column over its last HISTORY_YEARS years of data is taken from the
+country x year cube (see shared_data.py), or from the matrix of a derived column (see derived_columns.py), as log growth rates log(x[t] / x[t-1]). Those rates are the country's growth
+distribution, either fitted as a normal distribution (method='normal') or resampled as they are (method='empirical').
+Thousands of paths are then drawn for all countries at once, as a (paths, countries, years) array of growth rates whose
+cumulative sum, starting from each country's latest value, gives the simulated levels. The result is a band of
+percentiles of those levels for every country and year up to the target year.
+
+Countries are simulated in blocks of CHUNK_COUNTRIES, each with its own random generator spawned from the seed, so a
+projection only depends on its arguments: running the blocks in a process pool (workers=...) for large ensembles gives
+the same result as running them in this process.
+
+Like growth_analysis.find_multiplier, this describes past trends rather than predicting anything: the bands only show
+the spread of outcomes if each country's growth keeps behaving as it did.
+"""
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from download_data import co2_data_countries, download_key
+from cache import memoize
+import derived_columns as dc
+import shared_data as sd
+import utils as u
+
+# number of years of growth rates each country's distribution is fitted on, and the fewest it needs to be projected
+HISTORY_YEARS = 30
+MIN_HISTORY_YEARS = 10
+
+# number of simulated paths per country
+N_PATHS = 2000
+
+# percentiles of the simulated levels in every projection, the inner pairs form nested bands around the median
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# number of countries simulated together, with one random generator per block
+CHUNK_COUNTRIES = 16
+
+
+def growth_history(column_name, history_years=HISTORY_YEARS):
+    """
+    Takes a column and returns the latest value of every country and its log growth rates over the years before it
+
+    :param column_name: name of a float column of the data set, or of a derived column that doesn't depend on the
+    selected countries
+    :param history_years: number of years of growth rates to return, ending at each country's latest value
+    :return: tuple of (array of countries, latest values, years of the latest values, array of shape (countries,
+    history_years) of log growth rates, NaN where a year or the year before it has no positive value)
+    """
+    # a column's values in every year for all countries, which a column of the selected countries doesn't have
+    _, countries, years, _ = sd.country_year_cube(download_key)
+    if dc.is_derived(column_name) and dc.DERIVED_COLUMNS[column_name]['selection']:
+        raise ValueError(f"{column_name} depends on the selected countries, so it can't be projected")
+    values = dc.country_year_matrix(column_name)
+
+    # log growth between consecutive years, which needs a positive value in both
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_values = np.log(np.where(values > 0, values, np.nan))
+    log_growth = np.diff(log_values, axis=1)
+
+    # every country's latest year with data, and the growth rates of the years up to it
+    has_value = ~np.isnan(values)
+    last_positions = values.shape[1] - 1 - np.argmax(has_value[:, ::-1], axis=1)
+    has_any_value = has_value.any(axis=1)
+    window = last_positions[:, None] - np.arange(history_years)[::-1][None, :] - 1
+    history = np.take_along_axis(log_growth, np.clip(window, 0, None), axis=1)
+    history[(window < 0) | ~has_any_value[:, None]] = np.nan
+
+    latest_values = np.where(has_any_value, values[np.arange(len(values)), last_positions], np.nan)
+
+    return np.array(countries, dtype=object), latest_values, years[last_positions], history
+
+
+def simulate_block(start_values, history, steps, n_paths, seed_sequence, method, percentiles):
+    """
+    Takes a block of countries and returns the percentiles of their simulated levels in every year of the projection
+
+    :param start_values: array of shape (countries,) of the latest value of each country
+    :param history: array of shape (countries, history years) of log growth rates, NaN where missing
+    :param steps: number of years to simulate
+    :param n_paths: number of paths per country
+    :param seed_sequence: np.random.SeedSequence of the block
+    :param method: 'normal' to draw growth rates from a normal distribution fitted to the history, or 'empirical' to
+    resample the history's growth rates
+    :param percentiles: percentiles of the levels to return
+    :return: array of shape (len(percentiles), countries, steps + 1), where step 0 is the start value
+    """
+    generator = np.random.default_rng(seed_sequence)
+    n_countries = len(start_values)
+
+    if method == 'normal':
+        means = np.nanmean(history, axis=1)
+        deviations = np.nanstd(history, axis=1, ddof=1)
+        growth = generator.normal(means[None, :, None], deviations[None, :, None], (n_paths, n_countries, steps))
+    elif method == 'empirical':
+        # move every country's growth rates to the front of its row (NaN sort last), and draw positions among them
+        observed = np.sort(history, axis=1)
+        counts = np.count_nonzero(~np.isnan(history), axis=1)
+        positions = (generator.random((n_paths, n_countries, steps)) * counts[None, :, None]).astype(np.int64)
+        growth = np.take_along_axis(observed[None, :, :], positions, axis=2)
+    else:
+        raise ValueError(f"method must be 'normal' or 'empirical', not '{method}'")
+
+    # levels are the start value times the product of the growth factors, i.e. the cumulative sum of the log growth
+    log_paths = np.concatenate([np.zeros((n_paths, n_countries, 1)), np.cumsum(growth, axis=2)], axis=2)
+    log_percentiles = np.percentile(log_paths, percentiles, axis=0)
+
+    return start_values[None, :, None] * np.exp(log_percentiles)
+
+
+@memoize
+def project_column(column_name, target_year, n_paths=N_PATHS, seed=0, method='normal', percentiles=PERCENTILES,
+                   workers=None):
+    """
+    Takes a column and a target year, returns percentile bands of every country's simulated values up to that year
+
+    :param column_name: name of a float column of the data set, e.g. 'co2', or of a derived column that doesn't depend
+    on the selected countries
+    :param target_year: last year to project
+    :param n_paths: number of simulated paths per country
+    :param seed: seed of the random generators, the same arguments always give the same projection
+    :param method: 'normal' or 'empirical', see simulate_block
+    :param percentiles: tuple of percentiles to return
+    :param workers: number of processes to simulate the blocks of countries in, or None to simulate them in this
+    process
+    :return: df indexed by (country, year), from each country's latest year with data (the latest value) to
+    target_year, with a column per percentile, for the countries with at least MIN_HISTORY_YEARS growth rates
+    """
+    countries, latest_values, latest_years, history = growth_history(column_name)
+
+    # only countries with enough history, a positive latest value, and a latest year before the target are projected
+    projected = (np.count_nonzero(~np.isnan(history), axis=1) >= MIN_HISTORY_YEARS) & (latest_values > 0) & \
+        (latest_years < target_year)
+    countries, latest_values, latest_years, history = \
+        countries[projected], latest_values[projected], latest_years[projected], history[projected]
+    steps = int(target_year - latest_years.min()) if len(countries) else 0
+
+    # simulate every block of countries with its own generator
+    blocks = [slice(start, start + CHUNK_COUNTRIES) for start in range(0, len(countries), CHUNK_COUNTRIES)]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(blocks))
+    arguments = ([latest_values[block] for block in blocks], [history[block] for block in blocks],
+                 itertools.repeat(steps), itertools.repeat(n_paths), seed_sequences, itertools.repeat(method),
+                 itertools.repeat(list(percentiles)))
+    if workers:
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            bands = list(executor.map(simulate_block, *arguments))
+    else:
+        bands = list(map(simulate_block, *arguments))
+    bands = np.concatenate(bands, axis=1) if bands else np.empty((len(percentiles), 0, steps + 1))
+
+    # keep each country's steps from its latest year to the target year, as rows of (country, year)
+    step_numbers = np.arange(steps + 1)
+    in_range = latest_years[:, None] + step_numbers[None, :] <= target_year
+    country_positions, row_steps = np.nonzero(in_range)
+    index = pd.MultiIndex.from_arrays([countries[country_positions], latest_years[country_positions] + row_steps],
+                                      names=['country', 'year'])
+    projection_df = pd.DataFrame(bands[:, country_positions, row_steps].T, index=index,
+                                 columns=[f"p{percentile:g}" for percentile in percentiles])
+
+    return u.record_dataset_version(projection_df, co2_data_countries)
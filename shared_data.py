@@ -0,0 +1,372 @@
+"""
+Shared-memory layout of the co2 data set.
+
+The data set is written once, by the gunicorn master (the app is started with --preload), to .npy files in a directory
+per download, on /dev/shm where available. Data frames are then built on top of read-only memory maps of those
+files without copying, so all workers read the same physical pages and adding a worker costs almost no extra memory.
+A process that starts later for a download that's already laid out simply attaches to the existing files, and reads
+the dataset version (the content hash of the data set) from the layout instead of parsing and hashing the csv again.
+
+Rows are ordered with countries first, so the country and region frames can be slices (views) of the full frame
+instead of copies. The country x year cube of every float column is laid out next to the data set the same way.
+
+The frames are read-only, so workers can answer requests from several threads without copying or locking the data:
+the numeric arrays behind them are flagged read-only, so writing a value raises ValueError, and they are SharedFrames,
+which raise SharedDataWriteError (a ValueError) on adding, replacing, or removing columns, on setting values with .loc,
+.iloc, .at, or .iat, on changing their attrs, and on other in-place changes. Code deriving data from them builds new
+frames instead, e.g. with utils.with_column. freeze protects other shared results the same way, e.g. the codebook and
+memoized frames (see cache.py).
+"""
+import json
+import os
+import shutil
+import tempfile
+import types
+
+import numpy as np
+import pandas as pd
+
+LAYOUT_FILE = 'layout.json'
+
+# part of the directory name, increased whenever the files or the layout file change, so old layouts aren't attached
+LAYOUT_FORMAT = 3
+
+# {directory : (cube, countries, years, columns)} for every cube attached by this process
+_attached_cubes = {}
+
+
+class SharedDataWriteError(ValueError):
+    """
+    Raised on a change to a read-only frame, see SharedFrame
+    """
+
+
+def refuse_write(*args, **kwargs):
+    raise SharedDataWriteError("shared data is read-only, derive a new frame from it instead (e.g. with "
+                               "utils.with_column)")
+
+
+class ReadOnlyIndexer:
+    """
+    Indexer of a SharedFrame (.loc, .iloc, .at, or .iat), which selects like the pandas indexer it wraps but refuses
+    setting values
+    """
+
+    def __init__(self, indexer):
+        self.indexer = indexer
+
+    def __getitem__(self, key):
+        return self.indexer[key]
+
+    __setitem__ = refuse_write
+
+
+class SharedFrame(pd.DataFrame):
+    """
+    Data frame that refuses to be changed in place, for data shared between threads, see freeze
+
+    Selections and computations on it return ordinary data frames, which belong to the code that made them.
+    """
+
+    @property
+    def _constructor(self):
+        return pd.DataFrame
+
+    # every way of changing the frame's columns in place
+    __setitem__ = __delitem__ = insert = pop = update = refuse_write
+
+    # selecting with the indexers works as usual, setting values with them raises, also where pandas would otherwise
+    # replace a column by one of another type (e.g. writing text to a float column) instead of writing to its array
+    @property
+    def loc(self):
+        return ReadOnlyIndexer(super().loc)
+
+    @property
+    def iloc(self):
+        return ReadOnlyIndexer(super().iloc)
+
+    @property
+    def at(self):
+        return ReadOnlyIndexer(super().at)
+
+    @property
+    def iat(self):
+        return ReadOnlyIndexer(super().iat)
+
+    @property
+    def attrs(self):
+        # a read-only view, pandas still copies it to the frames derived from this one
+        return types.MappingProxyType(super().attrs)
+
+    @attrs.setter
+    def attrs(self, value):
+        refuse_write()
+
+    def __setattr__(self, name, value):
+        # replacing the axes or the data changes the frame, e.g. methods called with inplace=True replace the data by
+        # their result. The data is consolidated by freeze, so pandas doesn't replace it by a consolidated copy either
+        if name in ('columns', 'index') or (name == '_mgr' and value is not self._mgr):
+            refuse_write()
+
+        super().__setattr__(name, value)
+
+
+def freeze(data):
+    """
+    Takes a data frame and returns it as a read-only SharedFrame on the same memory, without copying
+
+    The numeric arrays behind the frame are flagged read-only, so values can't be written through it or through any
+    view of it (e.g. a column, or a slice of rows), and the SharedFrame refuses changes to its columns, values, and
+    attrs. The frame passed in shares those arrays, so it should be dropped in favour of the result.
+    :param data: pd.DataFrame
+    :return: SharedFrame with the same data and attrs
+    """
+    # consolidate first, as pandas would on a later operation, replacing arrays of the same type by a writable copy.
+    # Text (object) arrays stay writable, pandas 1.5 can't compare read-only ones, but they are copies in every
+    # process rather than shared memory, and the SharedFrame still refuses writing to them
+    data._consolidate_inplace()
+    for block in data._mgr.blocks:
+        if isinstance(block.values, np.ndarray) and block.values.dtype != object:
+            block.values.setflags(write=False)
+
+    # the attrs are updated through the pandas property, since the SharedFrame only returns a read-only view of them
+    frozen = SharedFrame(data, copy=False)
+    pd.DataFrame.attrs.fget(frozen).update(data.attrs)
+
+    return frozen
+
+
+def shared_directory(download_key):
+    """
+    Takes the key of a download and returns the directory its shared arrays are stored in
+
+    The base directory can be set with the CO2_SHARED_DIR environment variable, and defaults to /dev/shm (memory
+    backed) where it exists, or the temp directory otherwise.
+    :param download_key: hash of the downloaded files, see download_data.download_key
+    :return: path of the directory
+    """
+    base_directory = os.environ.get('CO2_SHARED_DIR') or \
+        ('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+
+    return os.path.join(base_directory, f"co2-data-{LAYOUT_FORMAT}-{download_key}")
+
+
+def write_shared_data(data, directory, dataset_version, metadata=None):
+    """
+    Takes the full data set and writes it to the directory as .npy files that can be memory-mapped
+
+    Float columns are written as one block with a row per column, so every column is contiguous. Other numeric columns
+    are written as separate arrays, and text columns (country, iso_code) as integer codes with their categories in the
+    layout file. The files are written to a temporary directory that is renamed when complete, so other processes
+    never attach to a half-written layout.
+
+    :param data: the full co2 data set, as read from the csv
+    :param directory: directory to write to, see shared_directory
+    :param dataset_version: content hash of the data set, stored in the layout file
+    :param metadata: optional dict stored in the layout file, e.g. the validation report of the data set
+    :return: None
+    """
+    # put countries (rows with an iso_code) first, keeping the original order within countries and regions
+    data = data.take(np.argsort(data['iso_code'].isnull().to_numpy(), kind='stable'))
+    n_countries = int(data['iso_code'].notnull().sum())
+
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    temporary_directory = tempfile.mkdtemp(prefix=os.path.basename(directory) + '.', dir=os.path.dirname(directory))
+
+    # write all float columns as one block, with a row per column
+    float_columns = [col for col in data.columns if data[col].dtype == np.float64]
+    float_block = np.lib.format.open_memmap(os.path.join(temporary_directory, 'float_block.npy'), mode='w+',
+                                            dtype=np.float64, shape=(len(float_columns), len(data)))
+    float_block[:] = data[float_columns].to_numpy().T
+    float_block.flush()
+    del float_block
+
+    # write every other column on its own, text columns as codes into a list of categories
+    layout = {**(metadata or {}), 'dataset_version': dataset_version, 'n_rows': len(data), 'n_countries': n_countries,
+              'columns': []}
+    for position, col in enumerate(data.columns):
+        if col in float_columns:
+            layout['columns'].append({'name': col, 'kind': 'float_block', 'row': float_columns.index(col)})
+        elif pd.api.types.is_numeric_dtype(data[col]):
+            file_name = f"column_{position}.npy"
+            np.save(os.path.join(temporary_directory, file_name), data[col].to_numpy())
+            layout['columns'].append({'name': col, 'kind': 'array', 'file': file_name})
+        else:
+            file_name = f"column_{position}.npy"
+            codes, categories = pd.factorize(data[col])
+            np.save(os.path.join(temporary_directory, file_name), codes.astype(np.int32))
+            layout['columns'].append({'name': col, 'kind': 'codes', 'file': file_name,
+                                      'categories': [str(category) for category in categories]})
+    np.save(os.path.join(temporary_directory, 'index.npy'), data.index.to_numpy())
+
+    # lay out the country x year cube next to the data set
+    layout['cube'] = write_country_year_cube(data.iloc[:n_countries], float_columns, temporary_directory)
+
+    with open(os.path.join(temporary_directory, LAYOUT_FILE), 'w') as layout_file:
+        json.dump(layout, layout_file)
+
+    try:
+        os.rename(temporary_directory, directory)
+    except OSError:
+        # another process finished laying out the same version first, so its files are used instead
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+
+
+def write_country_year_cube(country_data, float_columns, directory):
+    """
+    Takes the country rows of the data set and writes the country x year cube of every float column to the directory
+
+    The cube has shape (columns, countries, years), so cube[i] is the country x year matrix of the i-th float column.
+    Country/year combinations without a row in the data set are NaN.
+
+    :param country_data: the rows of the data set that belong to countries
+    :param float_columns: names of the float columns, in the order of the cube's first axis
+    :param directory: directory to write to
+    :return: dict describing the cube's axes, stored in the layout file
+    """
+    country_index, countries = pd.factorize(country_data['country'])
+    years = country_data['year'].to_numpy()
+    first_year = int(years.min()) if len(years) else 0
+    n_years = int(years.max()) - first_year + 1 if len(years) else 0
+
+    cube = np.lib.format.open_memmap(os.path.join(directory, 'cube.npy'), mode='w+', dtype=np.float64,
+                                     shape=(len(float_columns), len(countries), n_years))
+    cube[:] = np.nan
+    cube[:, country_index, years - first_year] = country_data[float_columns].to_numpy().T
+    cube.flush()
+    del cube
+
+    return {'countries': [str(country) for country in countries], 'first_year': first_year, 'n_years': n_years,
+            'columns': float_columns}
+
+
+def read_shared_data(directory):
+    """
+    Takes a directory written by write_shared_data and builds the full data set on read-only memory maps of its files
+
+    The float columns (nearly all of the data) are views of the shared memory map. The year and text columns are small
+    and are copied into the process. The dataset version is recorded in the frame's attrs, which pandas carries over
+    to slices and copies of the frame.
+
+    :param directory: directory written by write_shared_data
+    :return: tuple of (the full data set with countries first as a read-only SharedFrame, number of country rows)
+    """
+    with open(os.path.join(directory, LAYOUT_FILE)) as layout_file:
+        layout = json.load(layout_file)
+
+    # build the frame on the float block without copying, the block's rows become the frame's columns
+    float_block = np.load(os.path.join(directory, 'float_block.npy'), mmap_mode='r')
+    float_columns = [entry['name'] for entry in layout['columns'] if entry['kind'] == 'float_block']
+    index = pd.Index(np.load(os.path.join(directory, 'index.npy')))
+    data = pd.DataFrame(float_block.T, index=index, columns=float_columns, copy=False)
+
+    # insert the other columns in their original positions, which restores the original column order
+    for position, entry in enumerate(layout['columns']):
+        if entry['kind'] == 'array':
+            data.insert(position, entry['name'], np.load(os.path.join(directory, entry['file'])))
+        elif entry['kind'] == 'codes':
+            codes = np.load(os.path.join(directory, entry['file']))
+            # code -1 marks a missing value, which picks the NaN appended to the categories
+            categories = np.array(entry['categories'] + [np.nan], dtype=object)
+            data.insert(position, entry['name'], categories[codes])
+    data.attrs['dataset_version'] = layout['dataset_version']
+
+    return freeze(data), layout['n_countries']
+
+
+def attach_shared_data(download_key, read_data, hash_data, validate_data=None, diff_data=None, metadata=None):
+    """
+    Takes the key of a download, a function that reads the data set, and a function that hashes it, returns the data
+    set on shared memory
+
+    If the download hasn't been laid out yet, read_data is called and its result is validated, hashed and written to
+    the shared directory first, together with how it differs from the download laid out before it. Downloads that were
+    laid out before are then removed, processes still attached to them keep their memory maps. A download that fails
+    validation isn't laid out, and the layouts of earlier downloads are kept, see latest_download_key.
+
+    :param download_key: hash of the downloaded files, see download_data.download_key
+    :param read_data: function without arguments returning the full data set as a DataFrame
+    :param hash_data: function taking the full data set and returning its dataset version
+    :param validate_data: optional function taking the full data set and returning its validation report, raising an
+    exception to refuse it (see validation.validate_or_refuse)
+    :param diff_data: optional function taking the previous data set, the previous layout, and the full data set, and
+    returning the changes between them (see dataset_diff.diff_data_sets), which is called if an earlier download is laid
+    out
+    :param metadata: optional dict stored in the layout file, available to diff_data of the next download
+    :return: tuple of (the full data set with countries first, number of country rows)
+    """
+    directory = shared_directory(download_key)
+    if not os.path.exists(os.path.join(directory, LAYOUT_FILE)):
+        data = read_data()
+        metadata = {**(metadata or {}), 'validation': validate_data(data) if validate_data else None}
+
+        # compare the data set to the one it replaces
+        previous_download_key = latest_download_key()
+        if diff_data and previous_download_key is not None:
+            previous_directory = shared_directory(previous_download_key)
+            previous_data, _ = read_shared_data(previous_directory)
+            metadata['changes'] = {'previous_download_key': previous_download_key,
+                                   **diff_data(previous_data, read_layout(previous_download_key), data)}
+
+        write_shared_data(data, directory, hash_data(data), metadata)
+        remove_other_versions(directory)
+
+    return read_shared_data(directory)
+
+
+def latest_download_key():
+    """
+    Returns the key of the download laid out most recently, e.g. the last one that passed validation
+    :return: download key, or None if no download is laid out
+    """
+    base_directory = os.path.dirname(shared_directory(''))
+    prefix = f"co2-data-{LAYOUT_FORMAT}-"
+    layouts = [os.path.join(base_directory, name) for name in os.listdir(base_directory)
+               if name.startswith(prefix) and '.' not in name and
+               os.path.exists(os.path.join(base_directory, name, LAYOUT_FILE))] \
+        if os.path.isdir(base_directory) else []
+    if not layouts:
+        return None
+
+    return os.path.basename(max(layouts, key=os.path.getmtime))[len(prefix):]
+
+
+def read_layout(download_key):
+    """
+    Takes the key of a download and returns its layout file, which holds the metadata stored with the data set, e.g.
+    'validation' (see validation.py) and 'changes' (see dataset_diff.py)
+    :param download_key: hash of the downloaded files, see download_data.download_key
+    :return: dict
+    """
+    with open(os.path.join(shared_directory(download_key), LAYOUT_FILE)) as layout_file:
+        return json.load(layout_file)
+
+
+def remove_other_versions(directory):
+    """
+    Takes the shared directory of the current download and removes the directories of all other downloads
+    :param directory: directory of the current download
+    :return: None
+    """
+    base_directory, current = os.path.split(directory)
+    for name in os.listdir(base_directory):
+        if name.startswith('co2-data-') and name != current and '.' not in name:
+            shutil.rmtree(os.path.join(base_directory, name), ignore_errors=True)
+
+
+def country_year_cube(download_key):
+    """
+    Takes the key of a download and returns its country x year cube as a read-only memory map
+
+    :param download_key: hash of the downloaded files, see download_data.download_key
+    :return: tuple of (cube with shape (columns, countries, years), list of countries, array of years, list of columns)
+    """
+    directory = shared_directory(download_key)
+    if directory not in _attached_cubes:
+        with open(os.path.join(directory, LAYOUT_FILE)) as layout_file:
+            cube_layout = json.load(layout_file)['cube']
+        cube = np.load(os.path.join(directory, 'cube.npy'), mmap_mode='r')
+        years = np.arange(cube_layout['first_year'], cube_layout['first_year'] + cube_layout['n_years'])
+        _attached_cubes[directory] = (cube, cube_layout['countries'], years, cube_layout['columns'])
+
+    return _attached_cubes[directory]
@@ -0,0 +1,154 @@
+"""
+Startup profiler for the app.
+
+Starts the app in a fresh interpreter with -X importtime, and reports the import time of each module, the time it
+takes to import app, and the time from interpreter start to the first response for the home page. The measurements
+are checked against the budget stored in startup_budget.json, so a change that slows down worker boot fails the check.
+
+Usage:
+    python startup_profile.py                   report and check against the stored budget
+    python startup_profile.py --top 40          show the 40 slowest modules
+    python startup_profile.py --update-budget   store the current measurements (plus headroom) as the new budget
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BUDGET_PATH = os.path.join(BASE_DIR, 'startup_budget.json')
+
+# runs in the child interpreter: times the app import and the first response, and prints the timings as json
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.server.test_client().get('/')
+responded = time.perf_counter()
+print(json.dumps({'import_app_seconds': imported - start, 'first_response_seconds': responded - start,
+                  'status_code': response.status_code}))
+"""
+
+
+def parse_import_times(importtime_output):
+    """
+    Takes the stderr output of python -X importtime, returns the self and cumulative import time of each module
+
+    :param importtime_output: text written to stderr by python -X importtime
+    :return: dict of {module name : (self seconds, cumulative seconds)}
+    """
+    import_times = {}
+    for line in importtime_output.splitlines():
+        # lines look like 'import time:       123 |       4567 |   package.module'
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        import_times[module.strip()] = (int(self_us) / 1e6, int(cumulative_us) / 1e6)
+
+    return import_times
+
+
+def profile_startup():
+    """
+    Starts the app in a fresh interpreter and measures its startup
+
+    :return: dict with the import time of app, the time to the first response, and the import times of each module
+    """
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_SCRIPT], cwd=BASE_DIR,
+                               capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"app failed to start:\n{completed.stderr[-2000:]}")
+
+    # the timings are the last line printed to stdout, anything before that was printed by the app
+    profile = json.loads(completed.stdout.strip().splitlines()[-1])
+    profile['modules'] = parse_import_times(completed.stderr)
+
+    return profile
+
+
+def check_budget(profile, budget):
+    """
+    Takes a startup profile and a budget, returns a list of every measurement that is over budget
+
+    The budget holds a limit in seconds for import_app_seconds and first_response_seconds, a limit on the cumulative
+    import time of individual modules, and a list of modules that must not be imported at startup at all.
+
+    :param profile: dict returned by profile_startup
+    :param budget: dict loaded from startup_budget.json
+    :return: list of messages describing each regression, empty if the startup is within budget
+    """
+    regressions = []
+
+    for measurement in ['import_app_seconds', 'first_response_seconds']:
+        if measurement in budget and profile[measurement] > budget[measurement]:
+            regressions.append(f"{measurement}: {profile[measurement]:.3f}s > budget of {budget[measurement]:.3f}s")
+
+    for module, limit in budget.get('modules', {}).items():
+        if module in profile['modules'] and profile['modules'][module][1] > limit:
+            regressions.append(f"import {module}: {profile['modules'][module][1]:.3f}s > budget of {limit:.3f}s")
+
+    # matching the top-level package catches a heavy library however it is imported
+    imported_packages = {module.split('.')[0] for module in profile['modules']}
+    for module in budget.get('forbidden_modules', []):
+        if module in imported_packages:
+            regressions.append(f"import {module}: should load lazily but was imported at startup")
+
+    return regressions
+
+
+def print_report(profile, top):
+    """
+    Takes a startup profile and prints the slowest modules and the overall startup timings
+
+    :param profile: dict returned by profile_startup
+    :param top: number of modules to show, sorted by cumulative import time
+    :return: None
+    """
+    print(f"{'module':<50} {'self (s)':>10} {'cumulative (s)':>15}")
+    slowest = sorted(profile['modules'].items(), key=lambda item: item[1][1], reverse=True)[:top]
+    for module, (self_seconds, cumulative_seconds) in slowest:
+        print(f"{module:<50} {self_seconds:>10.3f} {cumulative_seconds:>15.3f}")
+    print()
+    print(f"import app:        {profile['import_app_seconds']:.3f}s")
+    print(f"first response:    {profile['first_response_seconds']:.3f}s (status {profile['status_code']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--top', type=int, default=25, help='number of modules to show')
+    parser.add_argument('--update-budget', action='store_true',
+                        help='store the current measurements with 50%% headroom as the new budget')
+    args = parser.parse_args()
+
+    profile = profile_startup()
+    print_report(profile, args.top)
+
+    with open(BUDGET_PATH) as budget_file:
+        budget = json.load(budget_file)
+
+    if args.update_budget:
+        budget['import_app_seconds'] = round(profile['import_app_seconds'] * 1.5, 3)
+        budget['first_response_seconds'] = round(profile['first_response_seconds'] * 1.5, 3)
+        for module in budget.get('modules', {}):
+            if module in profile['modules']:
+                budget['modules'][module] = round(profile['modules'][module][1] * 1.5, 3)
+        with open(BUDGET_PATH, 'w') as budget_file:
+            json.dump(budget, budget_file, indent=4)
+        print(f"\nbudget updated in {BUDGET_PATH}")
+        return 0
+
+    regressions = check_budget(profile, budget)
+    print()
+    if regressions:
+        print("startup is over budget:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("startup is within budget")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,12 @@
 import pandas as pd
 import numpy as np
-from matplotlib import pyplot as plt
-import requests
 from download_data import co2_data_regions, co2_data_countries
+import bitmap_index as bi
+import tracing as tr
 import utils as u
 
 
+@tr.traced('compute')
 def find_earliest_data(original_data, column_name):
     """
     Takes the full data set and a column, returns the earliest available non-zero data and corresponding year
@@ -20,9 +21,9 @@ def find_earliest_data(original_data, column_name):
     :param column_name: the name of the column in the co2 data set for which you want the earliest available data
     :return: dataframe with the earliest data and corresponding year for each country in the data set
     """
-    # remove nulls and zeros from the selected column in the original data set and assign to a new df
-
-    drop_nan = original_data[~(original_data[column_name].isnull() | (original_data[column_name] == 0))]
+    # remove nulls and zeros from the selected column in the original data set and assign to a new df, with only the
+    # columns needed to find the earliest year, using the bitmap index of the data set where possible
+    drop_nan = original_data[['country', 'year']][bi.available_rows(original_data, column_name)]
 
     #  find the index of the minimum year for each country and assign to df
 
@@ -31,7 +32,7 @@ def find_earliest_data(original_data, column_name):
     # extract rows from original dataframe using the earliest indexes and save as new df
     # with renamed columns labeling as earliest data and country as index
 
-    earliest_data_df = pd.DataFrame(original_data.iloc[earliest_year_index][['country', 'year', column_name]])
+    earliest_data_df = pd.DataFrame(original_data.loc[earliest_year_index][['country', 'year', column_name]])
     earliest_data_df.rename(columns={'year': 'earliest ' + column_name + ' year',
                                      column_name: 'earliest ' + column_name}, inplace=True)
     earliest_data_df.set_index('country', inplace=True)
@@ -39,6 +40,7 @@ def find_earliest_data(original_data, column_name):
     return earliest_data_df
 
 
+@tr.traced('compute')
 def find_latest_data(original_data, column_name):
     """
     Takes the full data set and a column, returns the latest available non-zero data and corresponding year
@@ -56,8 +58,9 @@ def find_latest_data(original_data, column_name):
     :param column_name: the name of the column in the co2 data set for which you want the latest available data
     :return: dataframe with the latest data and corresponding year for each country in the data set
     """
-    # remove nulls from the selected column in the original data set and assign to a new df
-    drop_nan = original_data[~(original_data[column_name].isnull() | (original_data[column_name] == 0))]
+    # remove nulls and zeros from the selected column in the original data set and assign to a new df, with only the
+    # columns needed to find the latest year, using the bitmap index of the data set where possible
+    drop_nan = original_data[['country', 'year']][bi.available_rows(original_data, column_name)]
 
     #  find the index of the minimum year for each country and assign to df
 
@@ -66,7 +69,7 @@ def find_latest_data(original_data, column_name):
     # extract rows from original dataframe using the latest indexes and save as new df with
     # renamed columns labeling as latest data and country as index
 
-    latest_data_df = pd.DataFrame(original_data.iloc[latest_year_index][['country', 'year', column_name]])
+    latest_data_df = pd.DataFrame(original_data.loc[latest_year_index][['country', 'year', column_name]])
     latest_data_df.rename(columns={'year': 'latest ' + column_name + ' year',
                                    column_name: 'latest ' + column_name}, inplace=True)
     latest_data_df.set_index('country', inplace=True)
@@ -74,6 +77,7 @@ def find_latest_data(original_data, column_name):
     return latest_data_df
 
 
+@tr.traced('compute')
 def column_summary(original_data, column_name):
     """
     Takes the full data set and a column, returns a df summarizing data and its availability for all countries
@@ -94,9 +98,10 @@ def column_summary(original_data, column_name):
     columns_to_int = ['earliest ' + column_name + ' year', 'latest ' + column_name + ' year']
     summary_df[columns_to_int] = summary_df[columns_to_int].astype(pd.Int64Dtype())
 
-    return summary_df
+    return u.record_dataset_version(summary_df, original_data)
 
 
+@tr.traced('compute')
 def add_growth_column_to_summary_df(summary_dataframe, column_name):
     """
     Takes the summary table for a column and returns a dataframe with an added column calculating growth rate
@@ -106,23 +111,20 @@ def add_growth_column_to_summary_df(summary_dataframe, column_name):
 
     :param summary_dataframe: the dataframe generated by the column_summary function
     :param column_name: name of the column for which a growth rate should be calculated
-    :return: original summary dataframe with an added column showing growth rate for each country
+    :return: new summary dataframe with an added column showing growth rate for each country
     """
 
-    # create a copy of the summary_df generated by column_summary function
-    summary_df = summary_dataframe
-
-    # add a column that calculates the percent change between earliest and latest available data
-    summary_df[column_name + ' % growth'] = \
-        ((summary_df['latest ' + column_name] - summary_df['earliest ' + column_name]) /
-         summary_df['earliest ' + column_name])
+    # calculate the percent change between earliest and latest available data
+    growth = ((summary_dataframe['latest ' + column_name] - summary_dataframe['earliest ' + column_name]) /
+              summary_dataframe['earliest ' + column_name])
 
-    # rename dataframe to clarify that it contains a growth element
-    summary_df_with_growth = summary_df
+    # add it as a column of a new df, so the summary df passed in (which may be memoized) isn't changed
+    summary_df_with_growth = u.with_column(summary_dataframe, column_name + ' % growth', growth)
 
     return summary_df_with_growth
 
 
+@tr.traced('compute')
 def create_combined_summary(original_data, column_names=None):
     """
     Takes the full data set and a set of columns, returns a df summarizing data for each country, including growth rates
@@ -155,9 +157,10 @@ def create_combined_summary(original_data, column_names=None):
     combined_summary = combined_summary.droplevel(level=0, axis=1)
     combined_summary = combined_summary.replace(np.inf, np.NaN)
 
-    return combined_summary
+    return u.record_dataset_version(combined_summary, original_data)
 
 
+@tr.traced('compute')
 def extract_growth_rates_from_summary_df(original_data, column_names=None):
     """
     Takes the full co2 data and a selection of columns, and returns only the growth rates for each column and country
@@ -188,4 +191,4 @@ def extract_growth_rates_from_summary_df(original_data, column_names=None):
     # run the function to create the combined_summary dataframe, and then extract the growth % columns
     growth_columns = create_combined_summary(original_data, column_names)[col_growth_names]
 
-    return growth_columns
+    return u.record_dataset_version(growth_columns, original_data)
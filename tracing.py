@@ -0,0 +1,275 @@
+"""
+Stage-level tracing of where time goes inside a request, as OpenTelemetry spans written to a local JSON-lines file.
+
+With CO2_TRACE_FILE=<file.jsonl>, every traced function and block is recorded as a span with its start and end time and
+its parent span, and tagged with the stage of the request it belongs to (attribute co2.stage):
+    ingest      download_data: downloading, reading, hashing, validating, and diffing the data set
+    filter      utils functions selecting rows of countries and years
+    compute     grouping and statistics in utils, summary_growth, and growth_analysis
+    callback    the page callbacks (see pages/), with their filter, compute, and figure spans inside
+    figure      building a figure with plotly
+    serialize   Dash encoding a callback's outputs to json, from the callback returning to the response
+Every Flask request is a root span (see register), so the spans of a callback request form one trace, e.g.
+    POST /_dash-update-component
+        pages.aggregate.update_agg_plot
+            bitmap_index.select_countries
+            utils.divide_data_into_groups_for_year_range
+                utils.find_all_data_for_year_range
+            aggregate
+            px.bar
+        dash.serialize
+
+Functions are traced with the traced decorator, and blocks with the span context manager:
+    @tr.traced('compute')
+    def column_summary(original_data, column_name): ...
+
+    with tr.span('px.bar', 'figure'):
+        fig = px.bar(...)
+
+Every line of the file is an OTLP/JSON ExportTraceServiceRequest holding one span, the format of the OpenTelemetry
+collector's file exporter, so the file can be read by its otlpjsonfile receiver and forwarded to any tracing backend.
+Spans are written as they end, by every process: background callbacks (see jobs.py) are forked from the request
+starting them, so their spans belong to that request's trace.
+
+Without CO2_TRACE_FILE, traced returns the function itself and span returns a shared object doing nothing, so tracing
+costs nothing in traced functions and a function call per traced block.
+"""
+import contextvars
+import functools
+import json
+import os
+import random
+import threading
+import time
+
+TRACE_FILE = os.environ.get('CO2_TRACE_FILE')
+ENABLED = bool(TRACE_FILE)
+
+SERVICE_NAME = 'historical-co2-data'
+
+# span kinds of the OTLP format
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+
+# status codes of the OTLP format
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+# span the code running in this context is inside of
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+# file descriptor of the trace file in this process, which is reopened in a forked process
+_trace_file = {'pid': None, 'fd': None}
+_file_lock = threading.Lock()
+
+
+def attribute_value(value):
+    """
+    Takes an attribute value, returns it as an OTLP AnyValue
+    :param value: str, bool, int, float, or any other value, which is converted to str
+    :return: dict
+    """
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+
+    return {'stringValue': str(value)}
+
+
+def write_span(span):
+    """
+    Takes an ended span and appends it to the trace file as a line of OTLP/JSON
+    :param span: Span
+    :return: None
+    """
+    record = {
+        'traceId': span.trace_id,
+        'spanId': span.span_id,
+        'parentSpanId': span.parent.span_id if span.parent is not None else '',
+        'name': span.name,
+        'kind': span.kind,
+        'startTimeUnixNano': str(span.start_ns),
+        'endTimeUnixNano': str(span.end_ns),
+        'attributes': [{'key': key, 'value': attribute_value(value)} for key, value in span.attributes.items()],
+        'status': span.status,
+    }
+    resource = {'attributes': [{'key': 'service.name', 'value': attribute_value(SERVICE_NAME)},
+                               {'key': 'process.pid', 'value': attribute_value(os.getpid())}]}
+    line = json.dumps({'resourceSpans': [{'resource': resource,
+                                          'scopeSpans': [{'scope': {'name': 'tracing'}, 'spans': [record]}]}]})
+
+    # a single write of a line to a file opened for appending, so lines of concurrent threads and processes don't mix
+    with _file_lock:
+        if _trace_file['pid'] != os.getpid():
+            _trace_file['fd'] = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            _trace_file['pid'] = os.getpid()
+        os.write(_trace_file['fd'], (line + '\n').encode('utf-8'))
+
+
+class Span:
+    """
+    A timed operation of a trace, used as a context manager, which is the current span of its context while it runs
+    """
+
+    def __init__(self, name, stage=None, kind=KIND_INTERNAL, attributes=None):
+        self.parent = _current_span.get()
+        self.name = name
+        self.stage = stage
+        self.kind = kind
+        self.trace_id = self.parent.trace_id if self.parent is not None else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.attributes = {'co2.stage': stage} if stage else {}
+        self.attributes.update(attributes or {})
+        self.status = {'code': STATUS_OK}
+        # end of the latest callback span inside this span, where serializing its outputs starts
+        self.callback_end_ns = None
+        self.start_ns = self.end_ns = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def start(self):
+        self.start_ns = time.time_ns()
+        self._token = _current_span.set(self)
+
+        return self
+
+    def end(self, exception=None):
+        self.end_ns = time.time_ns()
+        _current_span.reset(self._token)
+        if exception is not None:
+            self.status = {'code': STATUS_ERROR, 'message': f"{type(exception).__name__}: {exception}"}
+        if self.stage == 'callback' and self.parent is not None:
+            self.parent.callback_end_ns = self.end_ns
+        write_span(self)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end(exc_value)
+
+
+class NoSpan:
+    """
+    Stands in for a span when tracing is disabled, doing nothing
+    """
+
+    def set_attribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NO_SPAN = NoSpan()
+
+
+def span(name, stage=None, **attributes):
+    """
+    Takes the name and stage of a block, returns a context manager tracing it as a span
+    :param name: name of the span, e.g. 'px.bar'
+    :param stage: stage of the request, see the module docstring
+    :param attributes: attributes of the span, as str, bool, int, or float values
+    :return: Span, or a span doing nothing if tracing is disabled
+    """
+    if not ENABLED:
+        return _NO_SPAN
+
+    return Span(name, stage, attributes=attributes)
+
+
+def traced(stage, name=None):
+    """
+    Takes a stage, returns a decorator tracing every call of a function as a span
+    :param stage: stage of the request, see the module docstring
+    :param name: name of the spans, by default the module and name of the function, e.g. 'utils.find_country_range_data'
+    :return: decorator, which returns the function itself if tracing is disabled
+    """
+    def decorator(func):
+        if not ENABLED:
+            return func
+        span_name = name or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def traced_func(*args, **kwargs):
+            with Span(span_name, stage):
+                return func(*args, **kwargs)
+
+        return traced_func
+
+    return decorator
+
+
+def start_request_span():
+    """
+    Registered as a before_request hook, starts the root span of a request
+    :return: None
+    """
+    import flask
+
+    request = flask.request
+    request_span = Span(f"{request.method} {request.path}", 'request', KIND_SERVER,
+                        {'http.method': request.method, 'http.target': request.full_path.rstrip('?')})
+    if request.path.endswith('/_dash-update-component'):
+        request_span.set_attribute('dash.output', (request.get_json(silent=True) or {}).get('output', 'unknown'))
+    flask.g.request_span = request_span.start()
+
+
+def end_request_span(response):
+    """
+    Registered as an after_request hook, adds the span of serializing the callback's outputs, and ends the root span
+    :param response: flask.Response
+    :return: the response, unchanged
+    """
+    import flask
+
+    request_span = flask.g.pop('request_span', None)
+    if request_span is None:
+        return response
+
+    # Dash encodes the outputs after the callback returns, until the response reaches the after_request hooks
+    if request_span.callback_end_ns is not None:
+        serialize_span = Span('dash.serialize', 'serialize')
+        serialize_span.start_ns, serialize_span.end_ns = request_span.callback_end_ns, time.time_ns()
+        serialize_span.set_attribute('http.response_content_length', response.calculate_content_length() or 0)
+        write_span(serialize_span)
+
+    request_span.set_attribute('http.status_code', response.status_code)
+    request_span.end(None if response.status_code < 500 else RuntimeError(response.status))
+
+    return response
+
+
+def release_request_span(exception):
+    """
+    Registered as a teardown_request hook, ends the root span of a request that failed before its after_request hooks
+    :param exception: exception raised while handling the request, if any
+    :return: None
+    """
+    import flask
+
+    request_span = flask.g.pop('request_span', None)
+    if request_span is not None:
+        request_span.end(exception)
+
+
+def register(server):
+    """
+    Takes the Flask server of the Dash app and registers the root span of every request on it if CO2_TRACE_FILE is set
+    :param server: app.server
+    :return: None
+    """
+    if not ENABLED:
+        return
+
+    server.before_request(start_request_span)
+    server.after_request(end_request_span)
+    server.teardown_request(release_request_span)
@@ -1,10 +1,47 @@
 import pandas as pd
 import numpy as np
-from matplotlib import pyplot as plt
-import requests
 from download_data import co2_data_regions, co2_data_countries
+import tracing as tr
 
 
+def record_dataset_version(derived_data, original_data):
+    """
+    Takes a df derived from the data set and the data it was derived from, records the dataset version on the result
+
+    The version is stored in derived_data.attrs['dataset_version'], so tables and charts built from the result can be
+    traced back to the download they came from.
+    :param derived_data: df derived from original_data
+    :param original_data: the co2 data set, or a slice of it, carrying its version in attrs
+    :return: derived_data, with the dataset version recorded
+    """
+    derived_data.attrs['dataset_version'] = original_data.attrs.get('dataset_version')
+
+    return derived_data
+
+
+def with_column(data, column_name, values, position=None):
+    """
+    Takes a df, a column name, and values, returns a new df with the column added (or replaced), leaving data unchanged
+
+    The new df shares the memory of data's other columns instead of copying them, so this is cheap, and it works on the
+    read-only shared frames (see shared_data.py), which can't be changed in place.
+    :param data: df to derive the new df from
+    :param column_name: name of the column to add or replace
+    :param values: values of the column, a series aligned with data's index or an array as long as data
+    :param position: position to insert the column at, or None to add it at the end (or replace it in place)
+    :return: new df with the column
+    """
+    # shallow copy, which has its own columns but shares the arrays holding the data
+    new_data = data.copy(deep=False)
+    if position is None:
+        new_data[column_name] = values
+    else:
+        new_data.insert(position, column_name, values, True)
+
+    return record_dataset_version(new_data, data)
+
+
+@tr.traced('filter')
 def find_country_year_data(data, column_name, country, year):
     """
     Takes a data set, a column, country, and year, and returns the corresponding value from the data set
@@ -25,6 +62,7 @@ def find_country_year_data(data, column_name, country, year):
     return value
 
 
+@tr.traced('filter')
 def find_country_range_data(data, column_name, countries, year_1, year_2):
     """
     Takes a data set, a column, country, and year range, and returns the corresponding values from the data set as df
@@ -62,6 +100,7 @@ def find_country_range_data(data, column_name, countries, year_1, year_2):
     return country_range_df
 
 
+@tr.traced('filter')
 def find_all_data_for_year(original_data, year):
     """
     Take the original data and a year, and return a df with the each country's data for that year
@@ -75,6 +114,7 @@ def find_all_data_for_year(original_data, year):
     return single_year_data
 
 
+@tr.traced('filter')
 def find_all_data_for_year_range(original_data, year_1, year_2):
     """
     Take the original data and a year range, and return a df with each country's data for that range.
@@ -107,6 +147,7 @@ def pct_change_formula(datapoint_1, datapoint_2):
     return pct_change
 
 
+@tr.traced('compute')
 def find_pct_change_between_years(original_data, column_name, year_1, year_2):
     """
     Takes the full data set and two years, returns the percent change between the years for the chosen column
@@ -137,28 +178,99 @@ def find_pct_change_between_years(original_data, column_name, year_1, year_2):
     return pct_change_between_years_dataframe
 
 
+@tr.traced('compute')
 def add_yoy_pct_change(original_data):
     """
     Takes the full data set and returns it as a df with YoY growth rate for each column of data
     :param original_data: pass the original, unaltered owid co2 data df that as downloaded from the owid GitHub
-    :return: df with original data and added columns showing the YoY growth rates for all data
+    :return: new df with original data and added columns showing the YoY growth rates for all data
     """
-    # save a copy of original_data
-    data_with_pct_change = original_data
-    print(data_with_pct_change.select_dtypes(include=['int64', 'float64']))
-
-    # iterate through columns to add a YoY % change column for each column of original data that contains ints or floats
+    # find the YoY % change of every column of original data that contains ints or floats
     # default NaN fill method (pad) is used to fill forward the time series as if data had continued to accrue
-    for col in data_with_pct_change.select_dtypes(include=['int64', 'float64']):
-        # get the index of col
-        col_index = data_with_pct_change.columns.get_loc(col)
-        # insert a column to the right of col with the pct_change
-        data_with_pct_change.insert(col_index + 1, str(col) + ' YoY_pct_change', data_with_pct_change[col].pct_change())
+    numeric_columns = original_data.select_dtypes(include=['int64', 'float64']).columns
+    pct_changes = original_data[numeric_columns].pct_change()
+
+    # build a new df with the pct_change of each of those columns to the right of the column
+    columns = {}
+    for col in original_data.columns:
+        columns[col] = original_data[col]
+        if col in numeric_columns:
+            columns[str(col) + ' YoY_pct_change'] = pct_changes[col]
+    data_with_pct_change = record_dataset_version(pd.concat(columns, axis=1), original_data)
 
     return data_with_pct_change
 
 
-def divide_data_into_groups_for_year(original_data, year, column_to_group, number_of_groups):
+@tr.traced('compute')
+def find_weighted_quantile_groups(values, weights, number_of_groups, keys=None):
+    """
+    Takes arrays of values and weights, returns the weighted quantile group (1 to number_of_groups) of each value
+
+    Values are sorted (within each key, e.g. each year) and the cumulative share of weight at the midpoint of each value
+    is searched against the group edges 1/n, 2/n, ..., so that every group holds roughly the same share of the total
+    weight rather than the same number of values. For example, grouping gdp_per_capita weighted by population into 10
+    groups means each group holds roughly 10% of the world's people.
+
+    All keys are handled in one vectorized pass, so passing the 'year' column as keys groups every year at once.
+
+    :param values: array-like of values that determine the order of the groups
+    :param weights: array-like of non-negative weights, e.g. population or gdp
+    :param number_of_groups: number of groups to split the weight into
+    :param keys: optional array-like of keys (e.g. years); groups are formed separately within each key
+    :return: float array of group numbers, NaN where the value or weight is missing
+    """
+    values = np.asarray(values, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    keys = np.zeros(len(values)) if keys is None else np.asarray(keys)
+    groups = np.full(len(values), np.nan)
+
+    # only values with a value and a non-negative weight can be placed in a group
+    valid_index = np.flatnonzero(~(np.isnan(values) | np.isnan(weights)) & (weights >= 0))
+    if len(valid_index) == 0:
+        return groups
+
+    # sort by key first and value second, so each key forms a contiguous block sorted by value
+    order = valid_index[np.lexsort((values[valid_index], keys[valid_index]))]
+    sorted_keys = keys[order]
+    sorted_weights = weights[order]
+
+    # find where each key block starts, which block each position belongs to and the total weight of each block
+    block_starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    block = np.repeat(np.arange(len(block_starts)), np.diff(np.r_[block_starts, len(order)]))
+    cumulative_weight = np.cumsum(sorted_weights)
+    weight_before_block = np.r_[0, cumulative_weight][block_starts]
+    block_totals = np.add.reduceat(sorted_weights, block_starts)
+
+    # cumulative share of the block's weight at the midpoint of each value, searched against the group edges
+    with np.errstate(divide='ignore', invalid='ignore'):
+        midpoint_share = (cumulative_weight - weight_before_block[block] - sorted_weights / 2) / block_totals[block]
+    group_edges = np.arange(1, number_of_groups) / number_of_groups
+    sorted_groups = np.searchsorted(group_edges, midpoint_share, side='right') + 1.0
+
+    # blocks without any weight can't be split into groups
+    sorted_groups[~(block_totals[block] > 0)] = np.nan
+    groups[order] = sorted_groups
+
+    return groups
+
+
+def weighted_group_labels(values, weights, number_of_groups, keys=None):
+    """
+    Takes values and weights, returns categorical group labels in the same format pd.qcut produces
+
+    :param values: series of values that determine the order of the groups
+    :param weights: series of weights, e.g. population or gdp
+    :param number_of_groups: number of groups to split the weight into
+    :param keys: optional series of keys (e.g. years); groups are formed separately within each key
+    :return: categorical series with labels 1 to number_of_groups, indexed like values
+    """
+    groups = find_weighted_quantile_groups(values, weights, number_of_groups, keys)
+
+    return pd.Series(pd.Categorical(groups, categories=range(1, number_of_groups + 1)), index=values.index)
+
+
+@tr.traced('compute')
+def divide_data_into_groups_for_year(original_data, year, column_to_group, number_of_groups, weight_column=None):
     """
     Take original data, a year, a column, and number of groups, and return data with a column containing group number
 
@@ -166,6 +278,8 @@ def divide_data_into_groups_for_year(original_data, year, column_to_group, numbe
     :param original_data:
     :param column_to_group:
     :param number_of_groups:
+    :param weight_column: optional column (e.g. 'population') to weight groups by, so each group holds an equal share
+    of the weight instead of an equal number of countries
     :return:
     """
     # define name of columns containing groups
@@ -174,14 +288,20 @@ def divide_data_into_groups_for_year(original_data, year, column_to_group, numbe
     # create a df with all the countries' data for the chosen year
     grouped_df = find_all_data_for_year(original_data, year)
 
-    # cut into groups and store in a new column
-    grouped_df.insert(3, group_column_name, pd.qcut(grouped_df.loc[:, column_to_group], q=number_of_groups,
-                                                    labels=range(1, number_of_groups + 1)), True)
+    # cut into groups and store in a new column, using weighted quantiles if a weight column is passed
+    if weight_column:
+        group_labels = weighted_group_labels(grouped_df[column_to_group], grouped_df[weight_column], number_of_groups)
+    else:
+        group_labels = pd.qcut(grouped_df.loc[:, column_to_group], q=number_of_groups,
+                               labels=range(1, number_of_groups + 1))
+    grouped_df = with_column(grouped_df, group_column_name, group_labels, position=3)
 
-    return grouped_df, group_column_name
+    return record_dataset_version(grouped_df, original_data), group_column_name
 
 
-def divide_data_into_groups_for_year_range(original_data, year_1, year_2, column_to_group, number_of_groups):
+@tr.traced('compute')
+def divide_data_into_groups_for_year_range(original_data, year_1, year_2, column_to_group, number_of_groups,
+                                           weight_column=None):
     """
     Take original data, two years, a column, and number of groups, and return data with a column containing group number
 
@@ -190,6 +310,7 @@ def divide_data_into_groups_for_year_range(original_data, year_1, year_2, column
     :param original_data:
     :param column_to_group:
     :param number_of_groups:
+    :param weight_column: optional column (e.g. 'population') to weight groups by, summed over the year range
     :return:
     """
     # define name of columns containing groups
@@ -200,6 +321,13 @@ def divide_data_into_groups_for_year_range(original_data, year_1, year_2, column
     grouped_df = pd.DataFrame(grouped_df.groupby('country').sum(numeric_only=True))
     grouped_df['year_range'] = f"{year_1} - {year_2}"
 
+    # weighted groups always hold an equal share of the weight, so there are no duplicate edges to drop
+    if weight_column:
+        grouped_df.insert(3, group_column_name, weighted_group_labels(grouped_df[column_to_group],
+                                                                      grouped_df[weight_column], number_of_groups),
+                          True)
+        return record_dataset_version(grouped_df, original_data), group_column_name
+
     # cut into groups and store in a new column
     n_labels = number_of_groups + 1
     while n_labels > 0:
@@ -211,10 +339,12 @@ def divide_data_into_groups_for_year_range(original_data, year_1, year_2, column
         except ValueError:
             n_labels -= 1
 
-    return grouped_df, group_column_name
+    return record_dataset_version(grouped_df, original_data), group_column_name
 
 
-def group_pct_of_total(original_data, year, column_to_group, number_of_groups, pct_of_total_column):
+@tr.traced('compute')
+def group_pct_of_total(original_data, year, column_to_group, number_of_groups, pct_of_total_column,
+                       weight_column=None):
     """
     Takes a year from original data, groups countries by percentiles of a chosen column,
     and finds the contribution of each group to the total of a (potentially different) chosen column
@@ -223,12 +353,13 @@ def group_pct_of_total(original_data, year, column_to_group, number_of_groups, p
     :param year:
     :param column_to_group:
     :param number_of_groups:
+    :param weight_column: optional column (e.g. 'population') to weight groups by
     :return:
     """
     original_data = pd.DataFrame(original_data)
     # create df with data split into groups
     grouped_df, group_column_name = divide_data_into_groups_for_year(original_data, year, column_to_group,
-                                                                     number_of_groups)
+                                                                     number_of_groups, weight_column)
 
     # calculate total of all countries in given year
     total = find_all_data_for_year(original_data, year)[pct_of_total_column].sum()
@@ -241,7 +372,9 @@ def group_pct_of_total(original_data, year, column_to_group, number_of_groups, p
     return pct_of_total_dict
 
 
-def find_summary_statistics_per_group(original_data, year, column_to_group, number_of_groups, column_to_summarize):
+@tr.traced('compute')
+def find_summary_statistics_per_group(original_data, year, column_to_group, number_of_groups, column_to_summarize,
+                                      weight_column=None):
     """
     Take original data, year, a specified column, and the number of groups for that column. Return descriptive
     statistics of another chosen column for each group.
@@ -250,11 +383,12 @@ def find_summary_statistics_per_group(original_data, year, column_to_group, numb
     :param column_to_group:
     :param number_of_groups:
     :param column_to_summarize:
+    :param weight_column: optional column (e.g. 'population') to weight groups by
     :return:
     """
     # create df with a column denoting group for chosen column
     grouped_df, group_column_name = divide_data_into_groups_for_year(original_data, year, column_to_group,
-                                                                     number_of_groups)
+                                                                     number_of_groups, weight_column)
 
     # set a variable to store the name of column denoting groups
     # group_column_name = str(column_to_group) + " Group"
@@ -0,0 +1,306 @@
+"""
+Validation of the downloaded co2 data set, run on every ingest before it is laid out in shared memory.
+
+Most of the app assumes things the download doesn't guarantee: e.g. utils.find_country_range_data assigns values by
+position, so a duplicated (country, year) row or a country whose years aren't in order silently shifts a series, and a
+renamed column only shows up as an empty chart. Every check here is a single vectorized pass over the arrays of the
+data set, so validating the whole download takes milliseconds:
+    - schema: the columns the app relies on exist, with the right types, and every other column is numeric
+    - codebook: every column of the data set is described in the codebook and every described column exists
+    - uniqueness: every (country, year) appears once, and every country has one iso_code
+    - order: the rows of every country are contiguous, with years increasing
+    - ranges: years are plausible, values are finite, and columns like population aren't negative
+
+Each check reports the problems it found and the time it took. A check with severity 'error' that fails raises
+DataValidationError, which refuses the refresh: download_data keeps serving the last download that passed (see
+download_data.py), or fails to start if there is none. 'warning' checks are only reported.
+
+The report of the current data set is stored in its shared-memory layout and returned by /api/v1/version, and the
+message of DataValidationError holds the report of a refused download.
+"""
+import datetime
+import time
+
+import numpy as np
+import pandas as pd
+
+import tracing as tr
+
+# columns the app relies on, with the kind of type they must have
+REQUIRED_COLUMNS = {'country': 'text', 'year': 'integer', 'iso_code': 'text', 'population': 'float', 'gdp': 'float',
+                    'co2': 'float'}
+
+# first year the data set can plausibly start in, the last one is next year
+FIRST_YEAR = 1750
+
+# {column : (minimum, maximum)} of the values of a column, None for no bound
+VALUE_RANGES = {'population': (0, None), 'gdp': (0, None), 'primary_energy_consumption': (0, None),
+                'share_global_co2': (0, 100)}
+
+# number of examples listed with a problem
+MAX_EXAMPLES = 5
+
+
+class DataValidationError(ValueError):
+    """
+    Raised when the downloaded data set fails a validation check with severity 'error', holds the validation report
+    """
+
+    def __init__(self, report):
+        super().__init__(f"the downloaded data set failed validation:\n{format_report(report)}")
+        self.report = report
+
+
+def examples(values):
+    """
+    Takes values that caused a problem and returns the first few of them as a string
+    :param values: iterable of values
+    :return: comma-separated string, ending in '...' if there are more than MAX_EXAMPLES
+    """
+    values = list(values)
+    listed = ', '.join(str(value) for value in values[:MAX_EXAMPLES])
+
+    return listed + (', ...' if len(values) > MAX_EXAMPLES else '')
+
+
+def has_kind(series, kind):
+    """
+    Takes a column and a kind of type, returns whether the column has that kind of type
+    :param series: pd.Series
+    :param kind: 'text', 'integer' or 'float'
+    :return: bool
+    """
+    if kind == 'text':
+        return series.dtype == object
+    if kind == 'integer':
+        return pd.api.types.is_integer_dtype(series)
+
+    return pd.api.types.is_float_dtype(series)
+
+
+def check_schema(data, codebook):
+    """
+    Takes the data set and the codebook, returns the problems with the data set's columns
+    :param data: the full co2 data set, as read from the csv
+    :param codebook: the codebook, as read from its csv
+    :return: list of problems
+    """
+    problems = []
+    missing = [col for col in REQUIRED_COLUMNS if col not in data.columns]
+    if missing:
+        problems.append(f"missing columns: {examples(missing)}")
+
+    wrong_types = [f"{col} ({data[col].dtype}, expected {kind})" for col, kind in REQUIRED_COLUMNS.items()
+                   if col in data.columns and not has_kind(data[col], kind)]
+    if wrong_types:
+        problems.append(f"columns of the wrong type: {examples(wrong_types)}")
+
+    # every other column holds values, which the shared-memory layout and the charts expect to be numbers
+    not_numeric = [col for col in data.columns
+                   if col not in REQUIRED_COLUMNS and not pd.api.types.is_numeric_dtype(data[col])]
+    if not_numeric:
+        problems.append(f"columns that aren't numeric: {examples(not_numeric)}")
+
+    if data.columns.duplicated().any():
+        problems.append(f"duplicated columns: {examples(data.columns[data.columns.duplicated()])}")
+
+    return problems
+
+
+def check_codebook(data, codebook):
+    """
+    Takes the data set and the codebook, returns the columns that only one of them has, e.g. after a column is renamed
+    :param data: the full co2 data set, as read from the csv
+    :param codebook: the codebook, as read from its csv
+    :return: list of problems
+    """
+    problems = []
+    described = pd.Index(codebook['column'])
+    undescribed = data.columns[~data.columns.isin(described)]
+    if len(undescribed):
+        problems.append(f"columns missing from the codebook: {examples(undescribed)}")
+
+    absent = described[~described.isin(data.columns)]
+    if len(absent):
+        problems.append(f"codebook columns missing from the data set: {examples(absent)}")
+
+    return problems
+
+
+def country_keys(data):
+    """
+    Takes the data set and returns an integer per row that identifies its (country, year)
+    :param data: the full co2 data set
+    :return: tuple of (country code of every row, key of every row, array of countries)
+    """
+    # a missing country is a country of its own, so every row has a code
+    country_codes, countries = pd.factorize(data['country'].to_numpy(), use_na_sentinel=False)
+    years = data['year'].to_numpy().astype(np.int64)
+    first_year = years.min() if len(years) else 0
+    n_years = years.max() - first_year + 1 if len(years) else 0
+
+    return country_codes, country_codes * n_years + (years - first_year), countries
+
+
+def check_uniqueness(data, codebook):
+    """
+    Takes the data set and the codebook, returns the duplicated (country, year) rows and countries with more than one
+    iso_code
+    :param data: the full co2 data set, as read from the csv
+    :param codebook: the codebook, as read from its csv
+    :return: list of problems
+    """
+    problems = []
+    if data['country'].isnull().any():
+        problems.append(f"{int(data['country'].isnull().sum())} rows without a country")
+
+    # duplicated keys are neighbours once the keys are sorted
+    country_codes, keys, countries = country_keys(data)
+    sorted_keys = np.sort(keys)
+    duplicated = np.unique(sorted_keys[1:][sorted_keys[1:] == sorted_keys[:-1]])
+    if len(duplicated):
+        rows = data.iloc[np.flatnonzero(np.isin(keys, duplicated))].drop_duplicates(['country', 'year'])
+        problems.append(f"{len(duplicated)} duplicated (country, year) rows: "
+                        f"{examples(zip(rows['country'], rows['year']))}")
+
+    # a country has one iso_code, or none for a region
+    iso_codes, iso_categories = pd.factorize(data['iso_code'].to_numpy(), use_na_sentinel=False)
+    pairs = np.unique(country_codes * len(iso_categories) + iso_codes)
+    codes_per_country = np.bincount(pairs // max(len(iso_categories), 1), minlength=len(countries))
+    if (codes_per_country > 1).any():
+        problems.append(f"countries with more than one iso_code: {examples(countries[codes_per_country > 1])}")
+
+    return problems
+
+
+def check_order(data, codebook):
+    """
+    Takes the data set and the codebook, returns the countries whose rows aren't contiguous or whose years decrease
+    :param data: the full co2 data set, as read from the csv
+    :param codebook: the codebook, as read from its csv
+    :return: list of problems
+    """
+    problems = []
+    country_codes, _, countries = country_keys(data)
+    years = data['year'].to_numpy()
+
+    # every country starts once, so the number of changes of country is one less than the number of countries
+    starts = np.flatnonzero(np.r_[True, country_codes[1:] != country_codes[:-1]]) if len(data) else np.array([], int)
+    if len(starts) > len(countries):
+        scattered = np.flatnonzero(np.bincount(country_codes[starts], minlength=len(countries)) > 1)
+        problems.append(f"countries whose rows aren't contiguous: {examples(countries[scattered])}")
+
+    # within a country, every year is after the one before
+    same_country = country_codes[1:] == country_codes[:-1]
+    decreasing = same_country & (years[1:] <= years[:-1])
+    if decreasing.any():
+        problems.append(f"countries whose years don't increase: "
+                        f"{examples(pd.unique(countries[country_codes[1:][decreasing]]))}")
+
+    return problems
+
+
+def check_ranges(data, codebook):
+    """
+    Takes the data set and the codebook, returns the columns with values outside of their plausible range
+    :param data: the full co2 data set, as read from the csv
+    :param codebook: the codebook, as read from its csv
+    :return: list of problems
+    """
+    problems = []
+    years = data['year'].to_numpy()
+    last_year = datetime.date.today().year + 1
+    if len(years) and (years.min() < FIRST_YEAR or years.max() > last_year):
+        problems.append(f"years outside of {FIRST_YEAR} to {last_year}: {years.min()} to {years.max()}")
+
+    # all float columns at once, as a block with a column per data set column
+    float_columns = data.columns[[pd.api.types.is_float_dtype(data[col]) for col in data.columns]]
+    values = data[float_columns].to_numpy()
+    infinite = float_columns[np.isinf(values).any(axis=0)]
+    if len(infinite):
+        problems.append(f"columns with infinite values: {examples(infinite)}")
+
+    for col, (minimum, maximum) in VALUE_RANGES.items():
+        if col not in float_columns:
+            continue
+        column_values = values[:, float_columns.get_loc(col)]
+        outside = (column_values < (-np.inf if minimum is None else minimum)) | \
+                  (column_values > (np.inf if maximum is None else maximum))
+        if outside.any():
+            problems.append(f"{int(outside.sum())} values of {col} outside of {minimum} to {maximum}")
+
+    return problems
+
+
+# (name, function, severity) of every check, in the order they run. The checks after the schema rely on its columns
+CHECKS = [
+    ('schema', check_schema, 'error'),
+    ('codebook', check_codebook, 'error'),
+    ('uniqueness', check_uniqueness, 'error'),
+    ('order', check_order, 'error'),
+    ('ranges', check_ranges, 'warning'),
+]
+
+
+@tr.traced('ingest')
+def validate(data, codebook):
+    """
+    Takes the data set and the codebook, runs every check and returns the validation report
+
+    :param data: the full co2 data set, as read from the csv
+    :param codebook: the codebook, as read from its csv
+    :return: dict with 'passed' (whether no 'error' check failed), 'seconds', and 'checks', a list of dicts with the
+    name, severity, problems and seconds of each check
+    """
+    report = {'passed': True, 'seconds': 0.0, 'checks': []}
+    for name, check, severity in CHECKS:
+        # the other checks need the required columns, so a data set failing the schema isn't checked further
+        if name != 'schema' and not report['checks'][0]['passed']:
+            report['checks'].append({'name': name, 'severity': severity, 'passed': False, 'seconds': 0.0,
+                                     'problems': ['skipped, the schema check failed']})
+            continue
+
+        start = time.perf_counter()
+        problems = check(data, codebook)
+        seconds = time.perf_counter() - start
+
+        report['checks'].append({'name': name, 'severity': severity, 'passed': not problems, 'seconds': seconds,
+                                 'problems': problems})
+        report['seconds'] += seconds
+        if problems and severity == 'error':
+            report['passed'] = False
+
+    return report
+
+
+def validate_or_refuse(data, codebook):
+    """
+    Takes the data set and the codebook, returns the validation report, or raises DataValidationError if an 'error'
+    check fails
+
+    :param data: the full co2 data set, as read from the csv
+    :param codebook: the codebook, as read from its csv
+    :return: validation report, see validate
+    """
+    report = validate(data, codebook)
+    if not report['passed']:
+        raise DataValidationError(report)
+
+    return report
+
+
+def format_report(report):
+    """
+    Takes a validation report and returns it as text, a line per check followed by its problems
+    :param report: dict returned by validate
+    :return: str
+    """
+    lines = []
+    for check in report['checks']:
+        status = 'ok' if check['passed'] else ('FAILED' if check['severity'] == 'error' else 'warning')
+        lines.append(f"{check['name']:<12}{status:<9}{check['seconds'] * 1000:8.2f} ms")
+        lines.extend(f"    {problem}" for problem in check['problems'])
+    lines.append(f"{'total':<21}{report['seconds'] * 1000:8.2f} ms")
+
+    return '\n'.join(lines)
+